@@ -299,8 +299,305 @@ def demultiplex_register_subparser(subparser):
         '-j',
         type=int,
         required=True,
-        help="Number of cores to use. Note that the demultiplex step will only use at most 32 cores, "
-             "the merge lane step will use the number of cores you provided."
+        help="Number of cores to use. The demultiplex and merge lane steps use the number of cores you provided, "
+             "their concurrent jobs on each filesystem are limited by io_slots_per_mount in the mapping config."
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default='cutadapt',
+        choices=['cutadapt', 'native'],
+        help="Demultiplex engine. cutadapt: align R1 to all random index sequences with cutadapt; "
+             "native: look up the R1 prefix in a precomputed random index table, which is much faster."
+    )
+
+    parser.add_argument(
+        "--max_mismatch",
+        type=int,
+        default=0,
+        help="[native engine only] Max number of mismatches allowed in the random index. "
+             "Neighbour sequences shared by different indexes are always rejected. "
+             "0 gives the same result as the cutadapt engine."
+    )
+
+    parser.add_argument(
+        "--single_pass",
+        dest='single_pass',
+        action='store_true',
+        help="[native engine only] Demultiplex all lanes of a UID directly into the final cell FASTQ files, "
+             "skip the lane FASTQ files and the merge lane step."
+    )
+    parser.set_defaults(single_pass=False)
+
+    parser.add_argument(
+        "--prescan",
+        dest='prescan',
+        action='store_true',
+        help="Sample read pairs of each lane file to predict cell read pairs before demultiplex. "
+             "The prediction is saved in stats/prescan.stats.csv, UIDs with more predicted reads run first, "
+             "and [native engine only] reads of cells predicted to have less than total_read_pairs_min "
+             "read pairs are discarded instead of written."
+    )
+    parser.set_defaults(prescan=False)
+
+    parser.add_argument(
+        "--prescan_pairs",
+        type=int,
+        default=100000,
+        help="Number of read pairs sampled from each lane file in prescan."
+    )
+
+    parser.add_argument(
+        "--watch",
+        dest='watch',
+        action='store_true',
+        help="Start before all the FASTQ files exist (e.g. while bcl2fastq is still running). "
+             "Poll files matching fastq_pattern, demultiplex each UID and make its mapping Snakefile "
+             "as soon as its FASTQ files are complete. Ready UIDs are listed in stats/ReadyUIDs.txt."
+    )
+    parser.set_defaults(watch=False)
+
+    parser.add_argument(
+        "--watch_interval",
+        type=int,
+        default=60,
+        help="[watch mode only] Seconds between two polls."
+    )
+
+    parser.add_argument(
+        "--watch_stable_seconds",
+        type=int,
+        default=300,
+        help="[watch mode only] A FASTQ file is complete if its size do not change for this many seconds."
+    )
+
+    parser.add_argument(
+        "--watch_sentinel",
+        type=str,
+        default=None,
+        help="[watch mode only] Path of a file created after the conversion finished. "
+             "When it exists, all the files are complete and the watch finish after all UIDs are demultiplexed."
+    )
+
+    parser.add_argument(
+        "--watch_lanes",
+        type=int,
+        default=None,
+        help="[watch mode only] Number of lanes of each UID. If not provided, UIDs are demultiplexed after "
+             "the sentinel file exists. One of --watch_lanes and --watch_sentinel is required in watch mode."
+    )
+
+    parser.add_argument(
+        "--watch_timeout",
+        type=int,
+        default=3600,
+        help="[watch mode only] Without sentinel file, finish the watch when all UIDs are demultiplexed "
+             "and no file changed for this many seconds."
+    )
+
+    parser.add_argument(
+        "--read_qc",
+        dest='read_qc',
+        action='store_true',
+        help="[native engine only] Collect per-cell read length, mean quality, adapter and N base histograms "
+             "while demultiplexing, saved in stats/demultiplex.read_qc.npz."
+    )
+    parser.set_defaults(read_qc=False)
+
+    parser.add_argument(
+        "--fused_trim",
+        dest='fused_trim',
+        action='store_true',
+        help="[single_pass only] Apply the adapter, cut, quality and length trimming of the mapping config "
+             "while demultiplexing, write *.trimmed.fq.gz with their trim stats, "
+             "and skip the trim rules in the mapping Snakefile."
+    )
+    parser.set_defaults(fused_trim=False)
+
+    parser.add_argument(
+        "--resume",
+        dest='resume',
+        action='store_true',
+        help="Continue a demultiplex run in output_dir that did not finish (e.g. killed by the scheduler). "
+             "UIDs and stages that already finished are validated and skipped, only the missing work is run. "
+             "Use the same parameters as the killed run."
+    )
+    parser.set_defaults(resume=False)
+
+    parser.add_argument(
+        "--check_fastq",
+        dest='check_fastq',
+        action='store_true',
+        help="Run 'yap check-fastq' on all the input FASTQ files before demultiplex, "
+             "the report is saved in stats/check_fastq.csv and demultiplex stop if any file failed the check."
+    )
+    parser.set_defaults(check_fastq=False)
+    return
+
+
+def check_fastq_register_subparser(subparser):
+    parser = subparser.add_parser('check-fastq',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Check name pattern, gzip integrity and R1 R2 record parity "
+                                       "of raw FASTQ files before demultiplex.")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--fastq_pattern",
+        "-fq",
+        type=str,
+        required=True,
+        help="FASTQ files with wildcard to match all bcl2fastq results, pattern with wildcard must be quoted."
+    )
+
+    parser_req.add_argument(
+        "--barcode_version",
+        '-v',
+        '-V',
+        type=str,
+        required=True,
+        choices=['V1', 'V2'],
+        help="Barcode version, V1 for 8 random index, V2 for 384 random index"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        '-j',
+        type=int,
+        default=1,
+        help="Number of files checked in parallel."
+    )
+
+    parser.add_argument(
+        "--output_path",
+        '-o',
+        type=str,
+        default=None,
+        help="Path of the report CSV, one row per FASTQ file."
+    )
+    return
+
+
+def topup_register_subparser(subparser):
+    parser = subparser.add_parser('topup',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Demultiplex the FASTQ files of a top-up sequencing run "
+                                       "into an existing demultiplex output_dir, only the new reads are mapped.")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--fastq_pattern",
+        "-fq",
+        type=str,
+        required=True,
+        help="FASTQ files of the top-up run with wildcard, pattern with wildcard must be quoted."
+    )
+
+    parser_req.add_argument(
+        "--output_dir",
+        "-o",
+        type=str,
+        required=True,
+        help="Existing demultiplex output_dir, the new reads are demultiplexed into output_dir/topup/topup_name, "
+             "using the mapping config of output_dir."
+    )
+
+    parser_req.add_argument(
+        "--cpu",
+        '-j',
+        type=int,
+        required=True,
+        help="Number of cores to use."
+    )
+
+    parser.add_argument(
+        "--topup_name",
+        type=str,
+        default=None,
+        help="Name of the top-up run, if not provided, use Topup1, Topup2, ... in order."
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default='cutadapt',
+        choices=['cutadapt', 'native'],
+        help="Demultiplex engine, see 'yap demultiplex -h'."
+    )
+
+    parser.add_argument(
+        "--max_mismatch",
+        type=int,
+        default=0,
+        help="[native engine only] Max number of mismatches allowed in the random index."
+    )
+
+    parser.add_argument(
+        "--single_pass",
+        dest='single_pass',
+        action='store_true',
+        help="[native engine only] Demultiplex all lanes of a UID directly into the final cell FASTQ files."
+    )
+    parser.set_defaults(single_pass=False)
+
+    parser.add_argument(
+        "--fused_trim",
+        dest='fused_trim',
+        action='store_true',
+        help="[single_pass only] Trim the reads while demultiplexing."
+    )
+    parser.set_defaults(fused_trim=False)
+
+    parser.add_argument(
+        "--check_fastq",
+        dest='check_fastq',
+        action='store_true',
+        help="Check the top-up FASTQ files before demultiplex, see 'yap check-fastq -h'."
+    )
+    parser.set_defaults(check_fastq=False)
+
+    parser.add_argument(
+        "--resume",
+        dest='resume',
+        action='store_true',
+        help="Continue a top-up demultiplex that did not finish, topup_name is required."
+    )
+    parser.set_defaults(resume=False)
+    return
+
+
+def topup_merge_register_subparser(subparser):
+    parser = subparser.add_parser('topup-merge',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="After the top-up reads are mapped, merge their BAM, ALLC and stats "
+                                       "into the existing per-cell results.")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--output_dir",
+        "-o",
+        type=str,
+        required=True,
+        help="Existing demultiplex output_dir used in 'yap topup'."
+    )
+
+    parser_req.add_argument(
+        "--topup_name",
+        type=str,
+        required=True,
+        help="Name of the top-up run, the dir name in output_dir/topup."
+    )
+
+    parser.add_argument(
+        "--cpu",
+        '-j',
+        type=int,
+        default=1,
+        help="Number of files merged in parallel."
     )
     return
 
@@ -454,6 +751,9 @@ def main():
     print_plate_info_register_subparser(subparsers)
     make_sample_sheet_register_subparser(subparsers)
     demultiplex_register_subparser(subparsers)
+    check_fastq_register_subparser(subparsers)
+    topup_register_subparser(subparsers)
+    topup_merge_register_subparser(subparsers)
     start_from_cell_fastq_register_subparser(subparsers)
     summary_register_subparser(subparsers)
 
@@ -490,6 +790,12 @@ def main():
         from .demultiplex import make_sample_sheet as func
     elif cur_command == 'demultiplex':
         from .demultiplex import demultiplex_pipeline as func
+    elif cur_command == 'check-fastq':
+        from .demultiplex import check_fastq as func
+    elif cur_command == 'topup':
+        from .demultiplex import topup_pipeline as func
+    elif cur_command == 'topup-merge':
+        from .mapping import topup_merge as func
     elif cur_command == 'default-mapping-config':
         from .mapping import print_default_mapping_config as func
     elif cur_command == 'start-from-cell-fastq':
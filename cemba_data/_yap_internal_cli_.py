@@ -294,6 +294,498 @@ def generate_contacts_internal_subparser(subparser):
     )
 
 
+def demultiplex_internal_subparser(subparser):
+    parser = subparser.add_parser('demultiplex-fastq',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Native random index demultiplex of R1 R2 FASTQ file pairs, "
+                                       "see cemba_data.demultiplex.native_demultiplex")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--r1_path",
+        type=str,
+        nargs='+',
+        required=True,
+        help="Input R1 fastq path(s)"
+    )
+
+    parser_req.add_argument(
+        "--r2_path",
+        type=str,
+        nargs='+',
+        required=True,
+        help="Input R2 fastq path(s), in the same order as r1_path"
+    )
+
+    parser_req.add_argument(
+        "--index_fasta_path",
+        type=str,
+        required=True,
+        help="Random index fasta path"
+    )
+
+    parser_req.add_argument(
+        "--output_prefix",
+        type=str,
+        required=True,
+        help="Output prefix, cell FASTQ will be {output_prefix}-{index_name}-R1/2.fq.gz"
+    )
+
+    parser_req.add_argument(
+        "--stats_path",
+        type=str,
+        nargs='+',
+        required=True,
+        help="Output demultiplex stats path(s), one for each pair of input files"
+    )
+
+    parser.add_argument(
+        "--counts_path",
+        type=str,
+        nargs='+',
+        default=None,
+        help="Output demultiplex counts path(s), one for each pair of input files"
+    )
+
+    parser.add_argument(
+        "--max_mismatch",
+        type=int,
+        default=0,
+        help="Max number of mismatches allowed in the random index"
+    )
+
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=1,
+        help="gzip compress level of the output FASTQ files"
+    )
+
+    parser.add_argument(
+        "--compress_threads",
+        type=int,
+        default=1,
+        help="Number of threads compressing the output BGZF blocks in each process"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        type=int,
+        default=1,
+        help="Number of processes, if > 1, input files are split into chunks and demultiplexed in parallel"
+    )
+
+    parser.add_argument(
+        "--max_open_files",
+        type=int,
+        default=None,
+        help="Max number of output files each process keep open at the same time, "
+             "if not provided, determined by the open file limit (ulimit -n)"
+    )
+
+    parser.add_argument(
+        "--discard_index",
+        type=str,
+        nargs='+',
+        default=None,
+        help="Index names whose reads are only counted but not written"
+    )
+
+    parser.add_argument(
+        "--qc_path",
+        type=str,
+        default=None,
+        help="If provided, save per-cell read QC histograms into this .npz file"
+    )
+
+    parser.add_argument(
+        "--trim_config",
+        type=str,
+        default=None,
+        help="If provided, also trim the reads with the parameters in this mapping config file, "
+             "and write *.trimmed.fq.gz and *.trimmed.stats.* files instead of the raw cell FASTQ"
+    )
+
+
+def demultiplex_counts_internal_subparser(subparser):
+    parser = subparser.add_parser('demultiplex-counts',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Convert cutadapt demultiplex report into the demultiplex counts file")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--stats_path",
+        type=str,
+        required=True,
+        help="cutadapt demultiplex report path"
+    )
+
+    parser_req.add_argument(
+        "--index_fasta_path",
+        type=str,
+        required=True,
+        help="Random index fasta path used by cutadapt"
+    )
+
+    parser_req.add_argument(
+        "--counts_path",
+        type=str,
+        required=True,
+        help="Output demultiplex counts path"
+    )
+
+
+def trim_internal_subparser(subparser):
+    parser = subparser.add_parser('trim',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Single-pass adapter, end cut and quality trimming of a cell FASTQ file, "
+                                       "see cemba_data.demultiplex.fused_trim")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--input_path",
+        type=str,
+        required=True,
+        help="Input FASTQ path"
+    )
+
+    parser_req.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="Output trimmed FASTQ path"
+    )
+
+    parser_req.add_argument(
+        "--stats_path",
+        type=str,
+        required=True,
+        help="Output trim stats path"
+    )
+
+    parser_req.add_argument(
+        "--adapter",
+        type=str,
+        required=True,
+        help="3' adapter sequence"
+    )
+
+    parser.add_argument(
+        "--read_type",
+        type=str,
+        default='R1',
+        choices=['R1', 'R2'],
+        help="Read type of the input FASTQ"
+    )
+
+    parser.add_argument(
+        "--left_cut",
+        type=int,
+        default=10,
+        help="Number of bases removed from the 5' end after adapter trimming"
+    )
+
+    parser.add_argument(
+        "--right_cut",
+        type=int,
+        default=10,
+        help="Number of bases removed from the 3' end after adapter trimming"
+    )
+
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default='mc',
+        choices=['mc', 'mct'],
+        help="If mct, also trim the TSO, N6 and polyA/T adapters and write the stats in the mct layout"
+    )
+
+    parser.add_argument(
+        "--quality_threshold",
+        type=int,
+        default=20,
+        help="3' quality trimming threshold"
+    )
+
+    parser.add_argument(
+        "--length_threshold",
+        type=int,
+        default=30,
+        help="Reads shorter than this after trimming are discarded"
+    )
+
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=1,
+        help="gzip compress level of the output FASTQ file"
+    )
+
+    parser.add_argument(
+        "--compress_threads",
+        type=int,
+        default=1,
+        help="Number of threads compressing the output BGZF blocks"
+    )
+
+
+def dedup_internal_subparser(subparser):
+    parser = subparser.add_parser('dedup',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Streaming PCR duplicate removal of coordinate sorted single-end BAM, "
+                                       "see cemba_data.mapping.dedup")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--input_path",
+        type=str,
+        required=True,
+        help="Input BAM path, sorted by coordinate"
+    )
+
+    parser_req.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="Output BAM path without duplicates"
+    )
+
+    parser_req.add_argument(
+        "--metrics_path",
+        type=str,
+        required=True,
+        help="Output duplication metrics path, in picard MarkDuplicates metrics format"
+    )
+
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=None,
+        help="BGZF compress level of the output BAM, 0 for uncompressed BAM, if not provided, use the pysam default"
+    )
+
+
+def bismark_batch_internal_subparser(subparser):
+    parser = subparser.add_parser('bismark-batch',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Map the FASTQ files of many cells in one bismark job and split the results "
+                                       "back to cells, see cemba_data.mapping.bismark_batch")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--bismark_reference",
+        type=str,
+        required=True,
+        help="bismark reference dir"
+    )
+
+    parser_req.add_argument(
+        "--fastq_paths",
+        type=str,
+        nargs='+',
+        required=True,
+        help="Cell FASTQ paths, one file per cell"
+    )
+
+    parser_req.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Output dir of the cell BAM and report files"
+    )
+
+    parser_req.add_argument(
+        "--batch_name",
+        type=str,
+        required=True,
+        help="Name of the batch, used in the temporary batch dir name"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        type=int,
+        default=1,
+        help="Number of threads"
+    )
+
+    parser.add_argument(
+        "--pbat",
+        dest='pbat',
+        action='store_true',
+        help="Map with bismark --pbat mode"
+    )
+    parser.set_defaults(pbat=False)
+
+    parser.add_argument(
+        "--bowtie1",
+        dest='bowtie1',
+        action='store_true',
+        help="Map with bowtie1 instead of bowtie2"
+    )
+    parser.set_defaults(bowtie1=False)
+
+    parser.add_argument(
+        "--un",
+        dest='unmapped',
+        action='store_true',
+        help="Also write the unmapped reads of each cell, same as bismark --un"
+    )
+    parser.set_defaults(unmapped=False)
+
+    parser.add_argument(
+        "--keep_batch_dir",
+        dest='keep_batch_dir',
+        action='store_true',
+        help="Keep the temporary batch dir, for trouble shooting purpose"
+    )
+    parser.set_defaults(keep_batch_dir=False)
+
+    parser.add_argument(
+        "--report_dir",
+        type=str,
+        default=None,
+        help="Output dir of the cell report files, if not provided, use output_dir"
+    )
+
+    parser.add_argument(
+        "--bam_compress_level",
+        type=int,
+        default=None,
+        help="BGZF compress level of the cell BAM files, 0 for uncompressed BAM, "
+             "if not provided, use the pysam default"
+    )
+
+
+def star_shared_genome_internal_subparser(subparser):
+    parser = subparser.add_parser('star-shared-genome',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Run a STAR command with the genome shared in memory between the jobs "
+                                       "on the same node, see cemba_data.mapping.mct.star_shared")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--star_reference",
+        type=str,
+        required=True,
+        help="STAR genome dir, same as the --genomeDir of the STAR command"
+    )
+
+    parser_req.add_argument(
+        "star_command",
+        nargs=argparse.REMAINDER,
+        help="The STAR command with --genomeLoad LoadAndKeep, put after \"--\""
+    )
+
+    parser.add_argument(
+        "--lock_dir",
+        type=str,
+        default=None,
+        help="Node-local dir of the lock and consumer files, if not provided, use /dev/shm or the system temp dir"
+    )
+
+
+def bam_to_allc_internal_subparser(subparser):
+    parser = subparser.add_parser('bam-to-allc',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Generate ALLC file from a coordinate sorted bismark BAM file, "
+                                       "see cemba_data.mapping.bam_to_allc")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--bam_path",
+        type=str,
+        required=True,
+        help="Input BAM path, sorted by coordinate"
+    )
+
+    parser_req.add_argument(
+        "--reference_fasta",
+        type=str,
+        required=True,
+        help="Reference fasta used in the mapping, the encoded reference is saved as {reference_fasta}.allc.seq"
+    )
+
+    parser_req.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="Output ALLC path, bgzip compressed and tabix indexed"
+    )
+
+    parser.add_argument(
+        "--num_upstr_bases",
+        type=int,
+        default=0,
+        help="Number of upstream bases of the C in the context column"
+    )
+
+    parser.add_argument(
+        "--num_downstr_bases",
+        type=int,
+        default=2,
+        help="Number of downstream bases of the C in the context column"
+    )
+
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=5,
+        help="Compress level of the ALLC file"
+    )
+
+    parser.add_argument(
+        "--save_count_df",
+        dest='save_count_df',
+        action='store_true',
+        help="Save the mC and coverage of each context to {output_path}.count.csv"
+    )
+    parser.set_defaults(save_count_df=False)
+
+    parser.add_argument(
+        "--merged_cg_path",
+        type=str,
+        default=None,
+        help="If provided, also write the strand merged mCG ALLC to this path in the same pass"
+    )
+
+    parser.add_argument(
+        "--mcg_context",
+        type=str,
+        default='CGN',
+        help="mC pattern of the strand merged mCG ALLC, CGN for normal snmC, HCGN for NOMe"
+    )
+
+    parser.add_argument(
+        "--chrom_size_path",
+        type=str,
+        default=None,
+        help="If provided, only the chromosomes in the chrom size file are written to the strand merged mCG ALLC"
+    )
+
+
+def encode_reference_internal_subparser(subparser):
+    parser = subparser.add_parser('encode-reference',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Encode the reference fasta for bam-to-allc once before the mapping jobs, "
+                                       "see cemba_data.mapping.bam_to_allc")
+
+    parser_req = parser.add_argument_group("Required inputs")
+
+    parser_req.add_argument(
+        "--reference_fasta",
+        type=str,
+        required=True,
+        help="Reference fasta used in the mapping, the encoded reference is saved as {reference_fasta}.allc.seq"
+    )
+
+
 def internal_main():
     parser = argparse.ArgumentParser(description=DESCRIPTION,
                                      epilog=EPILOG,
@@ -327,7 +819,9 @@ def internal_main():
 
     # set up logging
     if not logging.root.handlers:
-        setup_logging(stdout=True,
+        # the stdout of star-shared-genome is the STAR output (e.g. --outStd BAM_Unsorted streamed to a pipe),
+        # so its log must not go to stdout
+        setup_logging(stdout=args.command != 'star-shared-genome',
                       quiet=False)
 
     # execute command
@@ -344,6 +838,22 @@ def internal_main():
         from .mapping.m3c import split_fastq_reads as func
     elif cur_command == 'generate-contacts':
         from .mapping.m3c import generate_contacts as func
+    elif cur_command == 'demultiplex-fastq':
+        from .demultiplex.native_demultiplex import demultiplex_fastq_pair as func
+    elif cur_command == 'demultiplex-counts':
+        from .demultiplex.demultiplex_stats import cutadapt_report_to_counts as func
+    elif cur_command == 'trim':
+        from .demultiplex.fused_trim import trim_fastq as func
+    elif cur_command == 'dedup':
+        from .mapping.dedup import deduplicate_bam as func
+    elif cur_command == 'bismark-batch':
+        from .mapping.bismark_batch import bismark_batch as func
+    elif cur_command == 'star-shared-genome':
+        from .mapping.mct.star_shared import star_shared_genome as func
+    elif cur_command == 'bam-to-allc':
+        from .mapping.bam_to_allc import bam_to_allc as func
+    elif cur_command == 'encode-reference':
+        from .mapping.bam_to_allc import encode_reference as func
     else:
         log.debug(f'{cur_command} not Known, check the main function if else part')
         parser.parse_args(["-h"])
@@ -1,2 +1,4 @@
 from .plateinfo_and_samplesheet import print_plate_info, make_sample_sheet
 from .demultiplex import demultiplex_pipeline
+from .check_fastq import check_fastq
+from .topup import topup_pipeline
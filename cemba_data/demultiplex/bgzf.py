@@ -0,0 +1,71 @@
+"""
+Minimal BGZF (blocked gzip) compressor
+
+BGZF is a series of small gzip members (<= 64 KB each) with the block size saved in the gzip extra field,
+see the SAM/BAM format specification. Any gzip reader can read a BGZF file,
+and BGZF aware readers (bgzip -@, htslib) can decompress the blocks in parallel.
+Because every block is compressed independently, the blocks of one buffer are compressed
+by a thread pool here, zlib releases the GIL during compression.
+"""
+
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# max uncompressed data of one block, same as htslib, so the compressed block always fit into 64 KB
+BLOCK_DATA_SIZE = 65280
+
+# gzip header with the BC extra subfield, the last 2 bytes (BSIZE) are added per block
+_BLOCK_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+# empty block marking the end of a BGZF file
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def compress_block(data, compress_level=5):
+    """Compress one piece of data (<= BLOCK_DATA_SIZE) into one BGZF block"""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # total block size - 1: header (18) + compressed data + CRC32 (4) + ISIZE (4) - 1
+    block_size = len(compressed) + 25
+    return b''.join([_BLOCK_HEADER,
+                     struct.pack('<H', block_size),
+                     compressed,
+                     struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))])
+
+
+class BgzfCompressor:
+    """
+    Compress bytes into BGZF blocks with a pool of threads.
+
+    Parameters
+    ----------
+    compress_level
+        zlib compress level of each block
+    threads
+        Number of compression threads, if threads <= 1, compress in the calling thread
+    """
+
+    def __init__(self, compress_level=5, threads=1):
+        self.compress_level = int(compress_level)
+        self.threads = max(1, int(threads))
+        self._executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+    def _compress(self, block_data):
+        return compress_block(block_data, self.compress_level)
+
+    def compress(self, data):
+        """Compress data into one or more complete BGZF blocks, no EOF block is added"""
+        view = memoryview(data)
+        blocks = [view[start:start + BLOCK_DATA_SIZE] for start in range(0, len(view), BLOCK_DATA_SIZE)]
+        if self._executor is None or len(blocks) == 1:
+            return b''.join(map(self._compress, blocks))
+        else:
+            return b''.join(self._executor.map(self._compress, blocks))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return
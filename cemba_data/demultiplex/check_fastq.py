@@ -0,0 +1,175 @@
+"""
+Pre-flight integrity check of raw FASTQ files
+
+Before demultiplex, check all the input files in parallel, each file is decompressed once as a stream:
+1. the file name matches the name pattern of the barcode version;
+2. the gzip stream is complete and not corrupted (CRC and size of each member are validated by the decoder);
+3. the FASTQ has complete 4-line records;
+4. R1 and R2 of the same UID and lane have the same number of records.
+All problems are collected into one report instead of stopping at the first bad file.
+"""
+
+import glob
+import logging
+import pathlib
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from xopen import xopen
+
+from .fastq_dataframe import _parse_v1_fastq_names, _parse_v2_fastq_names
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def check_fastq_file(path):
+    """
+    Stream one gzip FASTQ file and count its records.
+
+    Returns
+    -------
+    dict with the number of records, compressed file size and the error message (None if the file is OK)
+    """
+    path = pathlib.Path(path)
+    record = {'fastq_path': str(path), 'file_size': None, 'records': None, 'error': None}
+    try:
+        record['file_size'] = path.stat().st_size
+        lines = 0
+        first_byte = None
+        last_byte = b'\n'
+        # threads=0 decompress in the current process, the files are already checked in parallel
+        with xopen(path, 'rb', threads=0) as f:
+            while True:
+                chunk = f.read(_READ_BUFFER_SIZE)
+                if not chunk:
+                    break
+                if first_byte is None:
+                    first_byte = chunk[:1]
+                lines += chunk.count(b'\n')
+                last_byte = chunk[-1:]
+    except (OSError, EOFError, zlib.error) as e:
+        # truncated file raise EOFError, corrupted data raise BadGzipFile (OSError) or zlib.error
+        record['error'] = f'gzip stream error: {type(e).__name__}: {e}'
+        return record
+
+    if last_byte != b'\n':
+        # last line without newline is still a line
+        lines += 1
+    if lines == 0:
+        record['error'] = 'empty FASTQ'
+    elif first_byte != b'@':
+        record['error'] = 'not a FASTQ file, first line do not start with "@"'
+    elif lines % 4 != 0:
+        record['error'] = f'incomplete FASTQ record, {lines} lines is not a multiple of 4'
+    record['records'] = lines // 4
+    return record
+
+
+def _check_pairs(file_df):
+    """Errors of R1 and R2 of the same UID and lane having different number of records"""
+    errors = {}
+    for (uid, lane), sub_df in file_df.groupby(['uid', 'lane']):
+        read_types = sub_df.set_index('read_type')
+        missing = {'R1', 'R2'} - set(read_types.index)
+        if missing:
+            for path in sub_df['fastq_path']:
+                errors[path] = f'{uid} {lane} has no {missing.pop()} file'
+            continue
+        if read_types.index.duplicated().any():
+            # duplicated names are reported by the name check
+            continue
+        r1_records = read_types.loc['R1', 'records']
+        r2_records = read_types.loc['R2', 'records']
+        if pd.isna(r1_records) or pd.isna(r2_records):
+            # already reported by the file check
+            continue
+        if r1_records != r2_records:
+            for path in sub_df['fastq_path']:
+                errors[path] = f'R1 has {int(r1_records)} records but R2 has {int(r2_records)} records'
+    return errors
+
+
+def check_fastq(fastq_pattern, barcode_version, cpu=1, output_path=None):
+    """
+    Check name pattern, gzip integrity and R1 R2 record parity of all raw FASTQ files.
+
+    Parameters
+    ----------
+    fastq_pattern
+        FASTQ path pattern with wildcard
+    barcode_version
+        V1 or V2, used to check the file name pattern
+    cpu
+        Number of files checked in parallel
+    output_path
+        Path of the consolidated report CSV, one row per file. If not provided, only print the summary.
+
+    Returns
+    -------
+    report dataframe, raise RuntimeError after writing the report if any file failed the check
+    """
+    barcode_version = barcode_version.upper()
+    if barcode_version == 'V1':
+        name_parser = _parse_v1_fastq_names
+    elif barcode_version == 'V2':
+        name_parser = _parse_v2_fastq_names
+    else:
+        raise ValueError(f'Primer Version can only be V1 or V2, got {barcode_version}.')
+
+    paths = sorted(str(pathlib.Path(p).absolute()) for p in glob.glob(fastq_pattern))
+    if len(paths) == 0:
+        raise FileNotFoundError(f'No FASTQ file match the pattern {fastq_pattern}')
+    print(f'Check {len(paths)} FASTQ files with {cpu} processes.')
+
+    paths = pd.Series(paths, dtype=object)
+    name_df, valid = name_parser(paths.str.rsplit('/', n=1).str[-1])
+    file_df = name_df[['uid', 'lane', 'read_type']].copy()
+    file_df['fastq_path'] = paths
+    file_df['name_error'] = None
+    file_df.loc[~valid, 'name_error'] = f'unknown name pattern for barcode version {barcode_version}'
+    duplicated = file_df.duplicated(['uid', 'lane', 'read_type'], keep=False) & valid
+    file_df.loc[duplicated, 'name_error'] = 'duplicated UID, lane and read type'
+
+    # biggest files first, so the slowest jobs do not start last
+    sizes = {path: pathlib.Path(path).stat().st_size for path in paths}
+    records = []
+    with ProcessPoolExecutor(max(1, min(int(cpu), len(paths)))) as exe:
+        futures = [exe.submit(check_fastq_file, path)
+                   for path in sorted(paths, key=lambda p: sizes[p], reverse=True)]
+        for future in as_completed(futures):
+            record = future.result()
+            if record['error'] is not None:
+                log.error(f'{record["fastq_path"]}: {record["error"]}')
+            records.append(record)
+    file_df = file_df.merge(pd.DataFrame(records), on='fastq_path', how='left')
+    file_df['records'] = file_df['records'].astype('Int64')
+
+    pair_errors = _check_pairs(file_df[file_df['name_error'].isna()])
+    file_df['pair_error'] = file_df['fastq_path'].map(pair_errors)
+    file_df['ok'] = file_df[['name_error', 'error', 'pair_error']].isna().all(axis=1)
+    file_df = file_df.rename(columns={'error': 'file_error'})
+    file_df = file_df[['fastq_path', 'uid', 'lane', 'read_type', 'file_size', 'records',
+                       'ok', 'name_error', 'file_error', 'pair_error']]
+    if output_path is not None:
+        file_df.to_csv(output_path, index=False)
+
+    n_bad = (~file_df['ok']).sum()
+    print(f'{file_df.shape[0]} FASTQ files checked, {file_df["records"].sum():.0f} records in total.')
+    for column, problem in [('name_error', 'wrong file name'),
+                            ('file_error', 'corrupted or truncated content'),
+                            ('pair_error', 'R1 R2 record count mismatch')]:
+        n = file_df[column].notna().sum()
+        if n > 0:
+            print(f'{n} files have {problem}.')
+    if n_bad > 0:
+        bad_paths = file_df.loc[~file_df['ok'], 'fastq_path']
+        report = f', see details in {output_path}' if output_path is not None else ''
+        raise RuntimeError(f'{n_bad} FASTQ files failed the check{report}, '
+                           f'e.g. {", ".join(bad_paths[:5])}')
+    print('All FASTQ files passed the check.')
+    return file_df
@@ -0,0 +1,121 @@
+"""
+Stage and UID completion markers of the demultiplex pipeline
+
+Each stage (check_fastq, prescan, demultiplex, merge_lane, summarize, clean, skip, snakefile)
+write one small JSON marker per UID in output_dir/.checkpoint/{stage}/{uid}.json after it finished,
+the marker records the size of files produced by the stage. When the pipeline is resumed, a UID is skipped by a stage if
+1. it has the marker of this stage, and
+2. it also has the marker of a later stage, or the recorded files still exist with the same size.
+Otherwise the markers of this and all later stages are removed and the stage run again for the UID.
+Within a stage, the snakemake run is resumed by snakemake itself (only the incomplete jobs are rerun).
+"""
+
+import json
+import logging
+import pathlib
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+STAGES = ['check_fastq', 'prescan', 'demultiplex', 'merge_lane', 'summarize', 'clean', 'skip', 'snakefile']
+# key of stages that are not per UID
+ALL_UIDS = '_all_'
+
+
+class DemultiplexCheckpoint:
+    """
+    Read and write completion markers of the demultiplex pipeline
+
+    Parameters
+    ----------
+    output_dir
+        demultiplex output_dir
+    resume
+        If False, markers are only written, all the UIDs are pending in every stage
+    """
+
+    def __init__(self, output_dir, resume=False):
+        self.output_dir = pathlib.Path(output_dir).absolute()
+        self.checkpoint_dir = self.output_dir / '.checkpoint'
+        self.resume = resume
+
+    def _marker_path(self, stage, uid):
+        return self.checkpoint_dir / stage / f'{uid}.json'
+
+    def _validate(self, stage, uid):
+        with open(self._marker_path(stage, uid)) as f:
+            record = json.load(f)
+        for path, size in record['files'].items():
+            path = self.output_dir / path
+            if not path.exists():
+                log.warning(f'{path} recorded by the {stage} stage of {uid} do not exist.')
+                return False
+            if size is not None and path.stat().st_size != size:
+                log.warning(f'{path} recorded by the {stage} stage of {uid} changed size.')
+                return False
+        return True
+
+    def is_done(self, stage, uid=ALL_UIDS):
+        if not self._marker_path(stage, uid).exists():
+            return False
+        later_stages = STAGES[STAGES.index(stage) + 1:]
+        if any(self._marker_path(later_stage, uid).exists() for later_stage in later_stages):
+            # files of earlier stages may be consumed by later stages (e.g. lane FASTQ), no need to check them
+            return True
+        return self._validate(stage, uid)
+
+    def pending_uids(self, stage, uids):
+        """UIDs that still need to run the stage, their markers of this and later stages are removed"""
+        if not self.resume:
+            pending = list(uids)
+        else:
+            pending = [uid for uid in uids if not self.is_done(stage, uid)]
+            if len(pending) < len(uids):
+                print(f'Resume: {stage} stage already finished for {len(uids) - len(pending)} UIDs')
+        for uid in pending:
+            self.clear(stage, uid)
+        return pending
+
+    def clear(self, stage, uid=ALL_UIDS):
+        """Remove the markers of the stage and all later stages"""
+        for cur_stage in STAGES[STAGES.index(stage):]:
+            marker_path = self._marker_path(cur_stage, uid)
+            if marker_path.exists():
+                marker_path.unlink()
+        return
+
+    def mark_done(self, stage, uids=(ALL_UIDS,), patterns=None):
+        """
+        Write markers of the stage.
+
+        Parameters
+        ----------
+        stage
+        uids
+        patterns
+            Glob patterns relative to output_dir of files produced by the stage,
+            "{uid}" in the pattern is replaced by each UID. If the pattern has no wildcard (e.g. a summary file),
+            only its existence is checked when resuming, because other UIDs may change it.
+        """
+        if patterns is None:
+            patterns = []
+        marker_dir = self.checkpoint_dir / stage
+        marker_dir.mkdir(parents=True, exist_ok=True)
+        for uid in uids:
+            files = {}
+            for pattern in patterns:
+                pattern = pattern.replace('{uid}', uid)
+                if '*' not in pattern:
+                    files[pattern] = None
+                    continue
+                for path in self.output_dir.glob(pattern):
+                    if path.is_file():
+                        files[str(path.relative_to(self.output_dir))] = path.stat().st_size
+            # write to a temp file first, so a killed run never leave a truncated marker
+            marker_path = self._marker_path(stage, uid)
+            temp_path = marker_path.with_suffix('.json.tmp')
+            with open(temp_path, 'w') as f:
+                json.dump({'stage': stage, 'uid': uid, 'files': files}, f)
+            temp_path.rename(marker_path)
+        return
@@ -2,16 +2,23 @@
 Demultiplex pipeline
 """
 
-import locale
 import logging
 import pathlib
-import re
 import subprocess
+import time
 
 import pandas as pd
 
 import cemba_data
+from .check_fastq import check_fastq as _check_fastq
+from .checkpoint import DemultiplexCheckpoint
+from .demultiplex_stats import summarize_demultiplex_counts
 from .fastq_dataframe import make_fastq_dataframe
+from .io_resources import MountIOResources
+from .prescan import load_prescan, prescan_demultiplex
+from .read_qc import summarize_read_qc
+from .watch import FastqWatcher
+from ..fs_ops import move_paths, remove_paths, symlink_paths
 from ..mapping.pipelines import make_snakefile, prepare_run, validate_mapping_config
 from ..utilities import snakemake, get_configuration
 
@@ -22,7 +29,23 @@ log.addHandler(logging.NullHandler())
 PACKAGE_DIR = pathlib.Path(cemba_data.__path__[0])
 
 
-def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
+def _get_index_fasta_path(uid, barcode_version):
+    if barcode_version == 'V1':
+        random_index_fasta_path = str(PACKAGE_DIR /
+                                      'files/random_index_v1.fa')
+    elif barcode_version == 'V2':
+        multiplex_group = uid.split('-')[-2]
+        random_index_fasta_path = str(
+            PACKAGE_DIR / 'files/random_index_v2/'
+                          f'random_index_v2.multiplex_group_{multiplex_group}.fa')
+    else:
+        raise ValueError(f'Got unknown barcode version {barcode_version}.')
+    return random_index_fasta_path
+
+
+def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu, engine='cutadapt', max_mismatch=0,
+                 single_pass=False, compress_level=5, compress_threads=1, prescan=False, prescan_pairs=100000,
+                 io_resources=None, read_qc=False, fused_trim=False, uids=None, checkpoint=None):
     """
     Input raw FASTQ file pattern
     1. automatically parse the name to generate fastq dataframe
@@ -37,6 +60,40 @@ def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
     output_dir
     barcode_version
     cpu
+        Total cores of the snakemake run, each native engine rule also use all the cores
+        by splitting the input FASTQ into chunks, so a deeply sequenced UID won't run on a single core.
+    engine
+        "cutadapt" or "native", see native_demultiplex.py for the native engine
+    max_mismatch
+        Max number of mismatches in random index, only used by the native engine
+    single_pass
+        If True, demultiplex all lanes of a UID into the final cell FASTQ in one pass,
+        only used by the native engine
+    compress_level
+        Compress level of the final cell FASTQ, only used in single_pass
+    compress_threads
+        Number of BGZF compression threads, only used in single_pass
+    prescan
+        If True, sample prescan_pairs read pairs of each lane file to predict cell read pairs before demultiplex,
+        UIDs with more predicted reads run first, and reads of cells predicted to have too less reads
+        are discarded by the native engine, see prescan.py
+    prescan_pairs
+        Number of read pairs sampled from each lane file in prescan
+    io_resources
+        MountIOResources that limit the concurrent demultiplex jobs reading or writing on the same filesystem mount,
+        shared by all the demultiplex and merge lane runs, so the "measure" slots are only measured once.
+        If None, the default slots are used, see io_resources.py
+    read_qc
+        If True, collect per-cell read length, quality, adapter and N base histograms during demultiplex,
+        only used by the native engine, see read_qc.py
+    fused_trim
+        If True, trim the reads during demultiplex with the mapping config trim parameters,
+        the cell FASTQ are written as *.trimmed.fq.gz and the mapping Snakefile skip the trim rules,
+        only used in single_pass, see fused_trim.py
+    uids
+        If provided, only demultiplex these UIDs, e.g. the unfinished UIDs when resuming
+    checkpoint
+        DemultiplexCheckpoint, used to resume the prescan and the snakemake run
 
     Returns
     -------
@@ -49,22 +106,57 @@ def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
                                     barcode_version=barcode_version,
                                     output_path=output_dir / 'stats' / 'fastq_dataframe.csv')
 
+    index_fasta_paths = {uid: _get_index_fasta_path(uid, barcode_version)
+                         for uid in fastq_df['uid'].unique()}
+
+    resume = checkpoint is not None and checkpoint.resume
+
+    # predict cell read pairs by sampling
+    discard_index = {}
+    uid_priority = {}
+    if prescan:
+        if resume and checkpoint.is_done('prescan'):
+            print('Resume: load finished pre-scan results')
+            discard_index, uid_order = load_prescan(output_dir)
+        else:
+            config = get_configuration(output_dir / 'mapping_config.ini')
+            print('Pre-scanning raw FASTQ')
+            discard_index, uid_order = prescan_demultiplex(
+                fastq_df,
+                index_fasta_paths=index_fasta_paths,
+                output_dir=output_dir,
+                total_read_pairs_min=int(config['total_read_pairs_min']),
+                total_read_pairs_max=int(config['total_read_pairs_max']),
+                n_pairs=prescan_pairs,
+                max_mismatch=max_mismatch,
+                cpu=cpu)
+            if checkpoint is not None:
+                checkpoint.mark_done('prescan', patterns=['stats/prescan.stats.csv'])
+        if engine != 'native':
+            # only the native engine can discard reads
+            discard_index = {}
+        # snakemake run jobs with higher priority first
+        uid_priority = {uid: len(uid_order) - i for i, uid in enumerate(uid_order.index)}
+
+    if uids is not None:
+        fastq_df = fastq_df[fastq_df['uid'].isin(uids)]
+
+    # limit concurrent jobs on each filesystem mount separately from the cpu
+    if io_resources is None:
+        io_resources = MountIOResources(cpu=cpu)
+
     # prepare UID sub dir
     snakefile_list = []
     total_stats_list = []
+    link_pairs = []
     rule_count = 0
     for uid, uid_df in fastq_df.groupby('uid'):
-        # determine index file path
-        if barcode_version == 'V1':
-            random_index_fasta_path = str(PACKAGE_DIR /
-                                          'files/random_index_v1.fa')
-        elif barcode_version == 'V2':
-            multiplex_group = uid.split('-')[-2]
-            random_index_fasta_path = str(
-                PACKAGE_DIR / 'files/random_index_v2/'
-                              f'random_index_v2.multiplex_group_{multiplex_group}.fa')
+        random_index_fasta_path = index_fasta_paths[uid]
+        priority = uid_priority.get(uid, 0)
+        if uid in discard_index:
+            discard_str = f' --discard_index {" ".join(discard_index[uid])}'
         else:
-            raise ValueError(f'Got unknown barcode version {barcode_version}.')
+            discard_str = ''
 
         # create a directory for each uid, within this UID, do multiplex and lane merge
         uid_output_dir = output_dir / uid
@@ -80,19 +172,86 @@ def _demultiplex(fastq_pattern, output_dir, barcode_version, cpu):
                 'uid', 'read_type', 'lane', 'fastq_path'
             ]]
             new_path = raw_dir / f'{uid}+{lane}+{read_type}.fq.gz'
-            subprocess.run(['ln', '-s', old_path, new_path], check=True)
+            # existing links are replaced, they may exist if the run is resumed
+            link_pairs.append((old_path, new_path))
         lanes = list(uid_df['lane'].unique())
         name_str = '{{name}}'
+        resources_str = io_resources.rule_resources(list(uid_df['fastq_path']) + [uid_output_dir])
 
         # make snakefile
         stats_out_list = [
             f'{lane_files_dir}/{uid}-{lane}.demultiplex.stats.txt'
             for lane in lanes
         ]
-        total_stats_list += stats_out_list
+        counts_out_list = [
+            f'{lane_files_dir}/{uid}-{lane}.demultiplex.counts.csv'
+            for lane in lanes
+        ]
+        total_stats_list += counts_out_list
+        # per-cell read QC is collected by the native engine only
+        collect_qc = read_qc and (single_pass or engine == 'native')
         rules = ""
-        for lane in lanes:
-            snake_file_template = f"""
+        if single_pass:
+            # one rule for all lanes of this UID, reads go to the final cell FASTQ directly,
+            # so there is no lane FASTQ and no merge lane step, only the lane stats are in lanes/
+            fastq_dir = uid_output_dir / 'fastq'
+            fastq_dir.mkdir(exist_ok=True)
+            r1_in = [f'{raw_dir}/{uid}+{lane}+R1.fq.gz' for lane in lanes]
+            r2_in = [f'{raw_dir}/{uid}+{lane}+R2.fq.gz' for lane in lanes]
+            # the rule threads are shared by demultiplex processes and their compression threads
+            demultiplex_processes = max(1, cpu // compress_threads)
+            if collect_qc:
+                qc_output_str = f"\n        qc_out = '{lane_files_dir}/{uid}-AllLanes.read_qc.npz',"
+                qc_str = ' --qc_path {output.qc_out}'
+            else:
+                qc_output_str = ''
+                qc_str = ''
+            trim_str = f' --trim_config {output_dir}/mapping_config.ini' if fused_trim else ''
+            rules += f"""
+rule demultiplex_{rule_count}:
+    input:
+        r1_in = {r1_in},
+        r2_in = {r2_in}
+    output:{qc_output_str}
+        stats_out = {stats_out_list},
+        counts_out = {counts_out_list}
+    threads:
+        {cpu}
+    priority:
+        {priority}
+    resources:
+        {resources_str}
+    shell:
+        "yap-internal demultiplex-fastq --r1_path {{input.r1_in}} --r2_path {{input.r2_in}} "
+        "--index_fasta_path {random_index_fasta_path} --output_prefix {fastq_dir}/{uid} "
+        "--stats_path {{output.stats_out}} --counts_path {{output.counts_out}} "
+        "--max_mismatch {max_mismatch} --compress_level {compress_level} "
+        "--compress_threads {compress_threads} --cpu {demultiplex_processes}{discard_str}{qc_str}{trim_str}"
+    """
+            rule_count += 1
+        else:
+            for lane in lanes:
+                if collect_qc:
+                    qc_output_str = f"\n        qc_out = '{lane_files_dir}/{uid}-{lane}.read_qc.npz',"
+                    qc_str = ' --qc_path {output.qc_out}'
+                else:
+                    qc_output_str = ''
+                    qc_str = ''
+                if engine == 'native':
+                    shell_str = f"""
+        "yap-internal demultiplex-fastq --r1_path {{input.r1_in}} --r2_path {{input.r2_in}} "
+        "--index_fasta_path {random_index_fasta_path} --output_prefix {lane_files_dir}/{uid}-{lane} "
+        "--stats_path {{output.stats_out}} --counts_path {{output.counts_out}} "
+        "--max_mismatch {max_mismatch} --cpu {{threads}}{discard_str}{qc_str}\""""
+                    threads = cpu
+                else:
+                    threads = 1
+                    shell_str = f"""
+        "cutadapt -Z -e 0.01 --no-indels -g file:{random_index_fasta_path} "
+        "-o {{params.r1_out}} -p {{params.r2_out}} {{input.r1_in}} {{input.r2_in}} > {{output.stats_out}} && "
+        "yap-internal demultiplex-counts --stats_path {{output.stats_out}} "
+        "--index_fasta_path {random_index_fasta_path} --counts_path {{output.counts_out}}\""""
+                snake_file_template = f"""
 rule demultiplex_{rule_count}:
     input:
         r1_in = f'{raw_dir}/{uid}+{lane}+R1.fq.gz',
@@ -103,20 +262,27 @@ rule demultiplex_{rule_count}:
         # here the r1/2_out have to have the name_str
         r1_out = lambda wildcards: f'{lane_files_dir}/{uid}-{lane}-{name_str}-R1.fq.gz',
         r2_out = lambda wildcards: f'{lane_files_dir}/{uid}-{lane}-{name_str}-R2.fq.gz'
-    output:
-        stats_out = '{lane_files_dir}/{uid}-{lane}.demultiplex.stats.txt'
-    shell:
-        "cutadapt -Z -e 0.01 --no-indels -g file:{random_index_fasta_path} "
-        "-o {{params.r1_out}} -p {{params.r2_out}} {{input.r1_in}} {{input.r2_in}} > {{output.stats_out}}"
+    output:{qc_output_str}
+        stats_out = '{lane_files_dir}/{uid}-{lane}.demultiplex.stats.txt',
+        counts_out = '{lane_files_dir}/{uid}-{lane}.demultiplex.counts.csv'
+    threads:
+        {threads}
+    priority:
+        {priority}
+    resources:
+        {resources_str}
+    shell:{shell_str}
     """
-            rule_count += 1
-            rules += snake_file_template
+                rule_count += 1
+                rules += snake_file_template
 
         snake_file_path = lane_files_dir / 'Snakefile'
         with open(snake_file_path, 'w') as f:
             f.write(rules)
         snakefile_list.append(f'{uid}/lanes/Snakefile')
 
+    symlink_paths(link_pairs, desc='Link raw FASTQ')
+
     # make final snakefile for demultiplex step
     final_rules = ''
     for path in snakefile_list:
@@ -131,18 +297,26 @@ rule final:
         f.write(final_rules)
 
     print('Demultiplexing raw FASTQ')
-    snakemake(workdir=output_dir, snakefile=final_snake_path, cores=cpu)
+    snakemake(workdir=output_dir, snakefile=final_snake_path, cores=cpu, resources=io_resources.resources,
+              resume=resume)
     return
 
 
-def _merge_lane(output_dir, cpu):
+def _merge_lane(output_dir, cpu, compress_level=5, compress_threads=1, io_resources=None, uids=None,
+                resume=False):
     output_dir = pathlib.Path(output_dir).absolute()
+    # lane FASTQ and cell FASTQ are all in output_dir
+    if io_resources is None:
+        io_resources = MountIOResources(cpu=cpu)
+    resources_str = io_resources.rule_resources([output_dir])
     fastq_df = pd.read_csv(output_dir / 'stats' / 'fastq_dataframe.csv')
     snakefile_list = []
     total_output_list = []
     rule_uid = 0
     # prepare snakefile in each uid
     for uid in fastq_df['uid'].unique():
+        if uids is not None and uid not in uids:
+            continue
         uid_output_dir = output_dir / uid
         lanes_dir = uid_output_dir / 'lanes'
         fastq_dir = uid_output_dir / 'fastq'
@@ -171,8 +345,12 @@ rule merge_{rule_uid}:
         {input_paths}
     output: 
         "{output_path}"
+    threads:
+        {compress_threads}
+    resources:
+        {resources_str}
     shell:
-        "gzip -cd {{input}} | gzip -5 > {{output}} && rm -f {{input}}"
+        "gzip -cd {{input}} | bgzip -@ {{threads}} -l {compress_level} -c > {{output}} && rm -f {{input}}"
 
 """
             rule_uid += 1
@@ -199,135 +377,103 @@ rule final:
         f.write(final_rules)
 
     print('Merging lanes to get cell FASTQ')
-    snakemake(workdir=output_dir, snakefile=final_snake_path, cores=cpu)
+    snakemake(workdir=output_dir, snakefile=final_snake_path, cores=cpu, resources=io_resources.resources,
+              resume=resume)
     return
 
 
-def _parse_index_fasta(fasta_path):
-    records = {}
-    with open(fasta_path) as f:
-        key_line = True
-        for line in f:
-            if key_line:
-                key = line.lstrip('>').rstrip('\n')
-                key_line = False
-            else:
-                value = line.lstrip('^').rstrip('\n')
-                records[key] = value
-                key_line = True
-    return records
-
-
-def _read_cutadapt_result(stat_path):
-    """
-    Parser of cutadapt output
-    """
-    with open(stat_path) as f:
-        p = re.compile(
-            r"Sequence: .+; Type: .+; Length: \d+; Trimmed: \d+ times")
-        series = []
-        total_pairs = -1
-        for line in f:
-            if line.startswith('Total read pairs processed'):
-                # some weird transform of cutadapt outputs...
-                locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
-                total_pairs = locale.atoi(line.split(' ')[-1])
-
-            m = p.search(line)
-            if m is not None:
-                result_dict = {}
-                for i in m.group().split('; '):
-                    k, v = i.split(': ')
-                    result_dict[k] = v
-                result_series = pd.Series(result_dict)
-                series.append(result_series)
-        total_df = pd.DataFrame(series)
-        total_df['Trimmed'] = total_df['Trimmed'].apply(
-            lambda c: c.split(' ')[0]).astype(int)
-        total_df['TotalPair'] = total_pairs
-        total_df['Ratio'] = total_df['Trimmed'] / total_pairs
-    return total_df
-
-
-def _summarize_demultiplex(output_dir, barcode_version):
+def _summarize_demultiplex(output_dir, barcode_version, uids=None):
     output_dir = pathlib.Path(output_dir).absolute()
     output_path = output_dir / 'stats' / 'demultiplex.stats.csv'
     barcode_version = barcode_version.upper()
-
-    # get index info
-    if barcode_version == 'V1':
-        random_index_fasta_path = str(PACKAGE_DIR /
-                                      'files/random_index_v1.fa')
-    elif barcode_version == 'V2':
-        # here we don't need to worry about the multiplex_group issue,
-        # because we just need a index_name to index_seq map
-        # we've considered this during demultiplex
-        random_index_fasta_path = str(
-            PACKAGE_DIR / 'files/random_index_v2/random_index_v2.fa')
-    else:
+    if barcode_version not in ['V1', 'V2']:
         raise ValueError(
             f'Unknown version name {barcode_version} in multiplexIndex section of the config file.'
         )
-    index_seq_dict = _parse_index_fasta(random_index_fasta_path)
-    index_name_dict = {v: k for k, v in index_seq_dict.items()}
-
-    # read the demultiplex stats, its per lane, so need to sum up lane together of each uid and index name
-    # but R1 R2 is demultiplexed together, so this table don't separate R1 R2
-    stat_list = []
-    stat_path_list = list(output_dir.glob('*/lanes/*demultiplex.stats.txt'))
-    for path in stat_path_list:
-        single_df = _read_cutadapt_result(path)
-        *uid, suffix = path.name.split('-')
-        lane = suffix.split('.')[0]
-        uid = '-'.join(uid)
-        single_df['uid'] = uid
-        single_df['lane'] = lane
-        single_df['index_name'] = single_df['Sequence'].map(index_name_dict)
-        assert single_df['index_name'].isna().sum() == 0
-        stat_list.append(single_df)
-    total_demultiplex_stats = pd.concat(stat_list)
-
-    # calculate cell level table
-    total_demultiplex_stats['cell_id'] = total_demultiplex_stats[
-                                             'uid'] + '-' + total_demultiplex_stats['index_name']
-
-    cell_table = total_demultiplex_stats.groupby('cell_id').agg({
-        'Trimmed': 'sum',
-        'TotalPair': 'sum',
-        'index_name': lambda i: i.unique()[0],
-        'uid': lambda i: i.unique()[0]
-    })
-    cell_table.rename(columns={
-        'Trimmed': 'CellInputReadPairs',
-        'TotalPair': 'MultiplexedTotalReadPairs',
-        'index_name': 'IndexName',
-        'uid': 'UID'
-    },
-        inplace=True)
-    cell_table['CellBarcodeRate'] = cell_table[
-                                        'CellInputReadPairs'] / cell_table['MultiplexedTotalReadPairs']
-    cell_table['BarcodeVersion'] = barcode_version
+
+    # the demultiplex counts are per lane, lanes of each uid and index name are summed up,
+    # R1 R2 is demultiplexed together, so this table don't separate R1 R2
+    if uids is None:
+        counts_path_list = list(output_dir.glob('*/lanes/*.demultiplex.counts.csv'))
+    else:
+        counts_path_list = [path for uid in uids for path in output_dir.glob(f'{uid}/lanes/*.demultiplex.counts.csv')]
+    cell_table = summarize_demultiplex_counts(counts_path_list, barcode_version=barcode_version)
+    if uids is not None and output_path.exists():
+        # only some UIDs are demultiplexed in watch mode, update their rows in the existing table
+        exist_table = pd.read_csv(output_path, index_col=0)
+        exist_table = exist_table[~exist_table['UID'].isin(uids)]
+        cell_table = pd.concat([exist_table, cell_table]).sort_index()
     cell_table.to_csv(output_path)
+
+    # per-cell read QC, only exist if read_qc is used with the native engine
+    if uids is None:
+        qc_path_list = list(output_dir.glob('*/lanes/*.read_qc.npz'))
+    else:
+        qc_path_list = [path for uid in uids for path in output_dir.glob(f'{uid}/lanes/*.read_qc.npz')]
+    if len(qc_path_list) > 0:
+        summarize_read_qc(qc_path_list, output_path=output_dir / 'stats' / 'demultiplex.read_qc.npz', uids=uids)
     return
 
 
-def _final_cleaning(output_dir):
+def _final_cleaning(output_dir, uids=None):
     """
     remove intermediate files from demultiplex
     """
     output_dir = pathlib.Path(output_dir)
 
-    delete_patterns = [f'Snakefile_*', '*/lanes', '*/raw', '*/Snakefile', '*/fastq/*-unknown-R*.fq.gz', '.snakemake']
+    if uids is None:
+        delete_patterns = [f'Snakefile_*', '*/lanes', '*/raw', '*/Snakefile', '*/fastq/*-unknown-R*.fq.gz',
+                           '.snakemake']
+    else:
+        # do not touch other UIDs, their mapping Snakefile may already exist
+        delete_patterns = [f'Snakefile_*', '.snakemake']
+        for uid in uids:
+            delete_patterns += [f'{uid}/lanes', f'{uid}/raw', f'{uid}/Snakefile', f'{uid}/fastq/*-unknown-R*.fq.gz']
 
     total_paths = []
     for pattern in delete_patterns:
-        total_paths += list(map(str, output_dir.glob(pattern)))
+        total_paths += list(output_dir.glob(pattern))
 
-    subprocess.run(['rm', '-rf'] + total_paths, check=True)
+    remove_paths(total_paths, desc='Remove demultiplex intermediate files')
     return
 
 
-def _skip_abnormal_fastq_pairs(output_dir):
+def _check_prescan_discard(output_dir, checkpoint):
+    """
+    Find cells discarded by the prescan but actually have enough read pairs,
+    their reads are lost, so the UIDs must be demultiplexed again without discarding.
+    The checkpoint of these UIDs is cleared and their cells are not discarded in stats/prescan.stats.csv anymore,
+    so a resumed run also demultiplex them again.
+
+    Returns
+    -------
+    list of UIDs to demultiplex again
+    """
+    prescan_path = output_dir / 'stats/prescan.stats.csv'
+    if not prescan_path.exists():
+        return []
+    prescan_df = pd.read_csv(prescan_path, index_col=0)
+    demultiplex_df = pd.read_csv(output_dir / 'stats/demultiplex.stats.csv', index_col=0)
+    config = get_configuration(output_dir / 'mapping_config.ini')
+    total_read_pairs_min = int(config['total_read_pairs_min'])
+
+    discarded = prescan_df.index[prescan_df['Discard']]
+    actual_pairs = demultiplex_df['CellInputReadPairs'].reindex(discarded).fillna(0)
+    wrong = actual_pairs[actual_pairs >= total_read_pairs_min]
+    if wrong.size == 0:
+        return []
+    redo_uids = list(prescan_df.loc[wrong.index, 'UID'].unique())
+    log.warning(f'{wrong.size} cells discarded by pre-scan have >= {total_read_pairs_min} read pairs: '
+                f'{", ".join(wrong.index)}. Demultiplex their UIDs again without discarding reads: '
+                f'{", ".join(redo_uids)}')
+    for uid in redo_uids:
+        checkpoint.clear('demultiplex', uid)
+    prescan_df.loc[prescan_df['UID'].isin(redo_uids), 'Discard'] = False
+    prescan_df.to_csv(prescan_path)
+    return redo_uids
+
+
+def _skip_abnormal_fastq_pairs(output_dir, uids=None):
     demultiplex_df = pd.read_csv(output_dir / 'stats/demultiplex.stats.csv', index_col=0)
     config = get_configuration(output_dir / 'mapping_config.ini')
     total_read_pairs_min = int(config['total_read_pairs_min'])
@@ -340,18 +486,21 @@ def _skip_abnormal_fastq_pairs(output_dir):
     print(f'Skip {too_small.sum()} cells due to too less input read pairs (< {total_read_pairs_min})')
     print(f'Skip {too_large.sum()} cells due to too large input read pairs (> {total_read_pairs_max})')
 
+    if uids is not None:
+        unmapped_cells = unmapped_cells[unmapped_cells['UID'].isin(uids)]
+    move_pairs = []
     for cell_id, row in unmapped_cells.iterrows():
         uid = row['UID']
         skipped_dir = output_dir / uid / 'fastq/skipped/'
         skipped_dir.mkdir(exist_ok=True)
 
         # move both R1 R2 to skipped files, it will not be included in Snakefile
+        # (with fused trim, also the trimmed FASTQ and trim stats)
         for read_type in ['R1', 'R2']:
-            fastq_path = output_dir / uid / f'fastq/{cell_id}-{read_type}.fq.gz'
-            new_path = skipped_dir / f'{cell_id}-{read_type}.fq.gz'
             # if CellInputReadPairs = 0, the FASTQ file do not actually exist, but it does have a row in metadata.
-            if fastq_path.exists():
-                subprocess.run(['mv', str(fastq_path), str(new_path)], check=True)
+            for fastq_path in (output_dir / uid / 'fastq').glob(f'{cell_id}-{read_type}.*'):
+                move_pairs.append((fastq_path, skipped_dir / fastq_path.name))
+    move_paths(move_pairs, desc='Move skipped cell FASTQ')
 
     # save UID total input reads, for command order
     uid_order = demultiplex_df[~judge].groupby(
@@ -362,38 +511,231 @@ def _skip_abnormal_fastq_pairs(output_dir):
 
 
 SUPPORTED_TECHNOLOGY = ['mc', 'mct', 'm3c']
+SUPPORTED_ENGINE = ['cutadapt', 'native']
 
 
-def demultiplex_pipeline(fastq_pattern, output_dir, config_path, cpu):
+def _demultiplex_and_prepare(fastq_pattern, output_dir, barcode_version, cpu, demultiplex_kws, single_pass,
+                             merge_kws, uids=None, checkpoint=None):
+    """
+    Demultiplex, merge lanes, summarize and make mapping Snakefile for all UIDs, or the given UIDs.
+    Each stage mark its finished UIDs in the checkpoint, when resuming, only the unfinished UIDs run the stage.
+    """
+    if checkpoint is None:
+        checkpoint = DemultiplexCheckpoint(output_dir, resume=False)
+    if uids is None:
+        all_uids = list(make_fastq_dataframe(fastq_pattern, barcode_version=barcode_version)['uid'].unique())
+    else:
+        all_uids = list(uids)
+
+    def _stage_uids(stage):
+        pending = checkpoint.pending_uids(stage, all_uids)
+        # None means all the UIDs in output_dir, same as a fresh run
+        return None if uids is None and len(pending) == len(all_uids) else pending
+
+    stage_uids = _stage_uids('demultiplex')
+    if stage_uids != []:
+        _demultiplex(
+            fastq_pattern=fastq_pattern,
+            output_dir=output_dir,
+            barcode_version=barcode_version,
+            cpu=cpu,
+            single_pass=single_pass,
+            uids=stage_uids,
+            checkpoint=checkpoint,
+            **demultiplex_kws)
+    demultiplex_patterns = ['{uid}/lanes/*.demultiplex.*', '{uid}/lanes/*.read_qc.npz']
+    if single_pass:
+        demultiplex_patterns.append('{uid}/fastq/*')
+    checkpoint.mark_done('demultiplex', all_uids if stage_uids is None else stage_uids,
+                         patterns=demultiplex_patterns)
+
+    if not single_pass:
+        stage_uids = _stage_uids('merge_lane')
+        if stage_uids != []:
+            _merge_lane(output_dir=output_dir, cpu=cpu, uids=stage_uids, resume=checkpoint.resume, **merge_kws)
+        checkpoint.mark_done('merge_lane', all_uids if stage_uids is None else stage_uids,
+                             patterns=['{uid}/fastq/*'])
+
+    stage_uids = _stage_uids('summarize')
+    if stage_uids != []:
+        _summarize_demultiplex(output_dir=output_dir, barcode_version=barcode_version, uids=stage_uids)
+    checkpoint.mark_done('summarize', all_uids if stage_uids is None else stage_uids,
+                         patterns=['stats/demultiplex.stats.csv'])
+
+    if demultiplex_kws.get('prescan', False) and demultiplex_kws.get('engine') == 'native':
+        redo_uids = _check_prescan_discard(output_dir=output_dir, checkpoint=checkpoint)
+        if len(redo_uids) > 0:
+            remove_paths([output_dir / uid / sub_dir for uid in redo_uids for sub_dir in ['lanes', 'fastq']],
+                         desc='Remove demultiplex files of UIDs with wrongly discarded cells')
+            _demultiplex(
+                fastq_pattern=fastq_pattern,
+                output_dir=output_dir,
+                barcode_version=barcode_version,
+                cpu=cpu,
+                single_pass=single_pass,
+                uids=redo_uids,
+                checkpoint=checkpoint,
+                **dict(demultiplex_kws, prescan=False))
+            checkpoint.mark_done('demultiplex', redo_uids, patterns=demultiplex_patterns)
+            if not single_pass:
+                _merge_lane(output_dir=output_dir, cpu=cpu, uids=redo_uids, resume=checkpoint.resume, **merge_kws)
+                checkpoint.mark_done('merge_lane', redo_uids, patterns=['{uid}/fastq/*'])
+            _summarize_demultiplex(output_dir=output_dir, barcode_version=barcode_version, uids=redo_uids)
+            checkpoint.mark_done('summarize', redo_uids, patterns=['stats/demultiplex.stats.csv'])
+
+    stage_uids = _stage_uids('clean')
+    if stage_uids != []:
+        _final_cleaning(output_dir=output_dir, uids=stage_uids)
+    checkpoint.mark_done('clean', all_uids if stage_uids is None else stage_uids)
+
+    stage_uids = _stage_uids('skip')
+    if stage_uids != []:
+        _skip_abnormal_fastq_pairs(output_dir=output_dir, uids=stage_uids)
+    checkpoint.mark_done('skip', all_uids if stage_uids is None else stage_uids,
+                         patterns=['{uid}/fastq/*'])
+
+    stage_uids = _stage_uids('snakefile')
+    if stage_uids != []:
+        make_snakefile(output_dir=output_dir, uids=stage_uids, fused_trim=demultiplex_kws.get('fused_trim', False))
+    checkpoint.mark_done('snakefile', all_uids if stage_uids is None else stage_uids,
+                         patterns=['{uid}/Snakefile*'])
+    return
+
+
+def _watch_demultiplex(fastq_pattern, output_dir, barcode_version, cpu, demultiplex_kws, single_pass, merge_kws,
+                       watcher, checkpoint=None):
+    """Demultiplex each UID as soon as its FASTQ files are complete"""
+    fastq_df_list = []
+    while True:
+        ready_paths, finished = watcher.poll()
+        if len(ready_paths) > 0:
+            fastq_df = make_fastq_dataframe(ready_paths, barcode_version=barcode_version)
+            uids = list(fastq_df['uid'].unique())
+            print(f'FASTQ files of {len(uids)} UIDs are complete: {", ".join(uids)}')
+            _demultiplex_and_prepare(fastq_pattern=ready_paths,
+                                     output_dir=output_dir,
+                                     barcode_version=barcode_version,
+                                     cpu=cpu,
+                                     demultiplex_kws=demultiplex_kws,
+                                     single_pass=single_pass,
+                                     merge_kws=merge_kws,
+                                     uids=uids,
+                                     checkpoint=checkpoint)
+            fastq_df_list.append(fastq_df)
+            with open(output_dir / 'stats/ReadyUIDs.txt', 'a') as f:
+                for uid in uids:
+                    f.write(f'{uid}\n')
+            print(f'Mapping Snakefile of these UIDs are ready, UID list is saved in {output_dir}/stats/ReadyUIDs.txt')
+        elif finished:
+            break
+        else:
+            time.sleep(watcher.poll_interval)
+
+    if len(fastq_df_list) == 0:
+        raise FileNotFoundError(f'No FASTQ file found with pattern {fastq_pattern}')
+    # fastq dataframe of all the UIDs
+    pd.concat(fastq_df_list).to_csv(output_dir / 'stats' / 'fastq_dataframe.csv', index=False)
+    return
+
+
+def demultiplex_pipeline(fastq_pattern, output_dir, config_path, cpu, engine='cutadapt', max_mismatch=0,
+                         single_pass=False, prescan=False, prescan_pairs=100000, watch=False, watch_interval=60,
+                         watch_stable_seconds=300, watch_sentinel=None, watch_lanes=None, watch_timeout=3600,
+                         read_qc=False, fused_trim=False, resume=False, check_fastq=False):
     cpu = int(cpu)
-    merge_cpu = min(48, cpu)
-    demultiplex_cpu = min(32, cpu)
+    if engine not in SUPPORTED_ENGINE:
+        raise ValueError(f'Unknown demultiplex engine {engine}, supported engines are {SUPPORTED_ENGINE}')
+    if single_pass and engine != 'native':
+        raise ValueError('single_pass demultiplex is only supported by the native engine.')
+    if watch and prescan:
+        raise ValueError('prescan is not supported in watch mode, files are not complete when demultiplex start.')
+    if read_qc and engine != 'native':
+        raise ValueError('read_qc is only supported by the native engine.')
+    if fused_trim and not single_pass:
+        raise ValueError('fused_trim is only supported in single_pass demultiplex.')
+    if check_fastq and watch:
+        raise ValueError('check_fastq is not supported in watch mode, files are not complete when demultiplex start.')
+    if watch and watch_lanes is None and watch_sentinel is None:
+        raise ValueError('Watch mode need --watch_lanes or --watch_sentinel to know when all the lanes '
+                         'of a UID are complete.')
 
     output_dir = pathlib.Path(output_dir).absolute()
+    new_config_path = output_dir / 'mapping_config.ini'
     if output_dir.exists():
-        raise FileExistsError('output_dir already exists, to prevent conflicts, '
-                              'use another output_dir or delete the existing output_dir first.')
+        if not resume:
+            raise FileExistsError('output_dir already exists, to prevent conflicts, '
+                                  'use another output_dir or delete the existing output_dir first. '
+                                  'Use --resume to continue a demultiplex run that did not finish.')
+        if not new_config_path.exists():
+            raise FileNotFoundError(f'{new_config_path} not found, output_dir is not a demultiplex output_dir.')
+        print(f'Resume demultiplex in {output_dir}, use the mapping config in it.')
+        with open(config_path) as f1, open(new_config_path) as f2:
+            if f1.read() != f2.read():
+                log.warning(f'{config_path} is different from {new_config_path}, '
+                            f'the latter is used by the resumed run.')
     else:
         output_dir.mkdir(parents=True)
         (output_dir / 'stats').mkdir()
+        subprocess.run(f'cp {config_path} {new_config_path}', shell=True, check=True)
+    checkpoint = DemultiplexCheckpoint(output_dir, resume=resume)
 
-    config = get_configuration(config_path)
-    new_config_path = output_dir / 'mapping_config.ini'
-    subprocess.run(f'cp {config_path} {new_config_path}', shell=True, check=True)
+    config = get_configuration(new_config_path)
     barcode_version = config['barcode_version']
+    # cell FASTQ are written in BGZF format, so downstream tools can decompress them in parallel
+    fastq_compress_level = int(config.get('fastq_compress_level', 5))
+    fastq_compress_threads = max(1, int(config.get('fastq_compress_threads', 1)))
+    # concurrent I/O jobs per filesystem mount, separate from the cpu limit
+    # created once, so the slots of each mount are measured only once for all the snakemake runs
+    io_resources = MountIOResources(slots=config.get('io_slots_per_mount', 'default'), cpu=cpu,
+                                    measure_dirs=[output_dir])
     # validate config file first before demultiplex
     validate_mapping_config(output_dir)
-
-    _demultiplex(
-        fastq_pattern=fastq_pattern,
-        output_dir=output_dir,
-        barcode_version=barcode_version,
-        cpu=demultiplex_cpu)
-    _merge_lane(output_dir=output_dir, cpu=merge_cpu)
-    _summarize_demultiplex(output_dir=output_dir, barcode_version=barcode_version)
-    _final_cleaning(output_dir=output_dir)
-    _skip_abnormal_fastq_pairs(output_dir=output_dir)
-    make_snakefile(output_dir=output_dir)
+    if check_fastq and not checkpoint.is_done('check_fastq'):
+        # raise before any demultiplex if any input file is broken
+        _check_fastq(fastq_pattern,
+                     barcode_version=barcode_version,
+                     cpu=cpu,
+                     output_path=output_dir / 'stats/check_fastq.csv')
+        checkpoint.mark_done('check_fastq', patterns=['stats/check_fastq.csv'])
+
+    demultiplex_kws = dict(engine=engine,
+                           max_mismatch=max_mismatch,
+                           compress_level=fastq_compress_level,
+                           compress_threads=fastq_compress_threads,
+                           prescan=prescan,
+                           prescan_pairs=int(prescan_pairs),
+                           io_resources=io_resources,
+                           read_qc=read_qc,
+                           fused_trim=fused_trim)
+    merge_kws = dict(compress_level=fastq_compress_level,
+                     compress_threads=fastq_compress_threads,
+                     io_resources=io_resources)
+    if watch:
+        watcher = FastqWatcher(fastq_pattern,
+                               barcode_version=barcode_version,
+                               poll_interval=watch_interval,
+                               stable_seconds=watch_stable_seconds,
+                               sentinel_path=watch_sentinel,
+                               expected_lanes=watch_lanes,
+                               idle_timeout=watch_timeout)
+        _watch_demultiplex(fastq_pattern=fastq_pattern,
+                           output_dir=output_dir,
+                           barcode_version=barcode_version,
+                           cpu=cpu,
+                           demultiplex_kws=demultiplex_kws,
+                           single_pass=single_pass,
+                           merge_kws=merge_kws,
+                           watcher=watcher,
+                           checkpoint=checkpoint)
+    else:
+        _demultiplex_and_prepare(fastq_pattern=fastq_pattern,
+                                 output_dir=output_dir,
+                                 barcode_version=barcode_version,
+                                 cpu=cpu,
+                                 demultiplex_kws=demultiplex_kws,
+                                 single_pass=single_pass,
+                                 merge_kws=merge_kws,
+                                 checkpoint=checkpoint)
 
     # this is just a convenient step, so I fix the parameters here
     # users should change the resulting batch submission
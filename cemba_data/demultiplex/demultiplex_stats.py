@@ -0,0 +1,130 @@
+"""
+Machine-readable demultiplex counts
+
+Each demultiplex job (one UID * lane) writes a small counts file
+{uid}-{lane}.demultiplex.counts.csv, example:
+
+index_name,read_pairs
+A1,11532
+A2,9871
+...
+unknown,1024
+total,2154312
+
+There is one row for every index in the index fasta (including 0 counts),
+"unknown" is the read pairs without a valid index, "total" is all the read pairs in the input.
+demultiplex.stats.csv is aggregated from these files without parsing any text report.
+"""
+
+import pathlib
+import re
+
+import pandas as pd
+
+from ..utilities import parse_index_fasta
+
+UNKNOWN_INDEX = 'unknown'
+TOTAL_PAIRS = 'total'
+
+
+def write_demultiplex_counts(counts_path, index_names, index_counts, total_pairs):
+    """
+    Write demultiplex counts file
+
+    Parameters
+    ----------
+    counts_path
+    index_names
+        All the index names in the index fasta, in the same order
+    index_counts
+        Dict-like of {index_name: read_pairs}, missing index names are counted as 0
+    total_pairs
+        Total input read pairs
+    """
+    assigned = 0
+    with open(counts_path, 'w') as f:
+        f.write('index_name,read_pairs\n')
+        for name in index_names:
+            count = index_counts.get(name, 0)
+            assigned += count
+            f.write(f'{name},{count}\n')
+        f.write(f'{UNKNOWN_INDEX},{total_pairs - assigned}\n')
+        f.write(f'{TOTAL_PAIRS},{total_pairs}\n')
+    return
+
+
+def read_cutadapt_result(stat_path):
+    """
+    Parse the text report of cutadapt demultiplex,
+    return total read pairs and a series of {index_sequence: trimmed_pairs}
+    """
+    with open(stat_path) as f:
+        text = f.read()
+    total_match = re.search(r'Total read pairs processed: +([\d,]+)', text)
+    if total_match is None:
+        raise ValueError(f'Total read pairs not found in cutadapt report {stat_path}')
+    # cutadapt report large numbers with thousands separator
+    total_pairs = int(total_match.group(1).replace(',', ''))
+
+    trimmed = re.findall(r'Sequence: (.+?); Type: .+?; Length: \d+; Trimmed: (\d+) times', text)
+    trimmed = pd.Series({seq: int(count) for seq, count in trimmed}, dtype=int)
+    return total_pairs, trimmed
+
+
+def cutadapt_report_to_counts(stats_path, index_fasta_path, counts_path):
+    """Convert the cutadapt demultiplex report into the demultiplex counts file"""
+    index_seq_dict = parse_index_fasta(index_fasta_path)
+    total_pairs, trimmed = read_cutadapt_result(stats_path)
+    index_counts = {name: int(trimmed.get(seq, 0)) for name, seq in index_seq_dict.items()}
+    write_demultiplex_counts(counts_path,
+                             index_names=list(index_seq_dict.keys()),
+                             index_counts=index_counts,
+                             total_pairs=total_pairs)
+    return
+
+
+def read_demultiplex_counts(counts_paths):
+    """
+    Read demultiplex counts files named as {uid}-{lane}.demultiplex.counts.csv
+
+    Returns
+    -------
+    Series of read pairs indexed by (uid, lane, index_name), index_name include "unknown" and "total"
+    """
+    records = {}
+    for path in counts_paths:
+        path = pathlib.Path(path)
+        *uid, suffix = path.name.split('-')
+        lane = suffix.split('.')[0]
+        uid = '-'.join(uid)
+        records[(uid, lane)] = pd.read_csv(path, index_col=0)['read_pairs']
+    if len(records) == 0:
+        raise FileNotFoundError('No demultiplex counts file found.')
+    counts = pd.concat(records, names=['uid', 'lane', 'index_name'])
+    return counts
+
+
+def summarize_demultiplex_counts(counts_paths, barcode_version):
+    """
+    Aggregate demultiplex counts files into the cell level demultiplex stats table
+
+    Returns
+    -------
+    DataFrame indexed by cell_id, with CellInputReadPairs, MultiplexedTotalReadPairs, IndexName, UID,
+    CellBarcodeRate and BarcodeVersion columns
+    """
+    counts = read_demultiplex_counts(counts_paths)
+    uid_total = counts.xs(TOTAL_PAIRS, level='index_name').groupby(level='uid').sum()
+
+    # different UIDs may use different index sets (V2 multiplex groups), so keep the long format
+    cell_pairs = counts.drop([UNKNOWN_INDEX, TOTAL_PAIRS], level='index_name')
+    cell_pairs = cell_pairs.groupby(level=['uid', 'index_name']).sum()
+    cell_table = cell_pairs.rename('CellInputReadPairs').reset_index()
+    cell_table.index = cell_table['uid'] + '-' + cell_table['index_name']
+    cell_table.index.name = 'cell_id'
+    cell_table = cell_table.rename(columns={'index_name': 'IndexName', 'uid': 'UID'})
+    cell_table['MultiplexedTotalReadPairs'] = cell_table['UID'].map(uid_total)
+    cell_table = cell_table[['CellInputReadPairs', 'MultiplexedTotalReadPairs', 'IndexName', 'UID']].sort_index()
+    cell_table['CellBarcodeRate'] = cell_table['CellInputReadPairs'] / cell_table['MultiplexedTotalReadPairs']
+    cell_table['BarcodeVersion'] = barcode_version
+    return cell_table
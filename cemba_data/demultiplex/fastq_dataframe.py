@@ -6,6 +6,7 @@ name pattern is based on samplesheet generated in plateinfo_and_samplesheet.py
 import glob
 import logging
 import pathlib
+import re
 
 import pandas as pd
 
@@ -13,66 +14,58 @@ import pandas as pd
 log = logging.getLogger()
 
 
-def _parse_v1_fastq_path(path):
+# {anything}-{field1}-{field2}-{field3}_{internal_info}_{lane}_{read_type}_{internal_info}
+# the prefix before the last three "-" separated fields is optional
+_FASTQ_NAME_PATTERN = re.compile(r'^(?:.*-)?(?P<field1>[^-]*)-(?P<field2>[^-]*)-'
+                                 r'(?P<field3>[^-_]*)_[^-_]*_(?P<lane>[^-_]*)_(?P<read_type>[^-_]*)_[^-_]*$')
+
+_VALID_LANES = ['L001', 'L002', 'L003', 'L004']
+_VALID_READ_TYPES = ['R1', 'R2']
+
+
+def _int_between(values, start, end):
+    """Column-wise check of values are integer strings in [start, end]"""
+    is_int = values.str.fullmatch(r'\d+').fillna(False).astype(bool)
+    numbers = pd.to_numeric(values.where(is_int), errors='coerce')
+    return is_int & numbers.between(start, end)
+
+
+def _parse_v1_fastq_names(names):
     """
     UID pattern of V1 {sample_id_prefix}-{plate1}-{plate2}-{plate_pos}
     FASTQ name pattern of V1:
     {sample_id_prefix}-{plate1}-{plate2}-{plate_pos}_{internal_info}_{lane}_{read_type}_{internal_info}.fastq.gz
     """
-    path = pathlib.Path(path)
-    try:
-        *_, plate1, plate2, multi_field = path.name.split('-')
-        plate_pos, _, lane, read_type, _ = multi_field.split('_')
-        try:
-            assert plate_pos[0] in 'ABCDEFGH'
-            assert int(plate_pos[1:]) in list(range(1, 13))
-            assert lane in {'L001', 'L002', 'L003', 'L004'}
-            assert read_type in {'R1', 'R2'}
-            assert plate1 != plate2
-        except AssertionError:
-            raise ValueError
-    except ValueError:
-        raise ValueError(f'Found unknown name pattern in path {path}')
-    name_dict = dict(plate1=plate1,
-                     plate2=plate2,
-                     plate_pos=plate_pos,
-                     lane=lane,
-                     read_type=read_type,
-                     fastq_path=path,
-                     uid=f'{plate1}-{plate2}-{plate_pos}')
-    name_series = pd.Series(name_dict)
-    return name_series
-
-
-def _parse_v2_fastq_path(path):
+    name_df = names.str.extract(_FASTQ_NAME_PATTERN)
+    name_df.columns = ['plate1', 'plate2', 'plate_pos', 'lane', 'read_type']
+    plate_pos = name_df['plate_pos']
+    valid = (name_df.notna().all(axis=1)
+             & plate_pos.str[:1].isin(list('ABCDEFGH'))
+             & _int_between(plate_pos.str[1:], 1, 12)
+             & name_df['lane'].isin(_VALID_LANES)
+             & name_df['read_type'].isin(_VALID_READ_TYPES)
+             & (name_df['plate1'] != name_df['plate2']))
+    name_df['uid'] = name_df['plate1'] + '-' + name_df['plate2'] + '-' + name_df['plate_pos']
+    return name_df, valid
+
+
+def _parse_v2_fastq_names(names):
     """
     UID pattern of V2 {sample_id_prefix}-{plate}-{multiplex_group}-{barcode_name}
-    FASTQ name pattern of V1:
+    FASTQ name pattern of V2:
     {sample_id_prefix}-{plate}-{multiplex_group}-{barcode_name}_{internal_info}_{lane}_{read_type}_{internal_info}.fastq.gz
     """
-    path = pathlib.Path(path)
-    try:
-        *_, plate, multiplex_group, multi_field = path.name.split('-')
-        primer_name, _, lane, read_type, _ = multi_field.split('_')
-        try:
-            assert primer_name[0] in 'ABCDEFGHIJKLMNOP'
-            assert int(primer_name[1:]) in list(range(1, 25))
-            assert int(multiplex_group) in list(range(1, 7))
-            assert lane in {'L001', 'L002', 'L003', 'L004'}
-            assert read_type in {'R1', 'R2'}
-        except AssertionError:
-            raise ValueError
-    except ValueError:
-        raise ValueError(f'Found unknown name pattern in path {path}')
-    name_dict = dict(plate=plate,
-                     multiplex_group=multiplex_group,
-                     primer_name=primer_name,
-                     lane=lane,
-                     read_type=read_type,
-                     fastq_path=path,
-                     uid=f'{plate}-{multiplex_group}-{primer_name}')
-    name_series = pd.Series(name_dict)
-    return name_series
+    name_df = names.str.extract(_FASTQ_NAME_PATTERN)
+    name_df.columns = ['plate', 'multiplex_group', 'primer_name', 'lane', 'read_type']
+    primer_name = name_df['primer_name']
+    valid = (name_df.notna().all(axis=1)
+             & primer_name.str[:1].isin(list('ABCDEFGHIJKLMNOP'))
+             & _int_between(primer_name.str[1:], 1, 24)
+             & _int_between(name_df['multiplex_group'], 1, 6)
+             & name_df['lane'].isin(_VALID_LANES)
+             & name_df['read_type'].isin(_VALID_READ_TYPES))
+    name_df['uid'] = name_df['plate'] + '-' + name_df['multiplex_group'] + '-' + name_df['primer_name']
+    return name_df, valid
 
 
 def make_fastq_dataframe(file_path, barcode_version, output_path=None):
@@ -93,9 +86,9 @@ def make_fastq_dataframe(file_path, barcode_version, output_path=None):
     """
     barcode_version = barcode_version.upper()
     if barcode_version == 'V1':
-        parser = _parse_v1_fastq_path
+        parser = _parse_v1_fastq_names
     elif barcode_version == 'V2':
-        parser = _parse_v2_fastq_path
+        parser = _parse_v2_fastq_names
     else:
         raise ValueError(f'Primer Version can only be V1 or V2, got {barcode_version}.')
 
@@ -108,20 +101,29 @@ def make_fastq_dataframe(file_path, barcode_version, output_path=None):
             file_path = [line.strip() for line in f]
     log.info(f'{len(file_path)} FASTQ file paths in input')
 
-    fastq_data = []
-    for path in file_path:
-        name_series = parser(path)
-        fastq_data.append(name_series)
-    fastq_df = pd.DataFrame(fastq_data)
+    paths = pd.Series(file_path, dtype=object).astype(str)
+    names = paths.str.rsplit('/', n=1).str[-1]
+    fastq_df, valid = parser(names)
+    if not valid.all():
+        invalid_paths = paths[~valid]
+        for path in invalid_paths:
+            log.error(f'Found unknown name pattern in path {path}')
+        raise ValueError(f'Found unknown name pattern in {invalid_paths.size} paths, '
+                         f'e.g. {", ".join(invalid_paths[:5])}')
+    fastq_df.insert(fastq_df.columns.get_loc('read_type') + 1, 'fastq_path', paths)
     log.info(f'{fastq_df.shape[0]} valid fastq names.')
     if fastq_df.shape[0] == 0:
         log.info('No fastq name remained, check if the name pattern is correct.')
         return None
 
     # make sure UID is unique
-    for _, df in fastq_df.groupby(['lane', 'read_type']):
-        if df['uid'].unique().size != df['uid'].size:
-            raise ValueError(f'UID column is not unique.')
+    duplicated = fastq_df.duplicated(['lane', 'read_type', 'uid'], keep=False)
+    if duplicated.any():
+        duplicated_paths = fastq_df.loc[duplicated, 'fastq_path']
+        for path in duplicated_paths:
+            log.error(f'Found duplicated UID, lane and read type in path {path}')
+        raise ValueError(f'UID column is not unique, {duplicated_paths.size} paths have duplicated '
+                         f'UID, lane and read type, e.g. {", ".join(duplicated_paths[:5])}')
     if output_path is not None:
         fastq_df.to_csv(output_path, index=False)
     return fastq_df
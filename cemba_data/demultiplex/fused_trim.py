@@ -0,0 +1,234 @@
+"""
+Single-pass adapter and quality trimming
+
+The trimming used to be two chained cutadapt commands on each cell FASTQ
+1. cutadapt -a ADAPTER(S)
+2. cutadapt -O 6 -q 20 -u LEFT_CUT -u -RIGHT_CUT -m 30
+Here the same cutadapt modifiers are applied to each read in one pass, the stats file is written
+in the layout of the two cutadapt reports, so it can be parsed by the mapping stats functions.
+The trimmer is used in two places:
+1. fused into the native demultiplex, so the cell FASTQ are written only once,
+   as {cell_id}-R1/2.trimmed.fq.gz, together with the trim stats;
+2. "yap-internal trim" in the trim rules of the mapping Snakefile templates.
+"""
+
+import re
+from collections import Counter
+
+import cutadapt
+import dnaio
+
+# the cutadapt modifiers and adapter parser are not a stable public API,
+# the output is verified to be the same as the cutadapt commands with this version
+CUTADAPT_MIN_VERSION = (5, 2)
+_cutadapt_version = tuple(int(i) for i in re.findall(r'\d+', cutadapt.__version__)[:2])
+if _cutadapt_version < CUTADAPT_MIN_VERSION:
+    raise ImportError(f'cutadapt >= {".".join(map(str, CUTADAPT_MIN_VERSION))} is required by the fused trimming, '
+                      f'found cutadapt {cutadapt.__version__}, please upgrade cutadapt.')
+
+from cutadapt.modifiers import AdapterCutter, ModificationInfo, QualityTrimmer, UnconditionalCutter
+from cutadapt.parser import make_adapters_from_specifications
+
+from .bgzf import BGZF_EOF, BgzfCompressor
+from ..utilities import get_configuration
+
+# same as the trim rules in the mapping Snakefile templates
+QUALITY_THRESHOLD = 20
+LENGTH_THRESHOLD = 30
+# cutadapt default search parameters
+SEARCH_PARAMETERS = dict(max_errors=0.1,
+                         min_overlap=3,
+                         read_wildcards=False,
+                         adapter_wildcards=True,
+                         indels=True)
+# additional adapters of the mct trim rules
+MCT_ADAPTERS = [('back', 'TSO=AAGCAGTGGTATCAACGCAGAGTGAATGG'),
+                ('back', 'N6=AAGCAGTGGTATCAACGCAGAGTAC'),
+                ('back', 'TSO_rc=CCATTCACTCTGCGTTGATACCACTGCTT'),
+                ('back', 'N6_rc=GTACTCTGCGTTGATACCACTGCTT'),
+                ('back', '3PpolyT=TTTTTTTTTTTTTTTX'),
+                ('front', '5PpolyT=XTTTTTTTTTTTTTTT'),
+                ('back', '3PpolyA=AAAAAAAAAAAAAAAX'),
+                ('front', '5PpolyA=XAAAAAAAAAAAAAAA'),
+                ('back', 'polyTLong=TTTTTTTTTTTTTTTTTTTTTTTTTTTTTT'),
+                ('back', 'polyALong=AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'),
+                ('back', 'ISPCR_F=AAGCAGTGGTATCAACGCAGAGT'),
+                ('back', 'ISPCR_R=ACTCTGCGTTGATACCACTGCTT')]
+MINIMAL_REPORT_HEADER = 'status\tin_reads\tin_bp\ttoo_short\ttoo_long\ttoo_many_n\tout_reads\tw/adapters\tqualtrim_bp\tout_bp'
+_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def get_adapter_specifications(read_type, adapter, mode):
+    """Adapter specifications of the trim rules, mct reads are also trimmed by the TSO, N6, polyA/T adapters"""
+    if mode == 'mct':
+        return [('back', f'{read_type}Adapter={adapter}')] + MCT_ADAPTERS
+    else:
+        return [('back', adapter)]
+
+
+def get_trim_parameters(config_path):
+    """
+    Trim parameters of R1 and R2 from the mapping config file
+
+    Returns
+    -------
+    mode, dict of {read_type: dict(adapters, left_cut, right_cut)}
+    """
+    config = get_configuration(config_path)
+    mode = config['mode']
+    default_adapters = {'R1': 'AGATCGGAAGAGCACACGTCTGAAC', 'R2': 'AGATCGGAAGAGCGTCGTGTAGGGA'}
+    parameters = {}
+    for read_type in ['R1', 'R2']:
+        adapter = config.get(f'{read_type.lower()}_adapter', default_adapters[read_type])
+        parameters[read_type] = dict(adapters=get_adapter_specifications(read_type, adapter, mode),
+                                     left_cut=int(config.get(f'{read_type.lower()}_left_cut', 10)),
+                                     right_cut=int(config.get(f'{read_type.lower()}_right_cut', 10)))
+    return mode, parameters
+
+
+class TrimStats:
+    """Trim stats of one cell and read type, can be summed up between processes"""
+
+    def __init__(self):
+        self.in_reads = 0
+        self.in_bp = 0
+        self.with_adapters = 0
+        self.adapter_bp = 0  # bp after adapter trimming, i.e. the input bp of the second cutadapt
+        self.too_short = 0
+        self.qualtrim_bp = 0
+        self.out_reads = 0
+        self.out_bp = 0
+        self.adapter_counts = Counter()
+
+    def __iadd__(self, other):
+        for key, value in other.__dict__.items():
+            setattr(self, key, getattr(self, key) + value)
+        return self
+
+    def write(self, path, adapters=None):
+        """
+        Write stats in the format of the trim rules: cutadapt minimal reports of the two steps,
+        if adapters is provided (mct), the first step is written as a (shortened) full report
+        """
+        with open(path, 'w') as f:
+            if adapters is None:
+                f.write(MINIMAL_REPORT_HEADER + '\n')
+                f.write(f'OK\t{self.in_reads}\t{self.in_bp}\t0\t0\t0\t{self.in_reads}\t'
+                        f'{self.with_adapters}\t0\t{self.adapter_bp}\n')
+            else:
+                f.write('This is a cutadapt compatible report generated by yap fused trim.\n\n')
+                f.write(f'=== Summary ===\n\nTotal reads processed: {self.in_reads:,}\n'
+                        f'Reads with adapters: {self.with_adapters:,}\n\n')
+                for adapter in adapters:
+                    f.write(f'=== Adapter {adapter.name} ===\n\n'
+                            f'Sequence: {adapter.sequence}; Type: {adapter.description}; '
+                            f'Length: {len(adapter.sequence)}; '
+                            f'Trimmed: {self.adapter_counts[adapter.name]} times\n\n')
+            f.write(MINIMAL_REPORT_HEADER + '\n')
+            f.write(f'OK\t{self.in_reads}\t{self.adapter_bp}\t{self.too_short}\t0\t0\t{self.out_reads}\t'
+                    f'0\t{self.qualtrim_bp}\t{self.out_bp}\n')
+        return
+
+
+class ReadTrimmer:
+    """Trim one type of reads (R1 or R2) the same way as the two chained cutadapt commands"""
+
+    def __init__(self, adapters, left_cut, right_cut,
+                 quality_threshold=QUALITY_THRESHOLD, length_threshold=LENGTH_THRESHOLD):
+        self.adapters = make_adapters_from_specifications(adapters, SEARCH_PARAMETERS)
+        self.adapter_cutter = AdapterCutter(self.adapters, times=1)
+        # cutadapt apply -u before quality trimming
+        self.cutters = [UnconditionalCutter(length) for length in [left_cut, -right_cut] if length != 0]
+        self.quality_trimmer = QualityTrimmer(0, quality_threshold, 33)
+        self.length_threshold = length_threshold
+
+    def trim(self, read, stats):
+        """Return the trimmed read, or None if the read is too short after trimming"""
+        stats.in_reads += 1
+        stats.in_bp += len(read)
+
+        info = ModificationInfo(read)
+        read = self.adapter_cutter(read, info)
+        if info.matches:
+            stats.with_adapters += 1
+            for match in info.matches:
+                stats.adapter_counts[match.adapter.name] += 1
+        stats.adapter_bp += len(read)
+
+        info = ModificationInfo(read)
+        for cutter in self.cutters:
+            read = cutter(read, info)
+        length = len(read)
+        read = self.quality_trimmer(read, info)
+        stats.qualtrim_bp += length - len(read)
+
+        if len(read) < self.length_threshold:
+            stats.too_short += 1
+            return None
+        stats.out_reads += 1
+        stats.out_bp += len(read)
+        return read
+
+
+def trim_fastq(input_path, output_path, stats_path, adapter, read_type='R1', left_cut=10, right_cut=10,
+               mode='mc', quality_threshold=QUALITY_THRESHOLD, length_threshold=LENGTH_THRESHOLD,
+               compress_level=1, compress_threads=1):
+    """
+    Trim one cell FASTQ file in a single pass, replacing the two chained cutadapt commands of the trim rules.
+
+    Parameters
+    ----------
+    input_path
+        Input FASTQ path
+    output_path
+        Output trimmed FASTQ path, written in BGZF format
+    stats_path
+        Output trim stats path, in the layout of the cutadapt reports of the trim rules
+    adapter
+        3' adapter sequence
+    read_type
+        R1 or R2, only used in the adapter name of the mct stats
+    left_cut
+        Number of bases removed from the 5' end after adapter trimming
+    right_cut
+        Number of bases removed from the 3' end after adapter trimming
+    mode
+        if mode is mct, also trim the mct adapters and write the stats in the mct layout
+    quality_threshold
+        3' quality trimming threshold
+    length_threshold
+        Reads shorter than this after trimming are discarded
+    compress_level
+        zlib compress level of the output BGZF blocks
+    compress_threads
+        Number of threads compressing the output BGZF blocks
+
+    Returns
+    -------
+    TrimStats of the file
+    """
+    trimmer = ReadTrimmer(get_adapter_specifications(read_type, adapter, mode),
+                          left_cut=left_cut,
+                          right_cut=right_cut,
+                          quality_threshold=quality_threshold,
+                          length_threshold=length_threshold)
+    stats = TrimStats()
+    compressor = BgzfCompressor(compress_level=compress_level, threads=compress_threads)
+    try:
+        with dnaio.open(input_path, mode='r') as reader, open(output_path, 'wb') as out:
+            buffer = bytearray()
+            for read in reader:
+                read = trimmer.trim(read, stats)
+                if read is None:
+                    continue
+                buffer += read.fastq_bytes()
+                if len(buffer) > _WRITE_BUFFER_SIZE:
+                    out.write(compressor.compress(buffer))
+                    buffer = bytearray()
+            if buffer:
+                out.write(compressor.compress(buffer))
+            out.write(BGZF_EOF)
+    finally:
+        compressor.close()
+    stats.write(stats_path, adapters=trimmer.adapters if mode == 'mct' else None)
+    return stats
@@ -0,0 +1,156 @@
+"""
+Filesystem-aware I/O slots for snakemake
+
+Demultiplex and lane merge jobs are mostly I/O bound, on network or parallel filesystems (Lustre, NFS, GPFS...)
+too many concurrent readers and writers saturate the storage servers while the CPUs wait.
+Here every filesystem mount touched by a job becomes a snakemake custom resource (e.g. io_scratch),
+each job consume 1 unit of the resource for every mount it reads or writes,
+and the snakemake run is limited by --resources io_scratch=N, separately from the --cores limit.
+
+The number of slots per mount is
+1. an integer from the config file; or
+2. "default": DEFAULT_NETWORK_FS_SLOTS for network or parallel filesystems, cpu for local filesystems; or
+3. "measure": measured by writing test files with increasing number of concurrent writers,
+   until the total write throughput stop increasing.
+   Only mounts that contain the output_dir can be measured, other mounts use the default.
+"""
+
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+NETWORK_FS_TYPES = {'lustre', 'nfs', 'nfs4', 'gpfs', 'beegfs', 'cifs', 'smb3', 'ceph', 'fuse.ceph',
+                    'glusterfs', 'fuse.glusterfs', 'panfs', 'wekafs', 'fuse.sshfs'}
+DEFAULT_NETWORK_FS_SLOTS = 16
+
+
+def _read_mounts():
+    """List of (mount_point, fstype) in /proc/mounts"""
+    mounts = []
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # space and other special chars are octal escaped in /proc/mounts
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                mounts.append((mount_point, fields[2]))
+    except OSError:
+        pass
+    return mounts
+
+
+def get_mount(path, mounts=None):
+    """Return (mount_point, fstype) of the mount that contains path"""
+    if mounts is None:
+        mounts = _read_mounts()
+    path = os.path.realpath(path)
+    best = ('/', 'unknown')
+    for mount_point, fstype in mounts:
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            if len(mount_point) >= len(best[0]):
+                best = (mount_point, fstype)
+    return best
+
+
+def _write_test_file(directory, size):
+    data = os.urandom(1048576)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.io_test_') as f:
+        for _ in range(size // len(data)):
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return
+
+
+def measure_io_slots(directory, max_slots=32, size=8388608, min_gain=1.1):
+    """
+    Find the number of concurrent writers that maximize the total write throughput of directory.
+    Concurrent writers are doubled until the throughput gain is less than min_gain.
+    """
+    best_slots = 1
+    best_throughput = 0
+    n_writers = 1
+    while n_writers <= max_slots:
+        start = time.time()
+        with ThreadPoolExecutor(n_writers) as exe:
+            list(exe.map(lambda _: _write_test_file(directory, size), range(n_writers)))
+        throughput = n_writers * size / max(time.time() - start, 1e-6)
+        log.info(f'{n_writers} concurrent writers in {directory}: {throughput / 1048576:.1f} MB/s')
+        if throughput < best_throughput * min_gain:
+            break
+        best_slots = n_writers
+        best_throughput = throughput
+        n_writers *= 2
+    return best_slots
+
+
+class MountIOResources:
+    """
+    Map paths to per-mount snakemake resources
+
+    Parameters
+    ----------
+    slots
+        Slots per mount, an integer, "default" or "measure", see module doc
+    cpu
+        Total cores of the snakemake run, used as slots of local filesystems
+    measure_dirs
+        Directories that can be used to measure write throughput, e.g. the output_dir
+    """
+
+    def __init__(self, slots='default', cpu=1, measure_dirs=None):
+        self.slots = str(slots).strip().lower()
+        if self.slots not in ('default', 'measure') and not self.slots.isdigit():
+            raise ValueError(f'io_slots_per_mount need to be an integer, "default" or "measure", got {slots}')
+        self.cpu = cpu
+        self.measure_dirs = [pathlib.Path(p) for p in measure_dirs] if measure_dirs is not None else []
+        self._system_mounts = _read_mounts()
+        self._names = {}
+        self._resources = {}
+
+    def _mount_slots(self, mount_point, fstype):
+        if self.slots.isdigit():
+            return max(1, int(self.slots))
+        if self.slots == 'measure':
+            for directory in self.measure_dirs:
+                if get_mount(directory, self._system_mounts)[0] == mount_point:
+                    return measure_io_slots(directory, max_slots=max(1, self.cpu))
+        if fstype in NETWORK_FS_TYPES:
+            return min(self.cpu, DEFAULT_NETWORK_FS_SLOTS)
+        return self.cpu
+
+    def resource_name(self, path):
+        """Name of the resource of the mount that contains path"""
+        mount_point, fstype = get_mount(path, self._system_mounts)
+        try:
+            return self._names[mount_point]
+        except KeyError:
+            pass
+        name = 'io_' + (re.sub(r'\W+', '_', mount_point).strip('_') or 'root')
+        if name in self._resources:
+            name = f'{name}_{len(self._resources)}'
+        slots = self._mount_slots(mount_point, fstype)
+        print(f'Filesystem {mount_point} ({fstype}): {slots} concurrent I/O jobs')
+        self._names[mount_point] = name
+        self._resources[name] = slots
+        return name
+
+    def rule_resources(self, paths):
+        """snakemake resources string of a rule that read or write paths"""
+        names = sorted({self.resource_name(path) for path in paths})
+        return ', '.join(f'{name}=1' for name in names)
+
+    @property
+    def resources(self):
+        """Total resources of all the mounts, for snakemake --resources"""
+        return dict(self._resources)
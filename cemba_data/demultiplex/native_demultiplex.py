@@ -0,0 +1,440 @@
+"""
+Native random index demultiplexer
+
+The random index is a fixed length prefix of R1 (cutadapt adapter "^INDEX"),
+so instead of aligning every R1 against all the index sequences,
+we look up the R1 prefix in a precomputed table that contains every index sequence
+and its tolerated-mismatch neighbours.
+"""
+
+import io
+import itertools
+import logging
+import multiprocessing
+import pathlib
+import queue
+import shutil
+from collections import Counter
+
+import dnaio
+from xopen import xopen
+
+from .bgzf import BGZF_EOF
+from .demultiplex_stats import write_demultiplex_counts
+from .fused_trim import ReadTrimmer, TrimStats, get_trim_parameters
+from .read_qc import CellReadQC
+from .writer_pool import FastqWriterPool, default_max_open
+from ..utilities import parse_index_fasta
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+BASES = 'ACGTN'
+
+
+def _mismatch_neighbours(seq, max_mismatch):
+    """All sequences within max_mismatch substitutions of seq, including seq itself"""
+    neighbours = {seq}
+    for n_mismatch in range(1, max_mismatch + 1):
+        for positions in itertools.combinations(range(len(seq)), n_mismatch):
+            choices = [[b for b in BASES if b != seq[pos]] for pos in positions]
+            for bases in itertools.product(*choices):
+                neighbour = list(seq)
+                for pos, base in zip(positions, bases):
+                    neighbour[pos] = base
+                neighbours.add(''.join(neighbour))
+    return neighbours
+
+
+def make_index_table(index_fasta_path, max_mismatch=0):
+    """
+    Make the prefix to index name lookup table of one random index fasta file.
+
+    Neighbour sequences shared by more than one index are ambiguous and removed from the table,
+    so a read is never assigned to an index it can not be distinguished from.
+
+    Parameters
+    ----------
+    index_fasta_path
+        Random index fasta file, the same file used by cutadapt -g file:index_fasta_path
+    max_mismatch
+        Max number of mismatches tolerated in the index sequence.
+        The cutadapt command we used before (-e 0.01 --no-indels) is equal to max_mismatch=0.
+
+    Returns
+    -------
+    lookup table of {prefix_sequence: index_name}, length of the index sequence
+    """
+    index_seq_dict = parse_index_fasta(index_fasta_path)
+    index_lengths = {len(seq) for seq in index_seq_dict.values()}
+    if len(index_lengths) != 1:
+        raise ValueError(f'Index sequences in {index_fasta_path} have different length {index_lengths}, '
+                         f'native demultiplex only support fixed length random index.')
+    index_length = index_lengths.pop()
+
+    table = {}
+    ambiguous = set()
+    for name, seq in index_seq_dict.items():
+        for neighbour in _mismatch_neighbours(seq.upper(), max_mismatch):
+            if neighbour in table and table[neighbour] != name:
+                ambiguous.add(neighbour)
+            else:
+                table[neighbour] = name
+
+    for name, seq in index_seq_dict.items():
+        if seq.upper() in ambiguous:
+            raise ValueError(f'Index {name} ({seq}) can not be distinguished from other indexes '
+                             f'in {index_fasta_path} with max_mismatch={max_mismatch}.')
+    for seq in ambiguous:
+        del table[seq]
+    if len(ambiguous) > 0:
+        log.info(f'{len(ambiguous)} ambiguous neighbour sequences removed from the index table.')
+    return table, index_length
+
+
+def _write_demultiplex_report(stats_path, index_seq_dict, index_counts, total_pairs):
+    """Write a report that can be parsed the same way as the cutadapt demultiplex report"""
+    with open(stats_path, 'w') as f:
+        f.write('This is a cutadapt compatible report generated by yap native demultiplex.\n\n')
+        f.write(f'Total read pairs processed: {total_pairs:,}\n')
+        f.write(f'  Read 1 with adapter: {sum(index_counts.values()):,}\n\n')
+        for name, seq in index_seq_dict.items():
+            f.write(f'\n=== First read: Adapter {name} ===\n\n')
+            f.write(f"Sequence: {seq}; Type: anchored 5'; Length: {len(seq)}; "
+                    f"Trimmed: {index_counts[name]} times\n")
+    return
+
+
+class _ChunkDemultiplexer:
+    """
+    Demultiplex record-aligned chunks of R1 R2 FASTQ,
+    append reads of each index to {output_prefix}-{index_name}-R1/2{part_suffix}.fq.gz,
+    or {output_prefix}-{index_name}-R1/2.trimmed{part_suffix}.fq.gz if trim_parameters is provided
+    """
+
+    def __init__(self, table, index_length, output_prefix, n_lanes, compress_level=1, compress_threads=1,
+                 part_suffix='', max_open=128, discard_index=None, read_qc=False, trim_parameters=None):
+        self.table = table
+        self.discard_index = frozenset(discard_index) if discard_index is not None else frozenset()
+        self.index_length = index_length
+        self.output_prefix = output_prefix
+        self.part_suffix = part_suffix
+        self.lane_counts = [Counter() for _ in range(n_lanes)]
+        self.lane_total_pairs = [0 for _ in range(n_lanes)]
+        self.index_names = set()
+        self.read_qc = CellReadQC() if read_qc else None
+        if trim_parameters is not None:
+            self.trimmers = {read_type: ReadTrimmer(**parameters)
+                             for read_type, parameters in trim_parameters.items()}
+            self.fastq_suffix = '.trimmed'
+        else:
+            self.trimmers = None
+            self.fastq_suffix = ''
+        # {index_name: {read_type: TrimStats}}
+        self.trim_stats = {}
+        # part files are concatenated later, only the final file get the EOF block
+        self.writer_pool = FastqWriterPool(max_open=max_open,
+                                           compress_level=compress_level,
+                                           compress_threads=compress_threads,
+                                           write_eof=part_suffix == '')
+
+    def _write(self, index_name, read_type, data):
+        # only create files for indexes that actually have reads, same as cutadapt
+        path = f'{self.output_prefix}-{index_name}-{read_type}{self.fastq_suffix}{self.part_suffix}.fq.gz'
+        self.writer_pool.write(path, data)
+        return
+
+    def process(self, lane_id, r1_chunk, r2_chunk):
+        table = self.table
+        index_length = self.index_length
+        counts = self.lane_counts[lane_id]
+        discard_index = self.discard_index
+        read_qc = self.read_qc
+        trimmers = self.trimmers
+        total_pairs = 0
+        buffers = {}
+        r1_reader = dnaio.FastqReader(io.BytesIO(r1_chunk))
+        r2_reader = dnaio.FastqReader(io.BytesIO(r2_chunk))
+        for r1, r2 in zip(r1_reader, r2_reader):
+            # R1 R2 are read by two readers, check the pairing as the dnaio paired reader (names up to the first space)
+            if not r1.is_mate(r2):
+                raise ValueError(f'Reads are improperly paired, R1 name {r1.name} and R2 name {r2.name} '
+                                 f'do not match, R1 and R2 FASTQ must have the same reads in the same order.')
+            total_pairs += 1
+            index_name = table.get(r1.sequence[:index_length])
+            if index_name is None:
+                continue
+            counts[index_name] += 1
+            if index_name in discard_index:
+                # only counted, the reads are not written
+                continue
+            try:
+                r1_buffer, r2_buffer = buffers[index_name]
+            except KeyError:
+                r1_buffer, r2_buffer = buffers[index_name] = (bytearray(), bytearray())
+            r1 = r1[index_length:]
+            if read_qc is not None:
+                read_qc.add(index_name, r1, r2)
+            if trimmers is not None:
+                try:
+                    trim_stats = self.trim_stats[index_name]
+                except KeyError:
+                    trim_stats = self.trim_stats[index_name] = {'R1': TrimStats(), 'R2': TrimStats()}
+                # R1 and R2 are mapped separately, so they are filtered separately, same as the trim rules
+                r1 = trimmers['R1'].trim(r1, trim_stats['R1'])
+                r2 = trimmers['R2'].trim(r2, trim_stats['R2'])
+            if r1 is not None:
+                r1_buffer += r1.fastq_bytes()
+            if r2 is not None:
+                r2_buffer += r2.fastq_bytes()
+        self.lane_total_pairs[lane_id] += total_pairs
+        if read_qc is not None:
+            read_qc.flush()
+
+        for index_name, (r1_buffer, r2_buffer) in buffers.items():
+            self._write(index_name, 'R1', r1_buffer)
+            self._write(index_name, 'R2', r2_buffer)
+            self.index_names.add(index_name)
+        return
+
+    def close(self):
+        self.writer_pool.close()
+        return self.lane_counts, self.lane_total_pairs, self.index_names, self.read_qc, self.trim_stats
+
+
+def _iter_chunks(r1_paths, r2_paths, chunk_size):
+    """Yield (lane_id, r1_chunk, r2_chunk), chunks of R1 R2 always contain the same reads"""
+    for lane_id, (r1_path, r2_path) in enumerate(zip(r1_paths, r2_paths)):
+        with xopen(r1_path, 'rb') as r1_f, xopen(r2_path, 'rb') as r2_f:
+            for r1_chunk, r2_chunk in dnaio.read_paired_chunks(r1_f, r2_f, buffer_size=chunk_size):
+                # the memoryview is only valid in one iteration
+                yield lane_id, bytes(r1_chunk), bytes(r2_chunk)
+
+
+def _demultiplex_worker(worker_id, task_queue, result_queue, demultiplexer_kws):
+    try:
+        demultiplexer = _ChunkDemultiplexer(**demultiplexer_kws, part_suffix=f'.part{worker_id}')
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            demultiplexer.process(*task)
+        result_queue.put((worker_id, demultiplexer.close()))
+    except BaseException as e:
+        result_queue.put((worker_id, e))
+        raise
+    return
+
+
+def _parallel_demultiplex(r1_paths, r2_paths, chunk_size, cpu, demultiplexer_kws):
+    """
+    Split R1 R2 into record-aligned chunks and demultiplex them with a pool of worker processes.
+    Each worker writes its own part files, the parts of each cell are then combined by BGZF block concatenation.
+    """
+    # bounded queue, so the reader never holds more than 2 chunks per worker in memory
+    task_queue = multiprocessing.Queue(maxsize=cpu * 2)
+    result_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_demultiplex_worker,
+                                       args=(worker_id, task_queue, result_queue, demultiplexer_kws))
+               for worker_id in range(cpu)]
+    for worker in workers:
+        worker.start()
+
+    def _put(item):
+        while True:
+            try:
+                task_queue.put(item, timeout=10)
+                return
+            except queue.Full:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError('Demultiplex worker process exited unexpectedly.')
+
+    try:
+        for task in _iter_chunks(r1_paths, r2_paths, chunk_size):
+            _put(task)
+        for _ in workers:
+            _put(None)
+
+        results = {}
+        while len(results) < cpu:
+            try:
+                worker_id, result = result_queue.get(timeout=10)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError('Demultiplex worker process exited unexpectedly.')
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            results[worker_id] = result
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    n_lanes = len(r1_paths)
+    lane_counts = [Counter() for _ in range(n_lanes)]
+    lane_total_pairs = [0 for _ in range(n_lanes)]
+    index_names = set()
+    read_qc = None
+    trim_stats = {}
+    for worker_id in range(cpu):
+        _lane_counts, _lane_total_pairs, _index_names, _read_qc, _trim_stats = results[worker_id]
+        for lane_id in range(n_lanes):
+            lane_counts[lane_id] += _lane_counts[lane_id]
+            lane_total_pairs[lane_id] += _lane_total_pairs[lane_id]
+        index_names |= _index_names
+        if _read_qc is not None:
+            if read_qc is None:
+                read_qc = _read_qc
+            else:
+                read_qc.merge(_read_qc)
+        for index_name, read_type_stats in _trim_stats.items():
+            if index_name not in trim_stats:
+                trim_stats[index_name] = read_type_stats
+            else:
+                for read_type, stats in read_type_stats.items():
+                    trim_stats[index_name][read_type] += stats
+
+    # concatenating BGZF blocks is still a valid BGZF file
+    output_prefix = demultiplexer_kws['output_prefix']
+    fastq_suffix = '.trimmed' if demultiplexer_kws.get('trim_parameters') is not None else ''
+    for index_name in index_names:
+        for read_type in ['R1', 'R2']:
+            output_path = f'{output_prefix}-{index_name}-{read_type}{fastq_suffix}.fq.gz'
+            with open(output_path, 'wb') as out_f:
+                for worker_id in range(cpu):
+                    part_path = pathlib.Path(
+                        f'{output_prefix}-{index_name}-{read_type}{fastq_suffix}.part{worker_id}.fq.gz')
+                    if not part_path.exists():
+                        continue
+                    with open(part_path, 'rb') as part_f:
+                        shutil.copyfileobj(part_f, out_f)
+                    part_path.unlink()
+                out_f.write(BGZF_EOF)
+    return lane_counts, lane_total_pairs, read_qc, trim_stats
+
+
+def _write_trim_stats(output_prefix, mode, trim_parameters, trim_stats):
+    """Write trim stats of each cell, cells without any read left after trimming get an empty FASTQ"""
+    # same stats file name as the trim rules
+    stats_suffix = 'txt' if mode == 'mct' else 'tsv'
+    for read_type, parameters in trim_parameters.items():
+        # the full adapter report is only used by mct
+        adapters = ReadTrimmer(**parameters).adapters if mode == 'mct' else None
+        for index_name, read_type_stats in trim_stats.items():
+            read_type_stats[read_type].write(
+                f'{output_prefix}-{index_name}-{read_type}.trimmed.stats.{stats_suffix}', adapters=adapters)
+            fastq_path = pathlib.Path(f'{output_prefix}-{index_name}-{read_type}.trimmed.fq.gz')
+            if not fastq_path.exists():
+                with open(fastq_path, 'wb') as f:
+                    f.write(BGZF_EOF)
+    return
+
+
+def demultiplex_fastq_pair(r1_path, r2_path, index_fasta_path, output_prefix, stats_path, counts_path=None,
+                           max_mismatch=0, compress_level=1, compress_threads=1, cpu=1, chunk_size=4194304,
+                           max_open_files=None, discard_index=None, qc_path=None, trim_config=None):
+    """
+    Demultiplex R1 R2 FASTQ file pairs by the random index at the start of R1.
+
+    Reads are written to {output_prefix}-{index_name}-R1/2.fq.gz in BGZF format,
+    the index sequence is removed from R1.
+    Reads without a valid index are only counted.
+    If multiple pairs are provided (e.g. all lanes of one UID), reads of all pairs are written
+    into the same cell FASTQ files, and one stats file is written for each pair.
+
+    Parameters
+    ----------
+    r1_path
+        One R1 path or a list of R1 paths
+    r2_path
+        One R2 path or a list of R2 paths, in the same order as r1_path
+    index_fasta_path
+    output_prefix
+    stats_path
+        One stats path or a list of stats paths, in the same order as r1_path
+    counts_path
+        One counts path or a list of counts paths, in the same order as r1_path,
+        see demultiplex_stats.py for the format
+    max_mismatch
+    compress_level
+        gzip compress level of the output FASTQ files
+    compress_threads
+        Number of threads compressing the output BGZF blocks in each process
+    cpu
+        If cpu > 1, the input files are split into record-aligned chunks and demultiplexed in parallel
+    chunk_size
+        Max size (bytes of uncompressed FASTQ) of each chunk
+    max_open_files
+        Max number of output files each process keep open at the same time,
+        if None, determined by the open file limit (ulimit -n) and cpu
+    discard_index
+        Index names whose reads are only counted but not written, e.g. cells predicted
+        to have too less reads by the pre-scan (see prescan.py)
+    qc_path
+        If provided, per-cell read length, mean quality, adapter and N base QC of the written reads
+        are saved into this .npz file, see read_qc.py for the format
+    trim_config
+        If provided, reads are also trimmed with the parameters in this mapping config file,
+        the same way as the trim rules of the mapping Snakefile,
+        and written to {output_prefix}-{index_name}-R1/2.trimmed.fq.gz with their trim stats files,
+        see fused_trim.py
+
+    Returns
+    -------
+
+    """
+    if isinstance(r1_path, (str, pathlib.Path)):
+        r1_path, r2_path, stats_path = [r1_path], [r2_path], [stats_path]
+    if isinstance(counts_path, (str, pathlib.Path)):
+        counts_path = [counts_path]
+    if not (len(r1_path) == len(r2_path) == len(stats_path)):
+        raise ValueError('r1_path, r2_path and stats_path must have the same length.')
+    if counts_path is not None and len(counts_path) != len(r1_path):
+        raise ValueError('r1_path and counts_path must have the same length.')
+
+    max_mismatch = int(max_mismatch)
+    cpu = int(cpu)
+    table, index_length = make_index_table(index_fasta_path, max_mismatch=max_mismatch)
+    index_seq_dict = parse_index_fasta(index_fasta_path)
+    if max_open_files is None:
+        max_open_files = default_max_open(n_process=cpu)
+    demultiplexer_kws = dict(table=table,
+                             index_length=index_length,
+                             output_prefix=output_prefix,
+                             n_lanes=len(r1_path),
+                             compress_level=int(compress_level),
+                             compress_threads=int(compress_threads),
+                             max_open=max_open_files,
+                             discard_index=discard_index,
+                             read_qc=qc_path is not None)
+    if trim_config is not None:
+        mode, trim_parameters = get_trim_parameters(trim_config)
+        demultiplexer_kws['trim_parameters'] = trim_parameters
+
+    if cpu > 1:
+        lane_counts, lane_total_pairs, read_qc, trim_stats = _parallel_demultiplex(
+            r1_path, r2_path, chunk_size=chunk_size, cpu=cpu, demultiplexer_kws=demultiplexer_kws)
+    else:
+        demultiplexer = _ChunkDemultiplexer(**demultiplexer_kws)
+        try:
+            for task in _iter_chunks(r1_path, r2_path, chunk_size):
+                demultiplexer.process(*task)
+        finally:
+            lane_counts, lane_total_pairs, _, read_qc, trim_stats = demultiplexer.close()
+
+    for _stats_path, index_counts, total_pairs in zip(stats_path, lane_counts, lane_total_pairs):
+        _write_demultiplex_report(_stats_path, index_seq_dict, index_counts, total_pairs)
+    if counts_path is not None:
+        for _counts_path, index_counts, total_pairs in zip(counts_path, lane_counts, lane_total_pairs):
+            write_demultiplex_counts(_counts_path,
+                                     index_names=list(index_seq_dict.keys()),
+                                     index_counts=index_counts,
+                                     total_pairs=total_pairs)
+    if qc_path is not None:
+        read_qc.save(qc_path)
+    if trim_config is not None:
+        _write_trim_stats(output_prefix, mode, trim_parameters, trim_stats)
+    return
@@ -0,0 +1,171 @@
+"""
+Sampling based pre-scan of raw FASTQ files
+
+Before the full demultiplex, read the first n_pairs R1 reads of each lane file and count the random index,
+then extrapolate the per-cell read pairs with the estimated total read pairs of the lane file.
+The total read pairs is estimated by the compressed bytes consumed by the sampled reads
+relative to the compressed file size, so only a small part of each file is read.
+
+The prediction is used to
+1. write a predicted stats/UIDTotalCellInputReadPairs.csv, so scheduling can start from estimated workloads;
+2. find hopeless cells whose read pairs will be below total_read_pairs_min even at the upper bound
+   of the prediction, the native demultiplexer discard their reads instead of writing them.
+
+The sampled reads are the first reads of each file (i.e. the first tiles), not a random sample,
+and the estimated total read pairs has its own error, so the upper bound is widened by ESTIMATE_MARGIN.
+Discarded reads can not be recovered, if a discarded cell still turns out to have enough read pairs,
+its UID is demultiplexed again without discarding, see demultiplex._check_prescan_discard.
+"""
+
+import gzip
+import itertools
+import logging
+import pathlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dnaio
+import numpy as np
+import pandas as pd
+
+from .native_demultiplex import make_index_table
+from ..utilities import parse_index_fasta
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# the extrapolated read pairs are multiplied (upper bound) or divided (lower bound) by this margin,
+# which covers the error of the estimated total and the difference between the first tiles and the whole file
+ESTIMATE_MARGIN = 2.0
+
+
+def prescan_fastq(r1_path, index_fasta_path, n_pairs=100000, max_mismatch=0):
+    """
+    Count the random index of the first n_pairs reads in one R1 FASTQ file,
+    with the same max_mismatch as the demultiplex.
+
+    Returns
+    -------
+    Counter of {index_name: sampled read pairs}, number of sampled read pairs,
+    estimated total read pairs of the file
+    """
+    table, index_length = make_index_table(index_fasta_path, max_mismatch=max_mismatch)
+    file_size = pathlib.Path(r1_path).stat().st_size
+    counts = Counter()
+    with open(r1_path, 'rb') as raw_f:
+        with gzip.GzipFile(fileobj=raw_f) as f:
+            reader = dnaio.FastqReader(f)
+            sampled = 0
+            for read in itertools.islice(reader, n_pairs):
+                sampled += 1
+                index_name = table.get(read.sequence[:index_length])
+                if index_name is not None:
+                    counts[index_name] += 1
+            if sampled < n_pairs:
+                # the whole file is read
+                estimated_total = sampled
+            else:
+                # compressed bytes consumed, slightly over-estimated due to read buffers
+                consumed = max(1, raw_f.tell())
+                estimated_total = int(sampled * max(1.0, file_size / consumed))
+    return counts, sampled, estimated_total
+
+
+def _predict_uid(uid, lane_results, index_names):
+    """Combine lane results of one UID into per-cell prediction"""
+    records = []
+    for index_name in index_names:
+        predicted = 0.
+        upper = 0.
+        lower = 0.
+        for counts, sampled, estimated_total in lane_results:
+            if sampled == 0:
+                continue
+            scale = estimated_total / sampled
+            # the whole file is read if nothing is extrapolated
+            margin = ESTIMATE_MARGIN if estimated_total > sampled else 1.
+            k = counts.get(index_name, 0)
+            # ~3 sigma poisson bounds of the sampled count, k + 3 is used as upper bound when k is 0
+            predicted += k * scale
+            upper += (k + 3 * np.sqrt(k) + 3) * scale * margin
+            lower += max(0., k - 3 * np.sqrt(k)) * scale / margin
+        records.append([f'{uid}-{index_name}', uid, index_name,
+                        int(predicted), int(upper), int(lower)])
+    return records
+
+
+def prescan_demultiplex(fastq_df, index_fasta_paths, output_dir, total_read_pairs_min,
+                        total_read_pairs_max, n_pairs=100000, max_mismatch=0, cpu=1):
+    """
+    Pre-scan all the R1 files in the fastq dataframe and predict cell read pairs.
+
+    Parameters
+    ----------
+    fastq_df
+        FASTQ dataframe made by make_fastq_dataframe
+    index_fasta_paths
+        Dict of {uid: random index fasta path}
+    output_dir
+        demultiplex output_dir, prediction is saved in output_dir/stats
+    total_read_pairs_min
+    total_read_pairs_max
+    n_pairs
+        Number of read pairs sampled from each lane file
+    max_mismatch
+        Max number of mismatches in random index, same as the demultiplex
+    cpu
+
+    Returns
+    -------
+    Dict of {uid: list of index names that can be discarded}, Series of predicted UID total read pairs
+    """
+    output_dir = pathlib.Path(output_dir)
+    r1_df = fastq_df[fastq_df['read_type'] == 'R1']
+
+    uid_results = {uid: [] for uid in r1_df['uid'].unique()}
+    with ProcessPoolExecutor(cpu) as exe:
+        futures = {}
+        for _, row in r1_df.iterrows():
+            future = exe.submit(prescan_fastq,
+                                r1_path=row['fastq_path'],
+                                index_fasta_path=index_fasta_paths[row['uid']],
+                                n_pairs=n_pairs,
+                                max_mismatch=max_mismatch)
+            futures[future] = row['uid']
+        for future in as_completed(futures):
+            uid_results[futures[future]].append(future.result())
+
+    records = []
+    for uid, lane_results in uid_results.items():
+        index_names = list(parse_index_fasta(index_fasta_paths[uid]).keys())
+        records += _predict_uid(uid, lane_results, index_names)
+    cell_table = pd.DataFrame(records, columns=['cell_id', 'UID', 'IndexName', 'PredictedCellInputReadPairs',
+                                                'PredictedUpper', 'PredictedLower']).set_index('cell_id')
+    cell_table['Discard'] = cell_table['PredictedUpper'] < total_read_pairs_min
+    cell_table['PredictedTooLarge'] = cell_table['PredictedLower'] > total_read_pairs_max
+    cell_table.to_csv(output_dir / 'stats/prescan.stats.csv')
+
+    print(f'Pre-scan predicts {cell_table["Discard"].sum()} cells with too less input read pairs '
+          f'(< {total_read_pairs_min}), reads of these cells will be discarded during demultiplex')
+    print(f'Pre-scan predicts {cell_table["PredictedTooLarge"].sum()} cells with too large input read pairs '
+          f'(> {total_read_pairs_max})')
+
+    discard_index, uid_order = _prescan_results(cell_table)
+    # predicted UID total input reads, for command order, will be overwritten after demultiplex
+    uid_order.to_csv(output_dir / 'stats/UIDTotalCellInputReadPairs.csv', header=False)
+    return discard_index, uid_order
+
+
+def _prescan_results(cell_table):
+    judge = cell_table['Discard'] | cell_table['PredictedTooLarge']
+    uid_order = cell_table[~judge].groupby('UID')['PredictedCellInputReadPairs'].sum().sort_values(
+        ascending=False)
+    discard_index = cell_table[cell_table['Discard']].groupby('UID')['IndexName'].apply(list).to_dict()
+    return discard_index, uid_order
+
+
+def load_prescan(output_dir):
+    """Load the results of a finished prescan_demultiplex in output_dir, the return values are the same"""
+    cell_table = pd.read_csv(pathlib.Path(output_dir) / 'stats/prescan.stats.csv', index_col=0)
+    return _prescan_results(cell_table)
@@ -0,0 +1,171 @@
+"""
+Per-cell read QC histograms collected during native demultiplex
+
+For each cell and read type (R1 after removing the random index, R2), keep fixed size histograms of
+1. read length, bin i is length i, the last bin contain all reads longer than MAX_LENGTH;
+2. mean base quality (phred, floored), the last bin contain all reads with mean quality >= MAX_QUALITY;
+and counts of reads containing the adapter prefix and total N bases.
+
+The histograms of all cells are saved together as a columnar numpy .npz file,
+each key is one column (cell_id, R1LengthHist, R1MeanQualityHist, R1WithAdapter, R1NBases, ...),
+row i of every column belong to cell_id[i].
+"""
+
+import pathlib
+
+import numpy as np
+
+MAX_LENGTH = 300
+MAX_QUALITY = 45
+QUALITY_OFFSET = 33
+# prefix shared by the illumina universal adapters of R1 and R2
+ADAPTER_PREFIX = 'AGATCGGAAGAGC'
+
+READ_TYPES = ['R1', 'R2']
+HIST_COLUMNS = ['LengthHist', 'MeanQualityHist']
+COUNT_COLUMNS = ['WithAdapter', 'NBases']
+
+
+def _empty_cell_qc():
+    qc = {}
+    for read_type in READ_TYPES:
+        qc[f'{read_type}LengthHist'] = np.zeros(MAX_LENGTH + 1, dtype=np.int64)
+        qc[f'{read_type}MeanQualityHist'] = np.zeros(MAX_QUALITY + 1, dtype=np.int64)
+        qc[f'{read_type}WithAdapter'] = 0
+        qc[f'{read_type}NBases'] = 0
+    return qc
+
+
+class CellReadQC:
+    """
+    Collect read QC of many cells.
+    Reads are first saved as small python lists, and added to the histograms by np.bincount in flush(),
+    so the per-read cost is only a few builtin calls.
+    """
+
+    def __init__(self, adapter=ADAPTER_PREFIX):
+        self.adapter = adapter
+        self.cell_qc = {}
+        # cell: [r1_lengths, r1_qual_sums, r2_lengths, r2_qual_sums]
+        self._pending = {}
+
+    def add(self, cell, r1, r2):
+        """Add one read pair (dnaio SequenceRecord) of cell"""
+        try:
+            pending = self._pending[cell]
+        except KeyError:
+            pending = self._pending[cell] = [[], [], [], []]
+            if cell not in self.cell_qc:
+                self.cell_qc[cell] = _empty_cell_qc()
+        qc = self.cell_qc[cell]
+        adapter = self.adapter
+
+        sequence = r1.sequence
+        pending[0].append(len(sequence))
+        pending[1].append(sum(r1.qualities.encode('ascii')))
+        qc['R1WithAdapter'] += adapter in sequence
+        qc['R1NBases'] += sequence.count('N')
+
+        sequence = r2.sequence
+        pending[2].append(len(sequence))
+        pending[3].append(sum(r2.qualities.encode('ascii')))
+        qc['R2WithAdapter'] += adapter in sequence
+        qc['R2NBases'] += sequence.count('N')
+        return
+
+    def flush(self):
+        for cell, pending in self._pending.items():
+            qc = self.cell_qc[cell]
+            for read_type, lengths, qual_sums in zip(READ_TYPES, pending[0::2], pending[1::2]):
+                lengths = np.array(lengths, dtype=np.int64)
+                qual_sums = np.array(qual_sums, dtype=np.int64)
+                mean_quality = qual_sums // np.maximum(lengths, 1) - QUALITY_OFFSET
+                mean_quality = np.clip(mean_quality, 0, MAX_QUALITY)
+                qc[f'{read_type}LengthHist'] += np.bincount(np.minimum(lengths, MAX_LENGTH),
+                                                            minlength=MAX_LENGTH + 1)
+                qc[f'{read_type}MeanQualityHist'] += np.bincount(mean_quality, minlength=MAX_QUALITY + 1)
+        self._pending = {}
+        return
+
+    def merge(self, other):
+        """Add the QC of another CellReadQC"""
+        self.flush()
+        other.flush()
+        for cell, other_qc in other.cell_qc.items():
+            if cell not in self.cell_qc:
+                self.cell_qc[cell] = _empty_cell_qc()
+            qc = self.cell_qc[cell]
+            for key, value in other_qc.items():
+                qc[key] += value
+        return
+
+    def to_columns(self):
+        """Columnar arrays of all cells"""
+        self.flush()
+        cells = sorted(self.cell_qc.keys())
+        columns = {'cell_id': np.array(cells, dtype=str)}
+        for read_type in READ_TYPES:
+            for column in HIST_COLUMNS + COUNT_COLUMNS:
+                key = f'{read_type}{column}'
+                columns[key] = np.array([self.cell_qc[cell][key] for cell in cells], dtype=np.int64)
+        return columns
+
+    def save(self, path):
+        save_read_qc_columns(path, self.to_columns())
+        return
+
+
+def save_read_qc_columns(path, columns):
+    # np.savez add .npz suffix if the path do not have it
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **columns)
+    return
+
+
+def load_read_qc_columns(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def concat_read_qc_columns(columns_list):
+    """Concatenate read QC columns, rows of the same cell_id are summed up"""
+    columns_list = [columns for columns in columns_list if columns['cell_id'].size > 0]
+    if len(columns_list) == 0:
+        return CellReadQC().to_columns()
+    cell_ids = np.concatenate([columns['cell_id'] for columns in columns_list])
+    unique_cells, inverse = np.unique(cell_ids, return_inverse=True)
+    total = {'cell_id': unique_cells}
+    for key in columns_list[0].keys():
+        if key == 'cell_id':
+            continue
+        values = np.concatenate([columns[key] for columns in columns_list])
+        summed = np.zeros((unique_cells.size, *values.shape[1:]), dtype=np.int64)
+        np.add.at(summed, inverse, values)
+        total[key] = summed
+    return total
+
+
+def summarize_read_qc(qc_paths, output_path, uids=None):
+    """
+    Sum up per job read QC files named as {uid}-{lane}.read_qc.npz into one file,
+    if uids is provided and output_path exists, only rows of these UIDs are replaced.
+    """
+    columns_list = []
+    for path in qc_paths:
+        path = pathlib.Path(path)
+        *uid, _ = path.name.split('-')
+        uid = '-'.join(uid)
+        columns = load_read_qc_columns(path)
+        # cell_id in job file is the index name
+        columns['cell_id'] = np.array([f'{uid}-{name}' for name in columns['cell_id']], dtype=str)
+        columns_list.append(columns)
+
+    output_path = pathlib.Path(output_path)
+    if uids is not None and output_path.exists():
+        exist_columns = load_read_qc_columns(output_path)
+        cell_uids = np.array(['-'.join(cell.split('-')[:-1]) for cell in exist_columns['cell_id']], dtype=str)
+        keep = ~np.isin(cell_uids, list(uids))
+        columns_list.append({key: value[keep] for key, value in exist_columns.items()})
+
+    save_read_qc_columns(output_path, concat_read_qc_columns(columns_list))
+    return
@@ -0,0 +1,72 @@
+"""
+Demultiplex the FASTQ files of a top-up sequencing run into an existing demultiplex output_dir
+
+The new reads are demultiplexed into output_dir/topup/{topup_name}, which is a normal demultiplex output_dir
+using the mapping config of output_dir, so only the new reads are mapped by its own snakemake commands.
+After the mapping finished, 'yap topup-merge' merge the results into the existing per-cell results,
+see cemba_data.mapping.topup.
+"""
+
+import logging
+import pathlib
+import re
+
+import pandas as pd
+
+from .demultiplex import demultiplex_pipeline
+from ..mapping.topup import get_topup_dir, TOPUP_RECORD
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _next_topup_name(output_dir):
+    """Topup{N + 1}, N is the largest number of the top-up dirs and the merged top-up runs"""
+    names = [path.name for path in (output_dir / 'topup').glob('Topup*')]
+    record_path = output_dir / TOPUP_RECORD
+    if record_path.exists():
+        # merged top-up dirs may be deleted already
+        with open(record_path) as f:
+            names += f.read().split()
+    numbers = [int(match.group(1)) for match in map(re.compile(r'Topup(\d+)$').match, names) if match]
+    return f'Topup{max(numbers, default=0) + 1}'
+
+
+def topup_pipeline(fastq_pattern, output_dir, cpu, topup_name=None, engine='cutadapt', max_mismatch=0,
+                   single_pass=False, fused_trim=False, check_fastq=False, resume=False):
+    output_dir = pathlib.Path(output_dir).absolute()
+    config_path = output_dir / 'mapping_config.ini'
+    if not config_path.exists():
+        raise FileNotFoundError(f'{config_path} not found, output_dir is not a demultiplex output_dir.')
+
+    if topup_name is None:
+        if resume:
+            raise ValueError('topup_name is required to resume a top-up demultiplex.')
+        topup_name = _next_topup_name(output_dir)
+    topup_dir = get_topup_dir(output_dir, topup_name)
+    topup_dir.parent.mkdir(exist_ok=True)
+    print(f'Demultiplex top-up FASTQ files into {topup_dir}')
+
+    demultiplex_pipeline(fastq_pattern=fastq_pattern,
+                         output_dir=topup_dir,
+                         config_path=config_path,
+                         cpu=cpu,
+                         engine=engine,
+                         max_mismatch=max_mismatch,
+                         single_pass=single_pass,
+                         fused_trim=fused_trim,
+                         check_fastq=check_fastq,
+                         resume=resume)
+
+    # cells not mapped in output_dir are mapped with the new reads only
+    topup_cells = pd.read_csv(topup_dir / 'stats/demultiplex.stats.csv', index_col=0)
+    exist_cells = pd.read_csv(output_dir / 'stats/demultiplex.stats.csv', index_col=0)
+    new_uids = set(topup_cells['UID']) - set(exist_cells['UID'])
+    if len(new_uids) > 0:
+        log.warning(f'{len(new_uids)} UIDs of the top-up run are not in {output_dir}: {", ".join(sorted(new_uids))}')
+
+    print(f"Run the snakemake commands in {topup_dir / 'snakemake'} to map the new reads, "
+          f"then use 'yap topup-merge --output_dir {output_dir} --topup_name {topup_name}' "
+          f"to merge them into the existing results.")
+    return
@@ -0,0 +1,134 @@
+"""
+Watch the raw FASTQ directory while bcl2fastq is still writing
+
+Files are polled instead of using inotify, because inotify do not see changes made by other nodes
+on network filesystems, which is where the sequencer output usually is.
+
+A UID is ready when
+1. all its FASTQ files have the same size and mtime for at least stable_seconds;
+2. every lane has both R1 and R2;
+3. it has expected_lanes lanes.
+If the sentinel file exists (e.g. a file touched by the conversion script after bcl2fastq finished),
+all the files are complete, condition 3 is not checked and the watch finish after all UIDs are ready.
+One of expected_lanes and the sentinel file is required, the lanes seen so far do not tell whether
+more lanes of a UID are still coming, a UID demultiplexed without them would lose their reads.
+A FASTQ file appearing after its UID is demultiplexed raise an error.
+"""
+
+import glob
+import logging
+import pathlib
+import time
+
+from .fastq_dataframe import make_fastq_dataframe
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class FastqWatcher:
+    """
+    Poll FASTQ files matching fastq_pattern and report UIDs whose files are complete.
+
+    Parameters
+    ----------
+    fastq_pattern
+        Raw FASTQ path pattern, same as yap demultiplex
+    barcode_version
+    poll_interval
+        Seconds between two polls
+    stable_seconds
+        A file is complete if its size and mtime do not change for stable_seconds
+    sentinel_path
+        If this file exists, the conversion is finished
+    expected_lanes
+        Number of lanes of each UID, required if sentinel_path is not provided
+    idle_timeout
+        Without sentinel, finish the watch if no file changes for idle_timeout seconds
+        and all the seen UIDs are ready
+    """
+
+    def __init__(self, fastq_pattern, barcode_version, poll_interval=60, stable_seconds=300, sentinel_path=None,
+                 expected_lanes=None, idle_timeout=3600):
+        self.fastq_pattern = fastq_pattern
+        self.barcode_version = barcode_version
+        self.poll_interval = poll_interval
+        self.stable_seconds = stable_seconds
+        self.sentinel_path = pathlib.Path(sentinel_path) if sentinel_path is not None else None
+        self.expected_lanes = expected_lanes
+        self.idle_timeout = idle_timeout
+        if self.sentinel_path is None and self.expected_lanes is None:
+            raise ValueError('Watch mode need expected_lanes or sentinel_path to know when all the lanes '
+                             'of a UID are complete.')
+
+        # path: (size, mtime, time when this state is first seen)
+        self._file_states = {}
+        self._last_change = time.time()
+        self._done_uids = set()
+        self._done_paths = set()
+
+    def _update_file_states(self):
+        now = time.time()
+        for path in glob.glob(self.fastq_pattern):
+            path = str(pathlib.Path(path).absolute())
+            try:
+                stat = pathlib.Path(path).stat()
+            except FileNotFoundError:
+                continue
+            state = (stat.st_size, stat.st_mtime)
+            if path not in self._file_states or self._file_states[path][:2] != state:
+                self._file_states[path] = (*state, now)
+                self._last_change = now
+        return now
+
+    def poll(self):
+        """
+        Returns
+        -------
+        list of FASTQ paths of newly ready UIDs, whether the watch is finished
+        """
+        now = self._update_file_states()
+        finished_conversion = self.sentinel_path is not None and self.sentinel_path.exists()
+        if len(self._file_states) == 0:
+            return [], finished_conversion
+
+        fastq_df = make_fastq_dataframe(list(self._file_states.keys()), barcode_version=self.barcode_version)
+        fastq_df['stable'] = fastq_df['fastq_path'].map(
+            lambda p: now - self._file_states[p][2] >= self.stable_seconds)
+
+        ready_paths = []
+        pending_uids = []
+        for uid, uid_df in fastq_df.groupby('uid'):
+            if uid in self._done_uids:
+                continue
+            lanes = set(uid_df['lane'].unique())
+            paired = (uid_df.groupby('lane')['read_type'].nunique() == 2).all()
+            if finished_conversion:
+                enough_lanes = True
+            elif self.expected_lanes is not None:
+                enough_lanes = len(lanes) >= self.expected_lanes
+            else:
+                # wait for the sentinel file
+                enough_lanes = False
+            if uid_df['stable'].all() and paired and enough_lanes:
+                ready_paths += list(uid_df['fastq_path'])
+                self._done_uids.add(uid)
+                self._done_paths.update(uid_df['fastq_path'])
+            else:
+                pending_uids.append(uid)
+
+        # new files of a UID that is already demultiplexed, their reads are not in the cell FASTQ files
+        late_df = fastq_df[fastq_df['uid'].isin(self._done_uids) & ~fastq_df['fastq_path'].isin(self._done_paths)]
+        if late_df.shape[0] > 0:
+            late_uids = ', '.join(late_df['uid'].unique())
+            raise RuntimeError(f'FASTQ files {late_df["fastq_path"].tolist()} appeared after their UIDs '
+                               f'({late_uids}) are demultiplexed, the cell FASTQ files of these UIDs are incomplete. '
+                               f'Do not map these UIDs, check --watch_lanes and demultiplex them again '
+                               f'after the conversion finished.')
+
+        if finished_conversion:
+            finished = len(pending_uids) == 0
+        else:
+            finished = len(pending_uids) == 0 and now - self._last_change > self.idle_timeout
+        return ready_paths, finished
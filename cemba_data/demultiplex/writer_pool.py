@@ -0,0 +1,140 @@
+"""
+Bounded, buffered pool of BGZF writers for per-cell FASTQ files
+
+A V2 UID writes 384 cells * 2 reads FASTQ files at the same time,
+opening one handle for each file is limited by the open file limit (ulimit -n), so the pool
+1. buffers data of each file in memory and compress it into BGZF blocks in large batches,
+   the blocks are compressed by a shared thread pool (see bgzf.py);
+2. keeps at most max_open file handles open, the least recently used handle is closed first;
+3. reopens a closed file in append mode, BGZF blocks are independent gzip members,
+   so appending blocks is always valid.
+"""
+
+import logging
+import resource
+from collections import OrderedDict
+
+from .bgzf import BgzfCompressor, BGZF_EOF
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def default_max_open(n_process=1, reserved=64, upper_limit=512):
+    """Max handles per process based on the soft open file limit"""
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return upper_limit
+    max_open = (soft_limit - reserved) // max(1, n_process)
+    return max(2, min(upper_limit, max_open))
+
+
+class FastqWriterPool:
+    """
+    Write bytes to many BGZF files with bounded memory and file handles.
+
+    Parameters
+    ----------
+    max_open
+        Max number of compressor handles open at the same time
+    buffer_size
+        Data of one file is written when its buffer reach this size (bytes)
+    max_buffer_total
+        All buffers are written when the total buffered data reach this size (bytes)
+    compress_level
+        gzip compress level
+    compress_threads
+        Number of threads compressing the BGZF blocks
+    write_eof
+        Whether to add the BGZF EOF block to each file when the pool is closed,
+        set to False when the files are parts that will be concatenated later
+    """
+
+    def __init__(self, max_open=128, buffer_size=1048576, max_buffer_total=268435456, compress_level=1,
+                 compress_threads=1, write_eof=True):
+        self.max_open = max(1, int(max_open))
+        self.buffer_size = buffer_size
+        self.max_buffer_total = max_buffer_total
+        self.write_eof = write_eof
+        self.compressor = BgzfCompressor(compress_level=compress_level, threads=compress_threads)
+
+        self._buffers = {}
+        self._total_buffered = 0
+        self._handles = OrderedDict()
+        self._created = set()
+
+    @property
+    def paths(self):
+        """All the paths written by this pool"""
+        return self._created | set(self._buffers.keys())
+
+    def _get_handle(self, path):
+        try:
+            handle = self._handles[path]
+            self._handles.move_to_end(path)
+            return handle
+        except KeyError:
+            pass
+
+        if len(self._handles) >= self.max_open:
+            _, lru_handle = self._handles.popitem(last=False)
+            lru_handle.close()
+
+        # the first open create or truncate the file, later ones append blocks
+        mode = 'ab' if path in self._created else 'wb'
+        handle = open(path, mode)
+        self._created.add(path)
+        self._handles[path] = handle
+        return handle
+
+    def _flush(self, path):
+        data = self._buffers.pop(path, None)
+        if not data:
+            return
+        self._total_buffered -= len(data)
+        self._get_handle(path).write(self.compressor.compress(data))
+        return
+
+    def write(self, path, data):
+        path = str(path)
+        try:
+            buffer = self._buffers[path]
+        except KeyError:
+            buffer = self._buffers[path] = bytearray()
+        buffer += data
+        self._total_buffered += len(data)
+
+        if len(buffer) >= self.buffer_size:
+            self._flush(path)
+        elif self._total_buffered >= self.max_buffer_total:
+            self.flush()
+        return
+
+    def flush(self):
+        # flush files that already have open handles first to reduce reopen
+        paths = sorted(self._buffers.keys(), key=lambda p: p not in self._handles)
+        for path in paths:
+            self._flush(path)
+        return
+
+    def close(self):
+        self.flush()
+        self.compressor.close()
+        for path, handle in self._handles.items():
+            if self.write_eof:
+                handle.write(BGZF_EOF)
+            handle.close()
+        if self.write_eof:
+            for path in self._created - set(self._handles.keys()):
+                with open(path, 'ab') as f:
+                    f.write(BGZF_EOF)
+        self._handles.clear()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return
@@ -0,0 +1,169 @@
+"""
+In-process parallel filesystem operations
+
+Staging and cleanup touch many small paths (FASTQ links, skipped cell files, .snakemake dirs...),
+starting one rm/mv/ln process per path makes them bound by process spawn overhead.
+Here the operations are done with os calls in a thread pool: the os calls release the GIL,
+so on network or parallel filesystems (Lustre, NFS, GPFS...) many metadata requests are in flight at the same time.
+Operations are submitted in batches to keep the pool overhead low, and the progress is printed during long runs.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+DEFAULT_THREADS = 16
+BATCH_SIZE = 256
+PROGRESS_INTERVAL = 10
+
+
+class _Progress:
+    """Print done/total of an operation at most every PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, desc, total):
+        self.desc = desc
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.last_print = self.start
+
+    def update(self, n):
+        self.done += n
+        now = time.time()
+        if now - self.last_print > PROGRESS_INTERVAL:
+            print(f'{self.desc}: {self.done}/{self.total} done ({now - self.start:.0f}s)')
+            self.last_print = now
+        return
+
+    def finish(self):
+        elapsed = time.time() - self.start
+        if elapsed > PROGRESS_INTERVAL:
+            print(f'{self.desc}: {self.done}/{self.total} done ({elapsed:.0f}s)')
+        return
+
+
+def _batches(items, batch_size=BATCH_SIZE):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def _run_batches(func, items, threads, desc):
+    """Run func on every item in a thread pool, items are submitted in batches"""
+    if len(items) == 0:
+        return
+
+    def _run_batch(batch):
+        for item in batch:
+            func(item)
+        return len(batch)
+
+    progress = _Progress(desc, len(items))
+    with ThreadPoolExecutor(max(1, threads)) as exe:
+        for n in exe.map(_run_batch, _batches(items)):
+            progress.update(n)
+    progress.finish()
+    return
+
+
+def _scan_dir(path):
+    """Files and sub-dirs in a dir, symlinks to dirs are files here, they are unlinked not followed"""
+    files = []
+    dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    return files, dirs
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return
+
+
+def _rmdir(path):
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    return
+
+
+def remove_paths(paths, threads=DEFAULT_THREADS, desc='Remove files'):
+    """
+    Remove files, symlinks and dir trees like "rm -rf", missing paths are ignored.
+
+    The dir trees are scanned level by level with all the dirs of a level scanned in parallel,
+    then all the files are unlinked in parallel, and the dirs are removed from the deepest level.
+    """
+    files = []
+    dir_levels = []
+    top_dirs = []
+    for path in map(str, paths):
+        if os.path.isdir(path) and not os.path.islink(path):
+            top_dirs.append(path)
+        elif os.path.lexists(path):
+            files.append(path)
+
+    with ThreadPoolExecutor(max(1, threads)) as exe:
+        level = top_dirs
+        while len(level) > 0:
+            dir_levels.append(level)
+            next_level = []
+            for sub_files, sub_dirs in exe.map(_scan_dir, level):
+                files += sub_files
+                next_level += sub_dirs
+            level = next_level
+
+    _run_batches(_unlink, files, threads=threads, desc=desc)
+    for level in reversed(dir_levels):
+        # dirs of the same level do not contain each other
+        _run_batches(_rmdir, level, threads=threads, desc=f'{desc} (dirs)')
+    return
+
+
+def _move(pair):
+    src, dst = pair
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # different filesystems
+        shutil.move(src, dst)
+    return
+
+
+def move_paths(path_pairs, threads=DEFAULT_THREADS, desc='Move files'):
+    """Move each (src, dst) pair like "mv", the dst dirs must exist"""
+    path_pairs = [(str(src), str(dst)) for src, dst in path_pairs]
+    _run_batches(_move, path_pairs, threads=threads, desc=desc)
+    return
+
+
+def _symlink(pair):
+    src, dst = pair
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    os.symlink(src, dst)
+    return
+
+
+def symlink_paths(path_pairs, threads=DEFAULT_THREADS, desc='Link files'):
+    """Create a symlink at dst pointing to src for each (src, dst) pair like "ln -sf", the dst dirs must exist"""
+    path_pairs = [(str(src), str(dst)) for src, dst in path_pairs]
+    _run_batches(_symlink, path_pairs, threads=threads, desc=desc)
+    return
+
@@ -0,0 +1,488 @@
+"""
+Native BAM to ALLC
+
+Same counting as "allcools bam-to-allc", which parse "samtools mpileup -Q 20 -q 10 -B" base by base:
+1. reads that are unmapped, secondary, QC failed, duplicated or with MAPQ < 10 are skipped,
+   bases with quality < 20 are skipped;
+2. at a reference C, forward strand reads with C (methylated) or T (unmethylated) are counted;
+   at a reference G, reverse strand reads with G (methylated) or A (unmethylated) are counted;
+3. the context is the reference sequence around the C, on the strand of the C.
+Instead of a pileup, the reference is pre-encoded once into a flat uppercase sequence file that is memory-mapped
+by every job (the Snakefile templates encode it on start, see encode_reference), the aligned bases of a batch of reads are expanded into arrays,
+and the mC and coverage of each C are summed with NumPy reductions.
+Sites of a batch are only written when no following read can overlap them, so the memory is bounded by the batch.
+
+Optionally, the strand merged mCG ALLC ("allcools extract-allc --strandness merge") is written in the same pass,
+so the ALLC file does not need to be read again to extract the CGN or HCGN sites.
+
+Note: allcools also counted the MAPQ character after each read start marker "^" of the pileup as a base,
+(e.g. a read with MAPQ 11 starting on a G is counted as an extra methylated base),
+here only the real bases are counted.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from ..demultiplex.bgzf import BGZF_EOF, BgzfCompressor
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MIN_MAPQ = 10
+MIN_BASE_QUALITY = 20
+BATCH_SIZE = 50000
+# samtools mpileup default --ff UNMAP,SECONDARY,QCFAIL,DUP
+SKIP_FLAG = 0x4 | 0x100 | 0x200 | 0x400
+# CIGAR operations consuming reference and query: M, =, X
+ALIGNED_OPS = {0, 7, 8}
+# CIGAR operations consuming only reference: D, N
+REF_ONLY_OPS = {2, 3}
+# CIGAR operations consuming only query: I, S
+QUERY_ONLY_OPS = {1, 4}
+
+# same as allcools extract-allc, sites with higher coverage are skipped in the extracted ALLC
+COV_CUTOFF = 9999
+IUPAC_TABLE = {'A': 'A', 'T': 'T', 'C': 'C', 'G': 'G', 'R': 'AG', 'Y': 'CT', 'S': 'GC', 'W': 'AT', 'K': 'GT',
+               'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ATC', 'V': 'ACG', 'N': 'ATCGN'}
+
+# bases fetched from the fasta at a time when encoding the reference
+ENCODE_CHUNK_SIZE = 16777216
+
+_C, _T, _G, _A = (ord(b) for b in 'CTGA')
+# complement table of the - strand context, allcools skip the sites with other bases in the context
+_COMPLEMENT = np.zeros(256, dtype=np.uint8)
+for _base, _complement in zip(b'ACGTN', b'TGCAN'):
+    _COMPLEMENT[_base] = _complement
+
+
+def _encoded_reference_path(reference_fasta):
+    return pathlib.Path(f'{reference_fasta}.allc.seq')
+
+
+def _read_fai(reference_fasta):
+    """Chromosome lengths in the order of the fasta index"""
+    fai_path = pathlib.Path(f'{reference_fasta}.fai')
+    if not fai_path.exists():
+        pysam.faidx(str(reference_fasta))
+    return pd.read_csv(fai_path, sep='\t', header=None, index_col=0, usecols=[0, 1])[1]
+
+
+def _reference_signature(reference_fasta):
+    """Size and mtime of the fasta, saved in {reference_fasta}.allc.seq.json to detect a stale encoded reference"""
+    stat = pathlib.Path(reference_fasta).stat()
+    return {'fasta_size': stat.st_size,
+            'fasta_mtime_ns': stat.st_mtime_ns,
+            'genome_length': int(_read_fai(reference_fasta).sum())}
+
+
+def _is_encoded(reference_fasta):
+    seq_path = _encoded_reference_path(reference_fasta)
+    signature_path = pathlib.Path(f'{seq_path}.json')
+    if not seq_path.exists() or not signature_path.exists():
+        return False
+    with open(signature_path) as f:
+        try:
+            saved = json.load(f)
+        except json.JSONDecodeError:
+            return False
+    signature = _reference_signature(reference_fasta)
+    return saved == signature and seq_path.stat().st_size == signature['genome_length']
+
+
+def encode_reference(reference_fasta):
+    """
+    Write the uppercase sequences of all chromosomes in the order of the fasta index, without new lines,
+    to {reference_fasta}.allc.seq, which is memory-mapped by all bam-to-allc jobs.
+
+    The size and mtime of the fasta are saved in {reference_fasta}.allc.seq.json,
+    the reference is only encoded again if the fasta changed.
+    Concurrent calls wait for each other with a file lock, so the reference is encoded only once.
+    """
+    reference_fasta = pathlib.Path(reference_fasta).absolute()
+    output_path = _encoded_reference_path(reference_fasta)
+    if _is_encoded(reference_fasta):
+        return output_path
+
+    signature_path = pathlib.Path(f'{output_path}.json')
+    lock_path = pathlib.Path(f'{output_path}.lock')
+    try:
+        lock_file = open(lock_path, 'a')
+    except PermissionError:
+        raise PermissionError(f'The encoded reference {output_path} is missing or older than {reference_fasta}, '
+                              f'and the reference dir is not writable. Run "yap-internal encode-reference '
+                              f'--reference_fasta {reference_fasta}" as a user who can write the reference dir.')
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # another job may have finished the encoding while this one wait for the lock
+        if _is_encoded(reference_fasta):
+            return output_path
+        print(f'Encoding {reference_fasta} to {output_path}')
+        signature = _reference_signature(reference_fasta)
+        # write to a temp file first, so other jobs never see a partial file
+        temp_path = output_path.parent / f'{output_path.name}.{os.getpid()}.tmp'
+        with pysam.FastaFile(str(reference_fasta)) as fasta, open(temp_path, 'wb') as f:
+            for chrom, length in _read_fai(reference_fasta).items():
+                # fetch by chunks, so only a small part of the largest chromosome is in memory
+                for start in range(0, length, ENCODE_CHUNK_SIZE):
+                    f.write(fasta.fetch(chrom, start, start + ENCODE_CHUNK_SIZE).upper().encode())
+        signature_path.unlink(missing_ok=True)
+        os.replace(temp_path, output_path)
+        temp_path = pathlib.Path(f'{signature_path}.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(signature, f)
+        os.replace(temp_path, signature_path)
+    return output_path
+
+
+class EncodedReference:
+    """Memory-mapped uppercase reference, chromosome sequences are numpy uint8 views"""
+
+    def __init__(self, reference_fasta):
+        reference_fasta = pathlib.Path(reference_fasta).absolute()
+        fai = _read_fai(reference_fasta)
+        self.genome_length = int(fai.sum())
+        offsets = np.concatenate([[0], np.cumsum(fai.values)])
+        self.chrom_ranges = {chrom: (int(start), int(end))
+                             for chrom, start, end in zip(fai.index, offsets[:-1], offsets[1:])}
+        # usually already encoded on start of the Snakefile, this only check the saved fasta size and mtime
+        seq_path = encode_reference(reference_fasta)
+        self.seq = np.memmap(seq_path, dtype=np.uint8, mode='r')
+
+    def __getitem__(self, chrom):
+        start, end = self.chrom_ranges[chrom]
+        return self.seq[start:end]
+
+
+def _expand_ranges(starts, lengths):
+    """Concatenate range(start, start + length) of all the ranges"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    range_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(np.asarray(starts, dtype=np.int64), lengths) + np.arange(total) - range_offsets
+
+
+def _merge_intervals(starts, ends):
+    """Merge overlapping half-open intervals into sorted disjoint intervals"""
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+    new_interval = starts[1:] > ends[:-1]
+    return starts[np.concatenate([[True], new_interval])], ends[np.concatenate([new_interval, [True]])]
+
+
+class _ReadBatch:
+    """Aligned bases and covered positions of a batch of reads on one chromosome"""
+
+    def __init__(self):
+        self.seqs = []
+        self.quals = []
+        self.query_offset = 0
+        # aligned blocks: reference start, query start in the batch, length, is_reverse
+        self.block_ref = []
+        self.block_query = []
+        self.block_length = []
+        self.block_reverse = []
+        # reference covered blocks, including deletions and skips, for the genome coverage
+        self.cover_ref = []
+        self.cover_length = []
+        self.n_reads = 0
+
+    def add(self, read):
+        ref_pos = read.reference_start
+        query_pos = self.query_offset
+        is_reverse = read.is_reverse
+        for op, length in read.cigartuples:
+            if op in ALIGNED_OPS:
+                self.block_ref.append(ref_pos)
+                self.block_query.append(query_pos)
+                self.block_length.append(length)
+                self.block_reverse.append(is_reverse)
+                self.cover_ref.append(ref_pos)
+                self.cover_length.append(length)
+                ref_pos += length
+                query_pos += length
+            elif op in REF_ONLY_OPS:
+                self.cover_ref.append(ref_pos)
+                self.cover_length.append(length)
+                ref_pos += length
+            elif op in QUERY_ONLY_OPS:
+                query_pos += length
+        self.seqs.append(read.query_sequence.encode())
+        self.quals.append(read.query_qualities.tobytes())
+        self.query_offset += read.query_length
+        self.n_reads += 1
+        return
+
+    def count(self, chrom_seq):
+        """
+        Returns
+        -------
+        positions, is_reverse, is_methylated of the counted bases, and the (starts, ends) of covered intervals
+        """
+        cover_start = np.asarray(self.cover_ref, dtype=np.int64)
+        covered = (cover_start, cover_start + np.asarray(self.cover_length, dtype=np.int64))
+        if self.n_reads == 0 or len(self.block_length) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool), covered
+        seq = np.frombuffer(b''.join(self.seqs), dtype=np.uint8)
+        qual = np.frombuffer(b''.join(self.quals), dtype=np.uint8)
+        ref_pos = _expand_ranges(self.block_ref, self.block_length)
+        query_pos = _expand_ranges(self.block_query, self.block_length)
+        is_reverse = np.repeat(np.asarray(self.block_reverse, dtype=bool), self.block_length)
+
+        read_base = seq[query_pos]
+        ref_base = chrom_seq[ref_pos]
+        forward_c = ~is_reverse & (ref_base == _C) & ((read_base == _C) | (read_base == _T))
+        reverse_g = is_reverse & (ref_base == _G) & ((read_base == _G) | (read_base == _A))
+        use = (forward_c | reverse_g) & (qual[query_pos] >= MIN_BASE_QUALITY)
+        is_methylated = (read_base == _C) | (read_base == _G)
+        return ref_pos[use], is_reverse[use], is_methylated[use], covered
+
+
+def _sum_sites(positions, is_reverse, is_methylated):
+    """Sum the counted bases of each site, a position is either a C or a G so the strand is unique"""
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    is_reverse = is_reverse[order]
+    is_methylated = is_methylated[order]
+    starts = np.flatnonzero(np.concatenate([[True], positions[1:] != positions[:-1]])) \
+        if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+    cov = np.diff(np.concatenate([starts, [len(positions)]]))
+    mc = np.add.reduceat(is_methylated.astype(np.int64), starts) if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+    return positions[starts], is_reverse[starts], mc, cov
+
+
+def _site_contexts(chrom_seq, positions, is_reverse, num_upstr_bases, num_downstr_bases):
+    """Context of each site on its strand, and whether the complete context is available"""
+    context_len = num_upstr_bases + 1 + num_downstr_bases
+    # + strand: seq[pos - up: pos + down + 1]; - strand: reverse complement of seq[pos - down: pos + up + 1]
+    starts = np.where(is_reverse, positions - num_downstr_bases, positions - num_upstr_bases)
+    valid = (starts >= 0) & (starts + context_len <= len(chrom_seq))
+    index = np.clip(starts[:, None] + np.arange(context_len)[None, :], 0, len(chrom_seq) - 1)
+    context = np.asarray(chrom_seq[index.ravel()]).reshape(-1, context_len)
+    reverse_context = _COMPLEMENT[context[:, ::-1]]
+    context = np.where(is_reverse[:, None], reverse_context, context)
+    valid &= ~(is_reverse & (reverse_context == 0).any(axis=1))
+    context_str = context.view(f'S{context_len}').ravel().astype(str)
+    return context_str, valid
+
+
+def parse_mc_pattern(pattern):
+    """All the contexts matching an IUPAC mC pattern, e.g. CGN"""
+    contexts = ['']
+    for base in pattern.upper():
+        contexts = [context + b for context in contexts for b in IUPAC_TABLE[base]]
+    return contexts
+
+
+def _allc_lines(chrom, positions, is_reverse, contexts, mc, cov):
+    return ''.join(f'{chrom}\t{pos + 1}\t{"-" if reverse else "+"}\t{context}\t{m}\t{c}\t1\n'
+                   for pos, reverse, context, m, c in zip(positions.tolist(), is_reverse.tolist(),
+                                                          contexts.tolist(), mc.tolist(), cov.tolist()))
+
+
+class _MergedCGWriter:
+    """
+    Write the CG sites with the two strands merged, same as "allcools extract-allc --strandness merge":
+    the + strand C and the - strand C (G at the next position) of a CG are merged into the + strand position;
+    a - strand C without the + strand C is moved to the + strand position.
+    """
+
+    def __init__(self, output_path, mc_context, chrom_size_path, compress_level):
+        self.output_path = output_path
+        self.file = open(output_path, 'wb')
+        self.compressor = BgzfCompressor(compress_level=compress_level)
+        self.contexts = parse_mc_pattern(mc_context)
+        self.chroms = None
+        if chrom_size_path is not None:
+            self.chroms = set(pd.read_csv(chrom_size_path, sep='\t', header=None, usecols=[0])[0].astype(str))
+        self.chrom = None
+        # the last + strand site, its - strand site may be in the next batch
+        self.pending = None
+
+    def write(self, chrom, positions, is_reverse, contexts, mc, cov):
+        if self.chroms is not None and chrom not in self.chroms:
+            return
+        if chrom != self.chrom:
+            self._flush()
+            self.chrom = chrom
+        use = np.isin(contexts, self.contexts) & (cov <= COV_CUTOFF)
+        sites = [positions[use], is_reverse[use], contexts[use], mc[use], cov[use]]
+        if self.pending is not None:
+            sites = [np.concatenate([p, s]) for p, s in zip(self.pending, sites)]
+            self.pending = None
+        if len(sites[0]) > 0 and not sites[1][-1]:
+            self.pending = [s[-1:] for s in sites]
+            sites = [s[:-1] for s in sites]
+        self._write_merged(*sites)
+        return
+
+    def _write_merged(self, positions, is_reverse, contexts, mc, cov):
+        if len(positions) == 0:
+            return
+        # a + strand site followed by the - strand site at the next position
+        pair = ~is_reverse[:-1] & is_reverse[1:] & (positions[1:] == positions[:-1] + 1)
+        mc = mc.copy()
+        cov = cov.copy()
+        mc[:-1] += np.where(pair, mc[1:], 0)
+        cov[:-1] += np.where(pair, cov[1:], 0)
+        keep = ~np.concatenate([[False], pair])
+        positions = np.where(is_reverse, positions - 1, positions)[keep]
+        lines = _allc_lines(self.chrom, positions, np.zeros(len(positions), dtype=bool),
+                            contexts[keep], mc[keep], cov[keep])
+        self.file.write(self.compressor.compress(lines.encode()))
+        return
+
+    def _flush(self):
+        if self.pending is not None:
+            self._write_merged(*self.pending)
+            self.pending = None
+        return
+
+    def close(self):
+        self._flush()
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        self.compressor.close()
+        pysam.tabix_index(str(self.output_path), seq_col=0, start_col=1, end_col=1, force=True)
+        return
+
+
+class _AllcWriter:
+    def __init__(self, output_path, compress_level, merged_cg_writer=None):
+        self.file = open(output_path, 'wb')
+        self.compressor = BgzfCompressor(compress_level=compress_level)
+        self.merged_cg_writer = merged_cg_writer
+        self.mc = {}
+        self.cov = {}
+
+    def write(self, chrom, chrom_seq, positions, is_reverse, is_methylated, num_upstr_bases, num_downstr_bases):
+        if len(positions) == 0:
+            return
+        positions, is_reverse, mc, cov = _sum_sites(positions, is_reverse, is_methylated)
+        contexts, valid = _site_contexts(chrom_seq, positions, is_reverse, num_upstr_bases, num_downstr_bases)
+        positions, is_reverse, mc, cov, contexts = \
+            positions[valid], is_reverse[valid], mc[valid], cov[valid], contexts[valid]
+        lines = _allc_lines(chrom, positions, is_reverse, contexts, mc, cov)
+        self.file.write(self.compressor.compress(lines.encode()))
+        if self.merged_cg_writer is not None:
+            self.merged_cg_writer.write(chrom, positions, is_reverse, contexts, mc, cov)
+
+        context_df = pd.DataFrame({'mc': mc, 'cov': cov}, index=contexts).groupby(level=0).sum()
+        for context, (m, c) in zip(context_df.index, context_df.values.tolist()):
+            self.mc[context] = self.mc.get(context, 0) + m
+            self.cov[context] = self.cov.get(context, 0) + c
+        return
+
+    def close(self):
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        self.compressor.close()
+        if self.merged_cg_writer is not None:
+            self.merged_cg_writer.close()
+        return
+
+
+def bam_to_allc(bam_path, reference_fasta, output_path, num_upstr_bases=0, num_downstr_bases=2,
+                compress_level=5, save_count_df=False, merged_cg_path=None, mcg_context='CGN',
+                chrom_size_path=None):
+    """
+    Generate an ALLC file from a coordinate sorted bismark BAM file.
+
+    Parameters
+    ----------
+    bam_path
+        Input BAM path, sorted by coordinate
+    reference_fasta
+        Reference fasta used in the mapping, need to have a .fai index
+    output_path
+        Output ALLC path, bgzip compressed and tabix indexed
+    num_upstr_bases
+        Number of upstream bases of the C in the context column, 0 for normal snmC, 1 for NOMe
+    num_downstr_bases
+        Number of downstream bases of the C in the context column
+    compress_level
+        Compress level of the ALLC file
+    save_count_df
+        If true, save the mC and coverage of each context to {output_path}.count.csv
+    merged_cg_path
+        If provided, also write the strand merged mCG ALLC of mcg_context to this path
+    mcg_context
+        mC pattern of the strand merged mCG ALLC, CGN for normal snmC, HCGN for NOMe
+    chrom_size_path
+        If provided, only the chromosomes in the chrom size file are written to the strand merged mCG ALLC
+
+    Returns
+    -------
+    count dataframe of each context
+    """
+    reference = EncodedReference(reference_fasta)
+    merged_cg_writer = None
+    if merged_cg_path is not None:
+        merged_cg_writer = _MergedCGWriter(merged_cg_path, mc_context=mcg_context,
+                                           chrom_size_path=chrom_size_path, compress_level=compress_level)
+    writer = _AllcWriter(output_path, compress_level=compress_level, merged_cg_writer=merged_cg_writer)
+    total_covered = 0
+
+    with pysam.AlignmentFile(bam_path) as bam:
+        chrom = None
+        chrom_seq = None
+        batch = _ReadBatch()
+        # counted bases and covered intervals not final yet
+        carry = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool),
+                 np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+
+        def flush(boundary):
+            """Write the sites before boundary, which no following read can overlap"""
+            nonlocal carry, batch, total_covered
+            positions, is_reverse, is_methylated, covered = batch.count(chrom_seq)
+            batch = _ReadBatch()
+            positions = np.concatenate([carry[0], positions])
+            is_reverse = np.concatenate([carry[1], is_reverse])
+            is_methylated = np.concatenate([carry[2], is_methylated])
+            cover_start, cover_end = _merge_intervals(np.concatenate([carry[3], covered[0]]),
+                                                      np.concatenate([carry[4], covered[1]]))
+            final = positions < boundary
+            writer.write(chrom, chrom_seq, positions[final], is_reverse[final], is_methylated[final],
+                         num_upstr_bases, num_downstr_bases)
+            total_covered += int((np.minimum(cover_end, boundary) - cover_start).clip(min=0).sum())
+            open_cover = cover_end > boundary
+            carry = [positions[~final], is_reverse[~final], is_methylated[~final],
+                     np.maximum(cover_start[open_cover], boundary).astype(np.int64), cover_end[open_cover]]
+            return
+
+        for read in bam:
+            if read.flag & SKIP_FLAG or read.mapping_quality < MIN_MAPQ:
+                continue
+            if read.reference_name != chrom:
+                if chrom is not None:
+                    flush(np.inf)
+                chrom = read.reference_name
+                chrom_seq = reference[chrom]
+            elif batch.n_reads >= BATCH_SIZE:
+                # following reads start at or after this read
+                flush(read.reference_start)
+            batch.add(read)
+        if chrom is not None:
+            flush(np.inf)
+    writer.close()
+    pysam.tabix_index(str(output_path), seq_col=0, start_col=1, end_col=1, force=True)
+
+    count_df = pd.DataFrame({'mc': pd.Series(writer.mc, dtype=np.int64),
+                             'cov': pd.Series(writer.cov, dtype=np.int64)}).sort_index()
+    count_df['mc_rate'] = count_df['mc'] / count_df['cov']
+    count_df['genome_cov'] = total_covered / reference.genome_length
+    if save_count_df:
+        count_df.to_csv(f'{output_path}.count.csv')
+    return count_df
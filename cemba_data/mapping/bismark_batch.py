@@ -0,0 +1,300 @@
+"""
+UID level batched bismark alignment
+
+The bismark rules map each cell and read type separately, every job loads the bisulfite genome index
+and starts its own bowtie processes, while most cells only have a few hundred thousand reads.
+In batch mode, the trimmed reads of all cells in a UID are mapped together:
+1. the cell FASTQ files are concatenated, each read name is prefixed with the cell index;
+2. one bismark job maps the concatenated reads with many threads;
+3. the bismark BAM (and the unmapped reads) are split back to cells in one streaming pass,
+   the cell prefix is removed from the read names and each cell BAM has its own read group;
+4. a bismark style report is written for each cell, so the cell level stats are parsed the same way.
+The per cell output files have the same names as the files written by running bismark on each cell.
+"""
+
+import logging
+import pathlib
+import shutil
+import subprocess
+from collections import Counter
+
+import dnaio
+import pysam
+from xopen import xopen
+
+from ..demultiplex.bgzf import BGZF_EOF, BgzfCompressor
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# read names are prefixed with {cell_index}{CELL_SEPARATOR}, bismark keep read names until the first space
+CELL_SEPARATOR = '#'
+FASTQ_SUFFIXES = ['.fastq.gz', '.fq.gz', '.fastq', '.fq']
+_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# bismark methylation call characters in the XM tag
+METHYLATION_CONTEXTS = {'CpG': ('Z', 'z'), 'CHG': ('X', 'x'), 'CHH': ('H', 'h'), 'Unknown': ('U', 'u')}
+# bismark read and genome conversion of each strand, from the XR and XG tag
+STRAND_CONVERSIONS = [('CT', 'CT', '((converted) top strand)'),
+                      ('CT', 'GA', '((converted) bottom strand)'),
+                      ('GA', 'CT', '(complementary to (converted) top strand)'),
+                      ('GA', 'GA', '(complementary to (converted) bottom strand)')]
+
+
+def bismark_output_names(fastq_path, bowtie1=False):
+    """Names of the bismark output files of a single-end FASTQ file"""
+    name = pathlib.Path(fastq_path).name
+    stem = name
+    for suffix in FASTQ_SUFFIXES:
+        if name.endswith(suffix):
+            stem = name[:-len(suffix)]
+            break
+    aligner = '_bismark' if bowtie1 else '_bismark_bt2'
+    return {'bam': f'{stem}{aligner}.bam',
+            'report': f'{stem}{aligner}_SE_report.txt',
+            'unmapped': f'{name}_unmapped_reads.fq.gz'}
+
+
+class _CellStats:
+    """Alignment and methylation counts of one cell, in the terms of the bismark report"""
+
+    def __init__(self):
+        self.total = 0
+        self.unique = 0
+        self.ambiguous = 0
+        self.strands = Counter()
+        self.methylation = Counter()
+
+    def add_alignment(self, read):
+        self.unique += 1
+        self.strands[(read.get_tag('XR'), read.get_tag('XG'))] += 1
+        methylation_call = read.get_tag('XM')
+        for chars in METHYLATION_CONTEXTS.values():
+            for char in chars:
+                self.methylation[char] += methylation_call.count(char)
+        return
+
+    def write_report(self, path, fastq_path, batch_report):
+        no_alignment = self.total - self.unique - self.ambiguous
+        efficiency = self.unique / self.total * 100 if self.total > 0 else 0
+        total_c = sum(self.methylation[char] for context, chars in METHYLATION_CONTEXTS.items()
+                      if context != 'Unknown' for char in chars)
+        with open(path, 'w') as f:
+            f.write(f'Bismark report for: {fastq_path} (split from the UID batch alignment {batch_report})\n\n')
+            f.write('Final Alignment report\n'
+                    '======================\n'
+                    f'Sequences analysed in total:\t{self.total}\n'
+                    f'Number of alignments with a unique best hit from the different alignments:\t{self.unique}\n'
+                    f'Mapping efficiency:\t{efficiency:.1f}%\n'
+                    f'Sequences with no alignments under any condition:\t{no_alignment}\n'
+                    f'Sequences did not map uniquely:\t{self.ambiguous}\n'
+                    f'Sequences which were discarded because genomic sequence could not be extracted:\t0\n\n')
+            f.write('Number of sequences with unique best (first) alignment came from the bowtie output:\n')
+            for read_conversion, genome_conversion, description in STRAND_CONVERSIONS:
+                f.write(f'{read_conversion}/{genome_conversion}:\t'
+                        f'{self.strands[(read_conversion, genome_conversion)]}\t{description}\n')
+            f.write('\nFinal Cytosine Methylation Report\n'
+                    '=================================\n'
+                    f"Total number of C's analysed:\t{total_c}\n\n")
+            for context, (methylated, _) in METHYLATION_CONTEXTS.items():
+                f.write(f"Total methylated C's in {context} context:\t{self.methylation[methylated]}\n")
+            f.write('\n')
+            for context, (_, unmethylated) in METHYLATION_CONTEXTS.items():
+                f.write(f"Total unmethylated C's in {context} context:\t{self.methylation[unmethylated]}\n")
+            f.write('\n')
+            for context, (methylated, unmethylated) in METHYLATION_CONTEXTS.items():
+                n_methylated = self.methylation[methylated]
+                n_total = n_methylated + self.methylation[unmethylated]
+                context_str = 'Unknown context (CN or CHN)' if context == 'Unknown' else f'{context} context'
+                if n_total > 0:
+                    f.write(f'C methylated in {context_str}:\t{n_methylated / n_total * 100:.1f}%\n')
+                else:
+                    f.write(f"Can't determine percentage of methylated Cs in {context_str} if value was 0\n")
+        return
+
+
+def _concat_fastq(fastq_paths, output_path, compress_level=1, threads=1):
+    """Concatenate cell FASTQ files with the cell index prefixed to the read names, return read counts"""
+    counts = []
+    compressor = BgzfCompressor(compress_level=compress_level, threads=threads)
+    try:
+        with open(output_path, 'wb') as out:
+            for cell_index, fastq_path in enumerate(fastq_paths):
+                n_reads = 0
+                buffer = bytearray()
+                with dnaio.open(fastq_path, mode='r') as reader:
+                    for read in reader:
+                        read.name = f'{cell_index}{CELL_SEPARATOR}{read.name}'
+                        buffer += read.fastq_bytes()
+                        n_reads += 1
+                        if len(buffer) > _WRITE_BUFFER_SIZE:
+                            out.write(compressor.compress(buffer))
+                            buffer = bytearray()
+                if buffer:
+                    out.write(compressor.compress(buffer))
+                counts.append(n_reads)
+            out.write(BGZF_EOF)
+    finally:
+        compressor.close()
+    return counts
+
+
+def _cell_id(fastq_path):
+    """Cell FASTQ file names are {cell_id}-{read_type}.*"""
+    name = fastq_path.name.split('.')[0]
+    if name.endswith(('-R1', '-R2')):
+        name = name[:-3]
+    return name
+
+
+def _split_read_name(name):
+    cell_index, name = name.split(CELL_SEPARATOR, 1)
+    return int(cell_index), name
+
+
+def _split_bam(batch_bam_path, cell_ids, output_paths, cell_stats, compress_level=None):
+    """Split the batch BAM to cell BAMs, each cell BAM has a read group of the cell"""
+    writers = []
+    format_options = None if compress_level is None else [f'level={compress_level}']
+    with pysam.AlignmentFile(batch_bam_path) as bam:
+        header = bam.header.to_dict()
+        try:
+            for cell_id, output_path in zip(cell_ids, output_paths):
+                cell_header = dict(header, RG=[{'ID': cell_id, 'SM': cell_id}])
+                writers.append(pysam.AlignmentFile(output_path, 'wb', header=cell_header,
+                                                   format_options=format_options))
+            for read in bam:
+                cell_index, read.query_name = _split_read_name(read.query_name)
+                read.set_tag('RG', cell_ids[cell_index], value_type='Z')
+                cell_stats[cell_index].add_alignment(read)
+                writers[cell_index].write(read)
+        finally:
+            for writer in writers:
+                writer.close()
+    return
+
+
+def _split_fastq(batch_fastq_paths, output_paths, cell_stats=None):
+    """Split reads of the batch FASTQ files to cell FASTQ files, optionally count them as ambiguous reads"""
+    writers = {}
+    try:
+        for batch_fastq_path in batch_fastq_paths:
+            with dnaio.open(batch_fastq_path, mode='r') as reader:
+                for read in reader:
+                    cell_index, read.name = _split_read_name(read.name)
+                    if cell_stats is not None:
+                        cell_stats[cell_index].ambiguous += 1
+                    if output_paths is None:
+                        continue
+                    try:
+                        writer = writers[cell_index]
+                    except KeyError:
+                        writer = writers[cell_index] = xopen(output_paths[cell_index], 'wb',
+                                                             compresslevel=1, threads=0)
+                    writer.write(read.fastq_bytes())
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if output_paths is not None:
+        # cells without unmapped reads still have the output file
+        for cell_index, output_path in enumerate(output_paths):
+            if cell_index not in writers:
+                with xopen(output_path, 'wb', compresslevel=1, threads=0):
+                    pass
+    return
+
+
+def _find_output(batch_dir, pattern):
+    paths = list(batch_dir.glob(pattern))
+    if len(paths) != 1:
+        raise FileNotFoundError(f'Expect one bismark output matching {pattern} in {batch_dir}, got {paths}')
+    return paths[0]
+
+
+def bismark_batch(bismark_reference, fastq_paths, output_dir, batch_name, cpu=1,
+                  pbat=False, bowtie1=False, unmapped=False, keep_batch_dir=False, report_dir=None,
+                  bam_compress_level=None):
+    """
+    Map the single-end FASTQ files of many cells in one bismark job and split the results back to cells.
+
+    Parameters
+    ----------
+    bismark_reference
+        bismark reference dir
+    fastq_paths
+        cell FASTQ paths, one file per cell, named as {cell_id}-{read_type}.*
+    output_dir
+        output dir of the cell BAM, report (and unmapped FASTQ) files
+    batch_name
+        name of the batch, used in the temporary batch dir name
+    cpu
+        number of threads, each bismark job run two bowtie processes
+    pbat
+        map with bismark --pbat
+    bowtie1
+        map with bowtie1 instead of bowtie2
+    unmapped
+        also write unmapped and ambiguous reads of each cell, same as bismark --un
+    keep_batch_dir
+        keep the temporary batch dir, for trouble shooting purpose
+    report_dir
+        output dir of the cell report files, if None, use output_dir
+    bam_compress_level
+        BGZF compress level of the cell BAM files, 0 for uncompressed BAM, if None, use the pysam default
+
+    Returns
+    -------
+    None
+    """
+    output_dir = pathlib.Path(output_dir).absolute()
+    report_dir = output_dir if report_dir is None else pathlib.Path(report_dir).absolute()
+    report_dir.mkdir(parents=True, exist_ok=True)
+    fastq_paths = [pathlib.Path(path).absolute() for path in fastq_paths]
+    cell_ids = [_cell_id(path) for path in fastq_paths]
+    cell_outputs = [bismark_output_names(path, bowtie1=bowtie1) for path in fastq_paths]
+
+    batch_dir = output_dir / f'{batch_name}.bismark_batch'
+    if batch_dir.exists():
+        shutil.rmtree(batch_dir)
+    batch_dir.mkdir(parents=True)
+    batch_fastq_path = batch_dir / f'{batch_name}.fq.gz'
+    read_counts = _concat_fastq(fastq_paths, batch_fastq_path, threads=max(1, cpu // 2))
+    cell_stats = [_CellStats() for _ in cell_ids]
+    for stats, n_reads in zip(cell_stats, read_counts):
+        stats.total = n_reads
+    print(f'Concatenated {sum(read_counts)} reads from {len(cell_ids)} cells, mapping with bismark.')
+
+    cmd = ['bismark', str(bismark_reference), '--bowtie1' if bowtie1 else '--bowtie2',
+           # bismark run two bowtie processes in directional and pbat mode
+           '-p', str(max(1, cpu // 2)),
+           # ambiguous reads are counted for each cell
+           '--ambiguous',
+           '-o', str(batch_dir), '--temp_dir', str(batch_dir)]
+    if pbat:
+        cmd.append('--pbat')
+    if unmapped:
+        cmd.append('--un')
+    cmd.append(str(batch_fastq_path))
+    subprocess.run(cmd, check=True)
+
+    batch_bam_path = _find_output(batch_dir, '*.bam')
+    batch_report_path = _find_output(batch_dir, '*_SE_report.txt')
+    _split_bam(batch_bam_path,
+               cell_ids=cell_ids,
+               output_paths=[output_dir / names['bam'] for names in cell_outputs],
+               cell_stats=cell_stats,
+               compress_level=bam_compress_level)
+    ambiguous_path = _find_output(batch_dir, '*_ambiguous_reads*')
+    if unmapped:
+        # without --ambiguous, bismark --un also write the ambiguous reads to the unmapped file
+        unmapped_path = _find_output(batch_dir, '*_unmapped_reads*')
+        _split_fastq([unmapped_path, ambiguous_path],
+                     output_paths=[output_dir / names['unmapped'] for names in cell_outputs])
+    # count the ambiguous reads
+    _split_fastq([ambiguous_path], output_paths=None, cell_stats=cell_stats)
+
+    for stats, fastq_path, names in zip(cell_stats, fastq_paths, cell_outputs):
+        stats.write_report(report_dir / names['report'], fastq_path=fastq_path, batch_report=batch_report_path.name)
+    if not keep_batch_dir:
+        shutil.rmtree(batch_dir)
+    return
@@ -0,0 +1,185 @@
+"""
+Streaming PCR duplicate removal of coordinate sorted single-end BAM
+
+This replaces "picard MarkDuplicates REMOVE_DUPLICATES=true" in the dedup rules,
+so each cell BAM do not need to start a JVM.
+The duplicate definition follows picard for unpaired reads:
+1. reads with the same reference, unclipped 5' position and strand are duplicates;
+2. among the duplicates, the read with the highest sum of base qualities (>= 15) is kept,
+   ties are kept in file order, i.e. the first read is kept;
+3. unmapped, secondary and supplementary reads are not examined and written as is.
+The input is streamed in coordinate order, only reads whose duplicate group may still grow are kept in memory,
+and the metrics file is written in the picard DuplicationMetrics format read by parse_deduplicate_stat.
+"""
+
+import logging
+from collections import deque
+
+import pysam
+
+import cemba_data
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MIN_BASE_QUALITY = 15
+# picard caps the score of a read to fit in a short
+MAX_SCORE = 32767 // 2
+METRICS_COLUMNS = ['LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'SECONDARY_OR_SUPPLEMENTARY_RDS',
+                   'UNMAPPED_READS', 'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES', 'READ_PAIR_OPTICAL_DUPLICATES',
+                   'PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']
+
+
+def _read_score(read):
+    qualities = read.query_qualities
+    if qualities is None:
+        return 0
+    return min(sum(q for q in qualities if q >= MIN_BASE_QUALITY), MAX_SCORE)
+
+
+def _read_key(read):
+    """(reference, unclipped 5' position, is_reverse) of a mapped read"""
+    cigar = read.cigartuples
+    if read.is_reverse:
+        # soft (4) and hard (5) clips at the end
+        clip = 0
+        for op, length in reversed(cigar):
+            if op not in (4, 5):
+                break
+            clip += length
+        return read.reference_id, read.reference_end + clip, True
+    else:
+        clip = 0
+        for op, length in cigar:
+            if op not in (4, 5):
+                break
+            clip += length
+        return read.reference_id, read.reference_start - clip, False
+
+
+class _DuplicateGroup:
+    __slots__ = ('best', 'score', 'pending')
+
+    def __init__(self, read_id, score):
+        self.best = read_id
+        self.score = score
+        self.pending = 0
+
+
+def _write_metrics(path, library, counts):
+    examined = counts['examined']
+    duplicates = counts['duplicates']
+    rate = duplicates / examined if examined > 0 else 0
+    values = [library, examined, 0, counts['secondary'], counts['unmapped'], duplicates, 0, 0, round(rate, 6), '']
+    with open(path, 'w') as f:
+        f.write('## htsjdk.samtools.metrics.StringHeader\n')
+        f.write(f'# yap-internal dedup, streaming duplicate removal of cemba_data {cemba_data.__version__}\n')
+        f.write('\n')
+        f.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        f.write('\t'.join(METRICS_COLUMNS) + '\n')
+        f.write('\t'.join(map(str, values)) + '\n')
+        f.write('\n')
+    return
+
+
+def deduplicate_bam(input_path, output_path, metrics_path, compress_level=None):
+    """
+    Remove PCR duplicates of a coordinate sorted single-end BAM file.
+
+    Parameters
+    ----------
+    input_path
+        Input BAM path, must be sorted by coordinate
+    output_path
+        Output BAM path without the duplicates
+    metrics_path
+        Output metrics path in picard DuplicationMetrics format
+    compress_level
+        BGZF compress level of the output BAM, 0 for uncompressed BAM, if None, use the pysam default
+
+    Returns
+    -------
+    dict of read counts
+    """
+    counts = {'examined': 0, 'duplicates': 0, 'secondary': 0, 'unmapped': 0}
+    with pysam.AlignmentFile(input_path) as bam:
+        header = bam.header.to_dict()
+        if header.get('HD', {}).get('SO') != 'coordinate':
+            raise ValueError(f'{input_path} is not sorted by coordinate, got SO:{header.get("HD", {}).get("SO")}')
+        libraries = {rg['LB'] for rg in header.get('RG', []) if 'LB' in rg}
+        library = libraries.pop() if len(libraries) == 1 else 'Unknown Library'
+        header.setdefault('PG', []).append({'ID': f'yap-dedup.{len(header.get("PG", []))}',
+                                            'PN': 'yap-internal dedup',
+                                            'VN': cemba_data.__version__})
+
+        # pysam only take the compress level through the htslib format options
+        format_options = None if compress_level is None else [f'level={compress_level}']
+        with pysam.AlignmentFile(output_path, 'wb', header=header, format_options=format_options) as out_bam:
+            # reads in file order whose duplicate groups may still change: (read_id, read, key)
+            pending = deque()
+            groups = {}
+            # leading clips can not be longer than the read, so a forward group can not grow after the
+            # current position passed it by more than the longest read seen
+            window = 0
+
+            def flush(reference_id, position):
+                while pending:
+                    read_id, read, key = pending[0]
+                    if key is None:
+                        # not examined reads are written in their original order
+                        pending.popleft()
+                        out_bam.write(read)
+                        continue
+                    key_reference, key_position, is_reverse = key
+                    if key_reference == reference_id and \
+                            (key_position >= position if is_reverse else key_position + window >= position):
+                        # the group of the first pending read is still open
+                        break
+                    pending.popleft()
+                    group = groups[key]
+                    if group.best == read_id:
+                        out_bam.write(read)
+                    else:
+                        counts['duplicates'] += 1
+                    group.pending -= 1
+                    if group.pending == 0:
+                        del groups[key]
+                return
+
+            for read_id, read in enumerate(bam):
+                if read.is_paired and not read.is_unmapped:
+                    raise ValueError(f'{input_path} contains paired reads, yap-internal dedup only support '
+                                     f'single-end reads, got {read.query_name}.')
+                if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                    if read.is_unmapped:
+                        counts['unmapped'] += 1
+                    else:
+                        counts['secondary'] += 1
+                    flush(read.reference_id, read.reference_start)
+                    if pending:
+                        # keep the output order, this read is written after the pending reads before it
+                        pending.append((read_id, read, None))
+                    else:
+                        out_bam.write(read)
+                    continue
+
+                counts['examined'] += 1
+                window = max(window, read.infer_read_length())
+                flush(read.reference_id, read.reference_start)
+                key = _read_key(read)
+                score = _read_score(read)
+                try:
+                    group = groups[key]
+                    if score > group.score:
+                        group.best = read_id
+                        group.score = score
+                except KeyError:
+                    group = groups[key] = _DuplicateGroup(read_id, score)
+                group.pending += 1
+                pending.append((read_id, read, key))
+            flush(None, None)
+
+    _write_metrics(metrics_path, library, counts)
+    log.info(f'{counts["examined"]} reads examined, {counts["duplicates"]} duplicates removed from {input_path}')
+    return counts
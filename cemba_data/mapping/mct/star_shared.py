@@ -0,0 +1,148 @@
+"""
+Share one STAR genome in memory between the mCT UID jobs running on the same node
+
+Without sharing, each UID job loads its own copy of the STAR genome (--genomeLoad NoSharedMemory),
+so the number of mCT UIDs running on a node is limited by the genome size.
+Here a node-local coordinator keeps a consumer count of each genome under a file lock:
+1. the first consumer loads the genome into shared memory (--genomeLoad LoadAndExit);
+2. each consumer map reads with --genomeLoad LoadAndKeep, which attach to the loaded genome;
+3. when the last consumer exits, the genome is removed from shared memory (--genomeLoad Remove).
+Each consumer is registered by its pid, consumers killed without cleanup are removed at the next lock,
+so the genome is not kept forever by dead jobs.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import pathlib
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _default_lock_dir():
+    # /dev/shm is node-local and cleaned on reboot, same as the shared memory genome
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _genome_state_dir(star_reference, lock_dir):
+    genome_dir = os.path.realpath(star_reference)
+    genome_hash = hashlib.sha1(genome_dir.encode()).hexdigest()[:12]
+    state_dir = pathlib.Path(lock_dir) / f'yap_star_genome_{genome_hash}'
+    state_dir.mkdir(exist_ok=True)
+    return state_dir
+
+
+@contextmanager
+def _locked(state_dir):
+    with open(state_dir / 'lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists but owned by another user
+        return True
+    return True
+
+
+def _live_consumers(state_dir):
+    """pids of registered consumers, files of dead consumers are removed"""
+    consumers = []
+    for path in state_dir.glob('consumer.*'):
+        pid = int(path.name.split('.')[1])
+        if _pid_alive(pid):
+            consumers.append(pid)
+        else:
+            log.warning(f'Remove STAR genome consumer {pid}, the process is not running anymore.')
+            path.unlink()
+    return consumers
+
+
+def _run_star_genome_load(star_reference, genome_load, state_dir):
+    cmd = ['STAR', '--genomeDir', str(star_reference), '--genomeLoad', genome_load,
+           '--outFileNamePrefix', f'{state_dir}/{genome_load}.', '--outSAMtype', 'None']
+    log.info(f'Run: {" ".join(cmd)}')
+    # the stdout of the wrapper can be the BAM stream of the mapping STAR command (--outStd BAM_Unsorted)
+    subprocess.run(cmd, check=True, stdout=sys.stderr)
+    return
+
+
+def _raise_on_sigterm(signum, frame):
+    # snakemake terminates jobs with SIGTERM, turn it into an exception so the consumer is unregistered
+    raise SystemExit(128 + signum)
+
+
+def star_shared_genome(star_reference, star_command, lock_dir=None):
+    """
+    Run a STAR command with the genome shared in memory between all jobs on the node.
+
+    Parameters
+    ----------
+    star_reference
+        STAR genome dir, must be the same as the --genomeDir of star_command
+    star_command
+        STAR command, list of arguments or a string, should contain "--genomeLoad LoadAndKeep"
+    lock_dir
+        node-local dir to keep the lock and consumer files, default is /dev/shm or the system temp dir
+
+    Returns
+    -------
+    None
+    """
+    if isinstance(star_command, str):
+        star_command = shlex.split(star_command)
+    star_command = list(star_command)
+    if len(star_command) > 0 and star_command[0] == '--':
+        star_command = star_command[1:]
+    if 'LoadAndKeep' not in star_command:
+        raise ValueError('The STAR command must use "--genomeLoad LoadAndKeep" to use the shared genome.')
+
+    lock_dir = _default_lock_dir() if lock_dir is None else lock_dir
+    state_dir = _genome_state_dir(star_reference, lock_dir)
+    consumer_path = state_dir / f'consumer.{os.getpid()}'
+    loaded_flag = state_dir / 'loaded'
+
+    previous_handler = signal.signal(signal.SIGTERM, _raise_on_sigterm)
+    try:
+        with _locked(state_dir):
+            consumers = _live_consumers(state_dir)
+            if len(consumers) == 0 or not loaded_flag.exists():
+                # also reload if the last loading failed or the shared memory is gone (e.g. the node rebooted)
+                print(f'Load STAR genome {star_reference} into shared memory.', file=sys.stderr)
+                _run_star_genome_load(star_reference, 'LoadAndExit', state_dir)
+                loaded_flag.touch()
+            consumer_path.touch()
+
+        try:
+            log.info(f'Run: {" ".join(star_command)}')
+            subprocess.run(star_command, check=True)
+        finally:
+            with _locked(state_dir):
+                consumer_path.unlink()
+                if len(_live_consumers(state_dir)) == 0:
+                    print(f'Remove STAR genome {star_reference} from shared memory, no job is using it.',
+                          file=sys.stderr)
+                    loaded_flag.unlink(missing_ok=True)
+                    _run_star_genome_load(star_reference, 'Remove', state_dir)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+    return
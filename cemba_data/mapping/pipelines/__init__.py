@@ -16,9 +16,11 @@ PACKAGE_DIR = pathlib.Path(cemba_data.__path__[0])
 INHOUSE_SERVERS = ['bpho', 'gale', 'cemba', 'oberon']
 
 
-def prepare_uid_snakefile(uid_dir, config_str, snake_template):
-    cell_ids = [path.name.split('.')[0][:-3] for path in (uid_dir / 'fastq').glob('*R1.fq.gz')]
-    cell_id_str = f'CELL_IDS = {cell_ids}\n'
+def prepare_uid_snakefile(uid_dir, config_str, snake_template, fused_trim=False):
+    # with fused trim, the demultiplexer already wrote the trimmed FASTQ and the trim rules are skipped
+    fastq_pattern = '*R1.trimmed.fq.gz' if fused_trim else '*R1.fq.gz'
+    cell_ids = [path.name.split('.')[0][:-3] for path in (uid_dir / 'fastq').glob(fastq_pattern)]
+    cell_id_str = f'CELL_IDS = {cell_ids}\nfused_trim = {fused_trim}\n'
 
     # no file in this UID, do not make snakefile
     if len(cell_ids) == 0:
@@ -51,7 +53,7 @@ def validate_mapping_config(output_dir):
     return
 
 
-def make_snakefile(output_dir):
+def make_snakefile(output_dir, uids=None, fused_trim=False):
     output_dir = pathlib.Path(output_dir).absolute()
     config = get_configuration(output_dir / 'mapping_config.ini')
     try:
@@ -75,10 +77,13 @@ def make_snakefile(output_dir):
 
     for sub_dir in output_dir.iterdir():
         if sub_dir.is_dir():
-            if sub_dir.name not in ['stats', 'snakemake']:
+            if sub_dir.name not in ['stats', 'snakemake', 'topup']:
+                if uids is not None and sub_dir.name not in uids:
+                    continue
                 prepare_uid_snakefile(uid_dir=sub_dir,
                                       config_str=config_str,
-                                      snake_template=snake_template)
+                                      snake_template=snake_template,
+                                      fused_trim=fused_trim)
     return
 
 
@@ -1,6 +1,8 @@
 def m3c_config_str(config):
     """Change the dtype of parameters and make a appropriate string"""
     int_parameters = {
+        'fastq_compress_level': 5,
+        'fastq_compress_threads': 1,
         'overlap': 6,
         'r1_left_cut': 10,
         'r1_right_cut': 10,
@@ -11,9 +13,11 @@ def m3c_config_str(config):
         'total_read_pairs_min': 1,
         'total_read_pairs_max': 6000000,
         'mapq_threshold': 10,
+        'intermediate_bam_compress_level': 1,
         'num_upstr_bases': 0,
         'num_downstr_bases': 2,
         'compress_level': 5,
+        'batch_bismark_threads': 16,
         'split_left_size': 40,
         'split_right_size': 40,
         'split_middle_min_size': 30,
@@ -21,7 +25,11 @@ def m3c_config_str(config):
         'trim_on_both_end': 5
     }
 
+    bool_parameters = {'batch_bismark': False, 'stream_intermediate_bam': False}
+
     str_parameters = {
+        'io_slots_per_mount': 'default',
+        'local_tmp_dir': 'none',
         'mode': 'mc',
         'barcode_version': 'required',
         'r1_adapter': 'AGATCGGAAGAGCACACGTCTGAAC',
@@ -44,6 +52,21 @@ def m3c_config_str(config):
                 raise ValueError(f'Required parameter {k} not found in config. '
                                  f'You can print the newest mapping config template via "yap default-mapping-config".')
 
+    for k, default in bool_parameters.items():
+        if k in config:
+            v = config[k]
+            if v.lower().startswith('t'):
+                v = True
+            else:
+                v = False
+            typed_config[k] = v
+        else:
+            if default != 'required':
+                typed_config[k] = default
+            else:
+                raise ValueError(f'Required parameter {k} not found in config. '
+                                 f'You can print the newest mapping config template via "yap default-mapping-config".')
+
     for k, default in str_parameters.items():
         if k in config:
             typed_config[k] = f"'{config[k]}'"
@@ -1,6 +1,8 @@
 def mc_config_str(config):
     """Change the dtype of parameters and make a appropriate string"""
     int_parameters = {
+        'fastq_compress_level': 5,
+        'fastq_compress_threads': 1,
         'overlap': 6,
         'r1_left_cut': 10,
         'r1_right_cut': 10,
@@ -11,14 +13,19 @@ def mc_config_str(config):
         'total_read_pairs_min': 1,
         'total_read_pairs_max': 6000000,
         'mapq_threshold': 10,
+        'intermediate_bam_compress_level': 1,
         'num_upstr_bases': 0,
         'num_downstr_bases': 2,
-        'compress_level': 5
+        'compress_level': 5,
+        'batch_bismark_threads': 16
     }
 
-    bool_parameters = {'unmapped_fastq': False}
+    bool_parameters = {'unmapped_fastq': False, 'batch_bismark': False, 'fused_cgn_extraction': False,
+                       'stream_intermediate_bam': False}
 
     str_parameters = {
+        'io_slots_per_mount': 'default',
+        'local_tmp_dir': 'none',
         'mode': 'mc',
         'barcode_version': 'required',
         'r1_adapter': 'AGATCGGAAGAGCACACGTCTGAAC',
@@ -9,6 +9,7 @@ from .mc import mc_mapping_stats, mc_additional_cols
 from .mct import mct_mapping_stats, mct_additional_cols
 from .plate_info import get_plate_info
 from ..pipelines import PACKAGE_DIR
+from ...fs_ops import remove_paths
 from ...utilities import get_configuration
 
 
@@ -36,6 +37,40 @@ def mapping_stats(output_dir):
     return
 
 
+def write_total_mapping_summary(output_dir, summary_paths, mode):
+    """Aggregate UID level mapping summaries into stats/MappingSummary.csv.gz and write stats/AllcPaths.tsv"""
+    output_dir = pathlib.Path(output_dir).absolute()
+
+    # aggregate mapping summaries
+    total_mapping_summary = pd.concat([pd.read_csv(path, index_col=0)
+                                       for path in summary_paths])
+    total_mapping_summary_path = output_dir / 'stats/MappingSummary.csv.gz'
+
+    # if this is mct, aggregate all the gene counts
+    if mode == 'mct':
+        from ..stats.mct import aggregate_feature_counts
+        aggregate_feature_counts(output_dir)
+
+    # add additional columns based on some calculation
+    if mode == 'mc':
+        total_mapping_summary = mc_additional_cols(total_mapping_summary)
+    elif mode == 'mct':
+        total_mapping_summary = mct_additional_cols(total_mapping_summary, output_dir=output_dir)
+    elif mode == 'm3c':
+        total_mapping_summary = m3c_additional_cols(total_mapping_summary)
+    else:
+        raise
+
+    # save total mapping summary
+    total_mapping_summary.to_csv(total_mapping_summary_path)
+
+    # write a ALLC path file for generating MCDS
+    allc_paths = pd.Series({path.name.split('.')[0]: str(path)
+                            for path in output_dir.glob('*/allc/*tsv.gz')})
+    allc_paths.to_csv(output_dir / 'stats/AllcPaths.tsv', sep='\t', header=False)
+    return total_mapping_summary
+
+
 def final_summary(output_dir, cleanup=True, notebook=None):
     output_dir = pathlib.Path(output_dir).absolute()
     mode = get_configuration(output_dir / 'mapping_config.ini')['mode']
@@ -64,28 +99,7 @@ def final_summary(output_dir, cleanup=True, notebook=None):
                                 f'Run the corresponding snakemake command again to retry mapping.\n'
                                 f'The snakemake commands can be found in output_dir/snakemake/*/snakemake_cmd.txt')
 
-    # aggregate mapping summaries
-    total_mapping_summary = pd.concat([pd.read_csv(path, index_col=0)
-                                       for path in summary_paths])
-    total_mapping_summary_path = output_dir / 'stats/MappingSummary.csv.gz'
-
-    # if this is mct, aggregate all the gene counts
-    if mode == 'mct':
-        from ..stats.mct import aggregate_feature_counts
-        aggregate_feature_counts(output_dir)
-
-    # add additional columns based on some calculation
-    if mode == 'mc':
-        total_mapping_summary = mc_additional_cols(total_mapping_summary)
-    elif mode == 'mct':
-        total_mapping_summary = mct_additional_cols(total_mapping_summary, output_dir=output_dir)
-    elif mode == 'm3c':
-        total_mapping_summary = m3c_additional_cols(total_mapping_summary)
-    else:
-        raise
-
-    # save total mapping summary
-    total_mapping_summary.to_csv(total_mapping_summary_path)
+    total_mapping_summary = write_total_mapping_summary(output_dir, summary_paths, mode)
 
     # add .snakemake files to deletion
     snakemake_hiding_dirs = list(output_dir.glob('*/.snakemake'))
@@ -95,11 +109,6 @@ def final_summary(output_dir, cleanup=True, notebook=None):
     mapping_temp_dirs = list(output_dir.glob('*/bam/temp'))
     path_to_remove += mapping_temp_dirs
 
-    # write a ALLC path file for generating MCDS
-    allc_paths = pd.Series({path.name.split('.')[0]: str(path)
-                            for path in output_dir.glob('*/allc/*tsv.gz')})
-    allc_paths.to_csv(output_dir / 'stats/AllcPaths.tsv', sep='\t', header=False)
-
     if 'Plate' in total_mapping_summary.columns:  # only run notebook when plate info exist
         # run summary notebook
         nb_path = output_dir / 'stats/MappingSummary.ipynb'
@@ -126,7 +135,6 @@ def final_summary(output_dir, cleanup=True, notebook=None):
 
     # delete
     if cleanup:
-        print('Clean up snakemake log (might take several minutes) ...')
-        for path in path_to_remove:
-            subprocess.run(['rm', '-rf', str(path)], check=True)
+        print('Clean up snakemake log ...')
+        remove_paths(path_to_remove, desc='Remove snakemake log and temp dirs')
     return
@@ -32,9 +32,6 @@ def testing_mapping_installation(mct=False):
     for command in COMMAND_TO_TEST:
         testing_cmd(command)
 
-    # picard always return 1...
-    testing_cmd('picard MarkDuplicates --version', 1)
-
     if mct:
         testing_cmd('STAR --version')
 
@@ -0,0 +1,371 @@
+"""
+Merge the mapping results of a top-up sequencing run into the existing results
+
+The top-up reads are demultiplexed and mapped in output_dir/topup/{topup_name} (see cemba_data.demultiplex.topup),
+then for each UID:
+1. the final per-cell BAM and ALLC files (and the per-UID RNA BAM and counts of mct) are merged with the existing
+   files, files of cells not exist in output_dir are moved there;
+2. rows of MappingSummary.csv.gz are merged, read counts are summed and the rates are recalculated;
+and stats/demultiplex.stats.csv and stats/MappingSummary.csv.gz of output_dir are updated.
+So the compute of a top-up scales with the new reads, only the merge reads the existing files.
+
+PCR duplicates are removed within each sequencing run by the mapping pipeline,
+duplicates between the top-up reads and the existing reads are kept.
+
+Every merged file is marked in output_dir/topup/{topup_name}/.topup_merged,
+so a killed topup-merge can be run again without merging a file twice.
+A merged file is written in output_dir/topup/{topup_name}/merged first, and marked as moving before it replaces
+the existing file, if topup-merge is killed after the replacement, the re-run find the moving marker without
+the merged file and only mark it as merged.
+"""
+
+import logging
+import pathlib
+import subprocess
+
+import pandas as pd
+import pysam
+
+from .stats import write_total_mapping_summary
+from ..utilities import get_configuration, snakemake
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# final files of each UID dir, glob pattern relative to the UID dir
+MERGE_PATTERNS = {
+    'mc': ['bam/*.final.bam', 'allc/*.allc.tsv.gz', 'allc-*/*.allc.tsv.gz'],
+    'mct': ['bam/*.dna_reads.bam', 'allc/*.allc.tsv.gz',
+            'rna_bam/TotalRNAAligned.rna_reads.bam', 'rna_bam/TotalRNAAligned.rna_reads.feature_count.tsv'],
+    'm3c': ['bam/*.3C.sorted.bam', 'allc/*.allc.tsv.gz', 'hic/*.3C.contact.tsv.gz']
+}
+# index files moved together with the data file
+INDEX_SUFFIXES = ['.tbi', '.bai']
+# cell info columns added by get_plate_info, not summed up
+CELL_INFO_COLUMNS = ['Plate', 'PCRIndex', 'MultiplexGroup', 'RandomIndex', 'Col384', 'Row384']
+TOPUP_RECORD = 'stats/TopupRuns.txt'
+
+
+def get_topup_dir(output_dir, topup_name):
+    return pathlib.Path(output_dir).absolute() / 'topup' / topup_name
+
+
+def _bam_sort_order(bam_path):
+    with pysam.AlignmentFile(bam_path, check_sq=False) as bam:
+        return bam.header.to_dict().get('HD', {}).get('SO', 'unknown')
+
+
+def _chrom_size_path(config, work_dir):
+    for key in ['chrom_sizes_file', 'chrom_size_path']:
+        if key in config:
+            return config[key]
+    # mct config has no chrom size file, use the fasta index of the reference used by bam-to-allc
+    chrom_size_path = work_dir / 'chrom_sizes.txt'
+    fai = pd.read_csv(f"{config['reference_fasta']}.fai", sep='\t', header=None, usecols=[0, 1])
+    fai.to_csv(chrom_size_path, sep='\t', header=False, index=False)
+    return str(chrom_size_path)
+
+
+def _merge_command(base_path, topup_path, output_path, chrom_size_path):
+    """Shell command merging the existing file and the top-up file, None if the file is merged in python"""
+    name = base_path.name
+    if name.endswith('.allc.tsv.gz'):
+        return f'allcools merge-allc --allc_paths {base_path} {topup_path} --output_path {output_path} ' \
+               f'--chrom_size_path {chrom_size_path} --cpu 1'
+    elif name.endswith('.bam'):
+        # -c -p: cells of mct RNA BAM have the same read group in both runs
+        name_sorted = '-n ' if _bam_sort_order(base_path) == 'queryname' else ''
+        cmd = f'samtools merge -f -c -p {name_sorted}{output_path} {base_path} {topup_path}'
+        if pathlib.Path(f'{base_path}.bai').exists():
+            cmd += f' && samtools index {output_path}'
+        return cmd
+    elif name.endswith('.contact.tsv.gz'):
+        # concatenated gzip members are still a valid gzip file
+        return f'cat {base_path} {topup_path} > {output_path}'
+    elif name.endswith('.feature_count.tsv'):
+        return None
+    else:
+        raise ValueError(f'Do not know how to merge {base_path}')
+
+
+def merge_feature_counts(base_path, topup_path, output_path):
+    """Sum the featureCounts tables of two runs, columns are {bam_path}:{cell_id}"""
+    base_df = pd.read_csv(base_path, sep='\t', index_col=0, comment='#')
+    topup_df = pd.read_csv(topup_path, sep='\t', index_col=0, comment='#')
+    gene_info = base_df.iloc[:, :5]
+    counts = base_df.iloc[:, 5:].add(topup_df.iloc[:, 5:], fill_value=0).astype(int)
+    merged = pd.concat([gene_info, counts.reindex(gene_info.index)], axis=1)
+    with open(output_path, 'w') as f:
+        f.write(f'# Merged from {base_path} and {topup_path}\n')
+        merged.to_csv(f, sep='\t')
+    return
+
+
+def merge_demultiplex_stats(base_df, topup_df):
+    """Sum the read pairs of cells and UIDs in two demultiplex stats tables and recalculate CellBarcodeRate"""
+    uid_total = pd.concat([base_df.groupby('UID')['MultiplexedTotalReadPairs'].first(),
+                           topup_df.groupby('UID')['MultiplexedTotalReadPairs'].first()])
+    uid_total = uid_total.groupby(level=0).sum()
+    cell_pairs = pd.concat([base_df['CellInputReadPairs'],
+                            topup_df['CellInputReadPairs']]).groupby(level=0).sum()
+
+    merged = pd.concat([base_df, topup_df])
+    merged = merged[~merged.index.duplicated(keep='first')].sort_index()
+    merged['CellInputReadPairs'] = cell_pairs
+    merged['MultiplexedTotalReadPairs'] = merged['UID'].map(uid_total)
+    merged['CellBarcodeRate'] = merged['CellInputReadPairs'] / merged['MultiplexedTotalReadPairs']
+    return merged
+
+
+def _read_type(col):
+    return col[:2] if col[:2] in ['R1', 'R2'] else ''
+
+
+def _merge_ratio(col, base_df, topup_df, merged):
+    """Recalculate a rate column of cells in both runs"""
+    rt = _read_type(col)
+    # rates with both numerator and denominator in the table: (numerator, denominator, scale)
+    exact_rates = {
+        f'{rt}TrimmedReadsRate': (f'{rt}TrimmedReads', f'{rt}InputReads', 1),
+        # bismark mapping efficiency in %
+        f'{rt}MappingRate': (f'{rt}UniqueMappedReads', f'{rt}TrimmedReads', 100),
+        # picard PERCENT_DUPLICATION is a fraction
+        f'{rt}DuplicationRate': (f'{rt}DuplicatedReads', f'{rt}MAPQFilteredReads', 1),
+        'SelectedRNAReadsRatio': ('FinalRNAReads', 'RNAUniqueMappedReads', 1)
+    }
+    # rates with only numerator in the table, denominator = numerator / rate of each run
+    numerators = {'SelectedDNAReadsRatio': 'FinalDNAReads'}
+
+    if col == 'GenomeCov':
+        # the union coverage is unknown, the larger one is a lower bound
+        return pd.concat([base_df[col], topup_df[col]], axis=1).max(axis=1)
+    if col.endswith('Frac') and f'{col[:-4]}mC' in merged and f'{col[:-4]}Cov' in merged:
+        return merged[f'{col[:-4]}mC'] / merged[f'{col[:-4]}Cov']
+    if col in exact_rates:
+        numerator, denominator, scale = exact_rates[col]
+        if numerator in merged and denominator in merged:
+            return merged[numerator] / merged[denominator] * scale
+    if col in numerators:
+        numerator = numerators[col]
+        denominator = base_df[numerator] / base_df[col] + topup_df[numerator] / topup_df[col]
+        return merged[numerator] / denominator
+
+    # other rates (e.g. bismark mC rates) are averaged with weights
+    if col.startswith(f'{rt}TotalmC') and f'{rt}TotalC' in base_df:
+        weight_col = f'{rt}TotalC'
+    else:
+        weight_col = 'R1InputReads'
+    base_weight = base_df[weight_col].astype(float)
+    topup_weight = topup_df[weight_col].astype(float)
+    return (base_df[col] * base_weight + topup_df[col] * topup_weight) / (base_weight + topup_weight)
+
+
+def merge_mapping_summary(base_df, topup_df):
+    """
+    Merge UID level mapping summary of two runs.
+    Read counts of cells in both runs are summed up and their rate columns are recalculated,
+    cells only in one run are kept as they are.
+    """
+    both = base_df.index.intersection(topup_df.index)
+    base_both = base_df.loc[both]
+    topup_both = topup_df.loc[both].reindex(columns=base_df.columns)
+
+    merged = base_both.copy()
+    rate_cols = []
+    for col in base_df.columns:
+        if col in CELL_INFO_COLUMNS or not pd.api.types.is_numeric_dtype(base_df[col]):
+            continue
+        if col == 'GenomeCov' or col.endswith(('Rate', 'Frac', 'Ratio')):
+            rate_cols.append(col)
+        else:
+            merged[col] = base_both[col].fillna(0) + topup_both[col].fillna(0)
+    for col in rate_cols:
+        merged[col] = _merge_ratio(col, base_both, topup_both, merged)
+
+    merged = pd.concat([merged,
+                        base_df.loc[base_df.index.difference(both)],
+                        topup_df.loc[topup_df.index.difference(both)]]).sort_index()
+    return merged[base_df.columns]
+
+
+class _TopupMergeRecord:
+    """Marker files of merged items in topup_dir/.topup_merged"""
+
+    def __init__(self, topup_dir):
+        self.record_dir = topup_dir / '.topup_merged'
+
+    def _path(self, key, state='done'):
+        return self.record_dir / f'{key}.{state}'
+
+    def is_done(self, key):
+        return self._path(key).exists()
+
+    def mark_done(self, key):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+        self._path(key, 'moving').unlink(missing_ok=True)
+        return
+
+    def is_replaced(self, key, merged_path):
+        """The merged file already replaced the existing file, but the merge is not marked as done"""
+        return self._path(key, 'moving').exists() and not merged_path.exists()
+
+    def replace(self, key, merged_path, base_path):
+        """Replace the existing file by the merged file and mark the merge as done"""
+        path = self._path(key, 'moving')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+        _move_file(merged_path, base_path)
+        self.mark_done(key)
+        return
+
+
+def _move_file(src, dst):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in INDEX_SUFFIXES:
+        src_index = pathlib.Path(f'{src}{suffix}')
+        if src_index.exists():
+            src_index.rename(f'{dst}{suffix}')
+    src.rename(dst)
+    return
+
+
+def _check_mapping_finished(uid_dirs):
+    missing = [uid_dir for uid_dir in uid_dirs
+               if (uid_dir / 'Snakefile').exists() and not (uid_dir / 'MappingSummary.csv.gz').exists()]
+    if len(missing) > 0:
+        for uid_dir in missing:
+            print(uid_dir)
+        raise FileNotFoundError(f'{len(missing)} UID dirs above missing MappingSummary.csv.gz, '
+                                f'finish their mapping before topup-merge.')
+    return
+
+
+def topup_merge(output_dir, topup_name, cpu=1):
+    output_dir = pathlib.Path(output_dir).absolute()
+    topup_dir = get_topup_dir(output_dir, topup_name)
+    if not topup_dir.exists():
+        raise FileNotFoundError(f'Top-up dir {topup_dir} not found.')
+    record_path = output_dir / TOPUP_RECORD
+    if record_path.exists():
+        with open(record_path) as f:
+            if topup_name in f.read().split('\n'):
+                raise ValueError(f'{topup_name} is already merged into {output_dir}, see {record_path}')
+    record = _TopupMergeRecord(topup_dir)
+
+    config = get_configuration(output_dir / 'mapping_config.ini')
+    mode = config['mode']
+    topup_uid_dirs = [path.parent for path in topup_dir.glob('*/Snakefile')]
+    _check_mapping_finished(topup_uid_dirs)
+    _check_mapping_finished([output_dir / uid_dir.name for uid_dir in topup_uid_dirs])
+
+    # collect files to merge and to move
+    merge_jobs = []
+    move_jobs = []
+    for topup_uid_dir in topup_uid_dirs:
+        uid = topup_uid_dir.name
+        for pattern in MERGE_PATTERNS[mode]:
+            for topup_path in topup_uid_dir.glob(pattern):
+                rel_path = f'{uid}/{topup_path.relative_to(topup_uid_dir)}'
+                if record.is_done(rel_path):
+                    continue
+                base_path = output_dir / rel_path
+                merged_path = topup_dir / 'merged' / rel_path
+                if record.is_replaced(rel_path, merged_path):
+                    record.mark_done(rel_path)
+                elif base_path.exists():
+                    merge_jobs.append((rel_path, base_path, topup_path, merged_path))
+                else:
+                    move_jobs.append((rel_path, topup_path, base_path))
+    print(f'Merge {len(merge_jobs)} files and move {len(move_jobs)} files of new cells into {output_dir}')
+
+    # merge files with snakemake, the merged files are written in topup_dir/merged first
+    rules = ''
+    output_paths = []
+    chrom_size_path = None
+    for i, (rel_path, base_path, topup_path, merged_path) in enumerate(merge_jobs):
+        merged_path.parent.mkdir(parents=True, exist_ok=True)
+        if chrom_size_path is None:
+            chrom_size_path = _chrom_size_path(config, topup_dir)
+        cmd = _merge_command(base_path, topup_path, merged_path, chrom_size_path)
+        if cmd is None:
+            continue
+        rules += f"""
+rule merge_{i}:
+    input:
+        ["{base_path}", "{topup_path}"]
+    output:
+        "{merged_path}"
+    shell:
+        "{cmd}"
+
+"""
+        output_paths.append(str(merged_path))
+    if len(output_paths) > 0:
+        rules = f"""
+rule final:
+    input: {output_paths}
+""" + rules
+        snakefile_path = topup_dir / 'Snakefile_topup_merge'
+        with open(snakefile_path, 'w') as f:
+            f.write(rules)
+        snakemake(workdir=topup_dir, snakefile=snakefile_path, cores=cpu, resume=True)
+
+    # replace the existing files by the merged files
+    for rel_path, base_path, topup_path, merged_path in merge_jobs:
+        if merged_path.name.endswith('.feature_count.tsv'):
+            merge_feature_counts(base_path, topup_path, merged_path)
+        record.replace(rel_path, merged_path, base_path)
+    for rel_path, topup_path, base_path in move_jobs:
+        _move_file(topup_path, base_path)
+        record.mark_done(rel_path)
+
+    # UID level mapping summary
+    for topup_uid_dir in topup_uid_dirs:
+        uid = topup_uid_dir.name
+        rel_path = f'{uid}/MappingSummary.csv.gz'
+        merged_path = topup_dir / 'merged' / rel_path
+        if record.is_done(rel_path):
+            continue
+        if record.is_replaced(rel_path, merged_path):
+            record.mark_done(rel_path)
+            continue
+        base_uid_dir = output_dir / uid
+        base_uid_dir.mkdir(exist_ok=True)
+        topup_summary = pd.read_csv(topup_uid_dir / 'MappingSummary.csv.gz', index_col=0)
+        if (base_uid_dir / 'MappingSummary.csv.gz').exists():
+            base_summary = pd.read_csv(base_uid_dir / 'MappingSummary.csv.gz', index_col=0)
+            merged_path.parent.mkdir(parents=True, exist_ok=True)
+            merge_mapping_summary(base_summary, topup_summary).to_csv(merged_path)
+            record.replace(rel_path, merged_path, base_uid_dir / 'MappingSummary.csv.gz')
+        else:
+            # no cell of this UID was mapped in output_dir
+            topup_summary.to_csv(base_uid_dir / 'MappingSummary.csv.gz')
+            if not (base_uid_dir / 'Snakefile').exists():
+                subprocess.run(['cp', str(topup_uid_dir / 'Snakefile'), str(base_uid_dir / 'Snakefile')],
+                               check=True)
+            record.mark_done(rel_path)
+
+    # library level stats
+    rel_path = 'stats/demultiplex.stats.csv'
+    merged_path = topup_dir / 'merged' / rel_path
+    if record.is_replaced(rel_path, merged_path):
+        record.mark_done(rel_path)
+    if not record.is_done(rel_path):
+        stats_path = output_dir / rel_path
+        merged_stats = merge_demultiplex_stats(pd.read_csv(stats_path, index_col=0),
+                                               pd.read_csv(topup_dir / rel_path, index_col=0))
+        merged_path.parent.mkdir(parents=True, exist_ok=True)
+        merged_stats.to_csv(merged_path)
+        record.replace(rel_path, merged_path, stats_path)
+    if (output_dir / 'stats/MappingSummary.csv.gz').exists():
+        # 'yap summary' already run, update the total summary
+        summary_paths = [path.parent / 'MappingSummary.csv.gz' for path in output_dir.glob('*/Snakefile')]
+        write_total_mapping_summary(output_dir, summary_paths, mode)
+
+    with open(record_path, 'a') as f:
+        f.write(f'{topup_name}\n')
+    print(f'{topup_name} merged into {output_dir}, the top-up dir {topup_dir} can be deleted.')
+    return
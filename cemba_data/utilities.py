@@ -48,8 +48,6 @@ def valid_environments(config):
     test_cmd(tool_name='cutadapt', cmd_list=['cutadapt', '--version'])
     # test samtools
     test_cmd(tool_name='samtools', cmd_list=['samtools', '--version'])
-    # test picard, picard always have return code 1...
-    test_cmd(tool_name='picard', cmd_list=['which', 'picard'])
     # test bismark_mapping
     test_cmd(tool_name='bismark_mapping', cmd_list=['bismark_mapping', '--version'])
     if config['mode'] != 'm3c':
@@ -127,17 +125,25 @@ def command_runner(commands, runner=None, cpu=1):
     return
 
 
-def snakemake(workdir, snakefile, cores):
+def snakemake(workdir, snakefile, cores, resources=None, resume=False):
+    cmd = [
+        'snakemake', '-d', str(workdir), '--snakefile',
+        str(snakefile), '--cores',
+        str(cores)
+    ]
+    if resources:
+        # custom resources, e.g. concurrent I/O jobs per filesystem mount
+        cmd += ['--resources'] + [f'{k}={v}' for k, v in resources.items()]
+    if resume:
+        # a killed snakemake leave its lock and incomplete output records in workdir/.snakemake
+        subprocess.run(cmd + ['--unlock'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cmd += ['--rerun-incomplete']
     try:
-        subprocess.run([
-            'snakemake', '-d', str(workdir), '--snakefile',
-            str(snakefile), '--cores',
-            str(cores)
-        ],
-            check=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            encoding='utf8')
+        subprocess.run(cmd,
+                       check=True,
+                       stdin=subprocess.PIPE,
+                       stdout=subprocess.PIPE,
+                       encoding='utf8')
     except subprocess.CalledProcessError as e:
         print(e.stdout)
         print(e.stderr)
@@ -27,7 +27,9 @@ setup(
                       'matplotlib',
                       'papermill',
                       'dnaio',
-                      'pysam'],
+                      'xopen',
+                      'pysam',
+                      'cutadapt>=5.2'],
     entry_points={
         'console_scripts': ['yap=cemba_data.__main__:main',
                             'yap-internal=cemba_data._yap_internal_cli_:internal_main'],